@@ -0,0 +1,187 @@
+import datetime
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# rows per statistics chunk, every chunk keeps min, max and null count of each column
+STATS_CHUNK_ROWS = int(os.getenv("STATS_CHUNK_ROWS", "65536"))
+# a query only scans the matching chunks when they are less than this part of the rows, otherwise the whole frame
+STATS_SKIP_RATIO = float(os.getenv("STATS_SKIP_RATIO", "0.5"))
+
+# pandas and arrow types which keep a min and max, all others only a null count
+RANGED_TYPES = re.compile(r"(u?int|U?Int|float|Float|double|halffloat|datetime64|timestamp)")
+
+
+class ColumnStatistics():
+    """
+    min, max and null count per column for every chunk of rows of the published frame (pandas or arrow).
+    A write keeps the chunks before its first changed row and only computes the rest again.
+    """
+    def __init__(self, columns=None, chunks=None, chunkRows=STATS_CHUNK_ROWS):
+        self.chunkRows = chunkRows
+        # column name -> dtype, chunks are [rows, {column: [min, max, nulls]}, rows without any value]
+        self.columns = columns or {}
+        self.chunks = chunks or []
+
+    @staticmethod
+    def getFrameColumns(frame):
+        if isinstance(frame, pa.Table):
+            return {name: str(frame.schema.field(name).type) for name in frame.column_names}
+        return {str(name): str(frame[name].dtype) for name in frame.columns}
+
+    @staticmethod
+    def getRows(frame):
+        return frame.num_rows if isinstance(frame, pa.Table) else frame.shape[0]
+
+    @staticmethod
+    def toValue(value):
+        if value is None or (not isinstance(value, str) and pd.isnull(value)):
+            return None
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    def computeChunk(self, frame, lo, hi):
+        stats = {}
+        if isinstance(frame, pa.Table):
+            for name in frame.column_names:
+                column = frame.column(name).slice(lo, hi - lo)
+                low, high = None, None
+                if pa.types.is_integer(column.type) or pa.types.is_floating(column.type) or pa.types.is_timestamp(column.type):
+                    minmax = pc.min_max(column)
+                    low, high = self.toValue(minmax["min"].as_py()), self.toValue(minmax["max"].as_py())
+                    if isinstance(low, datetime.datetime):
+                        low, high = pd.Timestamp(low), pd.Timestamp(high)
+                stats[name] = [low, high, column.null_count]
+            values = [c for c in frame.column_names if c != "datetime"]
+            if len(values) == 0:
+                return [hi - lo, stats, hi - lo]
+            valid = pc.is_valid(frame.column(values[0]).slice(lo, hi - lo))
+            for name in values[1:]:
+                valid = pc.or_(valid, pc.is_valid(frame.column(name).slice(lo, hi - lo)))
+            return [hi - lo, stats, int(pc.sum(pc.invert(valid)).as_py() or 0)]
+
+        part = frame.iloc[lo:hi]
+        isnull = part.isnull()
+        nulls = isnull.sum()
+        for position, name in enumerate(frame.columns):
+            series = part.iloc[:, position]
+            low, high = None, None
+            if series.dtype.kind in "iufM" and series.shape[0] > int(nulls.iloc[position]):
+                low, high = self.toValue(series.min()), self.toValue(series.max())
+            stats[str(name)] = [low, high, int(nulls.iloc[position])]
+        # the same rows a dropna over every column except datetime removes
+        empty = isnull.loc[:, [c != "datetime" for c in frame.columns]].all(axis=1).sum()
+        return [hi - lo, stats, int(empty)]
+
+    def computeChunks(self, frame, fromChunk=0):
+        rows = self.getRows(frame)
+        chunks = []
+        for lo in range(fromChunk * self.chunkRows, rows, self.chunkRows):
+            chunks.append(self.computeChunk(frame, lo, min(rows, lo + self.chunkRows)))
+        return chunks
+
+    @classmethod
+    def fromFrame(cls, frame):
+        statistics = cls(columns=cls.getFrameColumns(frame))
+        statistics.chunks = statistics.computeChunks(frame)
+        return statistics
+
+    def update(self, frame, fromRow=0):
+        # the chunks before the first changed row are complete and unchanged, so they are kept
+        columns = self.getFrameColumns(frame)
+        if columns != self.columns or fromRow <= 0:
+            return ColumnStatistics.fromFrame(frame)
+        keep = min(len(self.chunks), fromRow // self.chunkRows)
+        return ColumnStatistics(columns=columns, chunks=self.chunks[:keep] + self.computeChunks(frame, keep),
+                                chunkRows=self.chunkRows)
+
+    def getRowCount(self):
+        return sum([chunk[0] for chunk in self.chunks])
+
+    def hasColumn(self, column):
+        return column in self.columns
+
+    def hasRange(self, column):
+        return RANGED_TYPES.match(self.columns.get(column, "")) is not None
+
+    def getEmptyRowCount(self):
+        return sum([chunk[2] for chunk in self.chunks])
+
+    def getNullCount(self, column):
+        return sum([chunk[1][column][2] for chunk in self.chunks])
+
+    def getMin(self, column):
+        values = [chunk[1][column][0] for chunk in self.chunks if chunk[1][column][0] is not None]
+        return min(values) if len(values) > 0 else None
+
+    def getMax(self, column):
+        values = [chunk[1][column][1] for chunk in self.chunks if chunk[1][column][1] is not None]
+        return max(values) if len(values) > 0 else None
+
+    def getRowRanges(self, predicates):
+        """
+        row ranges of the chunks which can contain rows for all (column, bound, value) predicates,
+        None when every chunk is needed
+        """
+        predicates = [(c, b, v) for c, b, v in predicates if c in self.columns]
+        if len(predicates) == 0:
+            return None
+
+        ranges = []
+        lo = 0
+        kept = 0
+        for rows, stats, empty in self.chunks:
+            keep = True
+            for column, bound, value in predicates:
+                low, high, nulls = stats[column]
+                if nulls == rows:
+                    # a comparison with null never matches
+                    keep = False
+                    break
+                if not isinstance(low, (int, float)) or isinstance(low, bool):
+                    continue
+                if (bound == "start" and high < value) or (bound == "end" and low > value):
+                    keep = False
+                    break
+            if keep:
+                kept = kept + rows
+                if len(ranges) > 0 and ranges[-1][1] == lo:
+                    ranges[-1] = (ranges[-1][0], lo + rows)
+                else:
+                    ranges.append((lo, lo + rows))
+            lo = lo + rows
+        if kept > lo * STATS_SKIP_RATIO:
+            return None
+        return ranges
+
+    def toJson(self, signature):
+        def encode(value):
+            if isinstance(value, pd.Timestamp):
+                return {"timestamp": value.isoformat()}
+            return value
+        chunks = [[rows, {c: [encode(s[0]), encode(s[1]), s[2]] for c, s in stats.items()}, empty]
+                  for rows, stats, empty in self.chunks]
+        return json.dumps({"signature": signature, "chunkRows": self.chunkRows, "columns": self.columns, "chunks": chunks})
+
+    @classmethod
+    def fromJson(cls, data, signature):
+        info = json.loads(data)
+        if info["signature"] != signature or info["chunkRows"] != STATS_CHUNK_ROWS:
+            return None
+
+        def decode(value):
+            if isinstance(value, dict):
+                return pd.Timestamp(value["timestamp"])
+            return value
+        chunks = [[rows, {c: [decode(s[0]), decode(s[1]), s[2]] for c, s in stats.items()}, empty]
+                  for rows, stats, empty in info["chunks"]]
+        return cls(columns=info["columns"], chunks=chunks, chunkRows=info["chunkRows"])
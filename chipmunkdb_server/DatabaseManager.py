@@ -7,8 +7,14 @@ import threading
 from chipmunkdb_server.Registrar import Registrar
 from chipmunkdb_server.TableDatabase import TableDatabase
 from chipmunkdb_server.DocumentDatabase import DocumentDatabase
-from chipmunkdb_server.helper import extract_tables, printTiming
+from chipmunkdb_server.helper import printTiming, parse_query, replace_schemas, is_internal_query, get_parse_cache_stats
 from chipmunkdb_server.StorageDatabase import StorageDatabase
+from chipmunkdb_server.WorkerPools import WorkerPools
+from chipmunkdb_server.SaveScheduler import SaveScheduler
+from chipmunkdb_server.QueryCache import QueryCache
+from chipmunkdb_server.StoragePolicy import StoragePolicy
+from chipmunkdb_server.RetentionJob import RetentionJob
+from chipmunkdb_server.SharedCatalog import SharedCatalog
 
 import os.path
 import simplejson as json
@@ -16,6 +22,7 @@ import tracemalloc
 import os.path
 import time
 import pandas as pd
+import pyarrow as pa
 from dotenv import load_dotenv
 
 import sqlparse
@@ -25,6 +32,10 @@ import numpy as np
 
 load_dotenv()
 DATABASE_DIRECTORY = os.getenv("DATABASE_DIRECTORY", "db")
+# loaded collections are evicted to disk, least recently used first, when they need more memory than this. 0 disables the budget
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+# an eviction skips a collection when a writer holds it longer than this
+EVICTION_LOCK_TIMEOUT = float(os.getenv("EVICTION_LOCK_TIMEOUT", "1"))
 
 
 class DatabaseManager():
@@ -38,6 +49,16 @@ class DatabaseManager():
         self.loadedDocuments = {}
         self.loadedStorages = {}
         self.loadedDatabases = {}
+        self._loadingDatabases = {}
+        self.loop = None
+        self.pools = WorkerPools()
+        self.saveScheduler = SaveScheduler()
+        self.queryCache = QueryCache()
+        self.retentionJob = RetentionJob(self)
+        self.catalog = SharedCatalog(self.queryCache)
+        self._evictLock = threading.Lock()
+        self._evictions = 0
+        self._parseTime = 0.0
         if self.isDebug():
             self.debug()
 
@@ -65,7 +86,7 @@ class DatabaseManager():
         self.startCleanupService()
 
     def replaceSchemas(self, sql):
-        return sql.replace("default.", "").replace("'default'.", "").replace('"default".', "").replace("`default`.", "")
+        return replace_schemas(sql)
 
     def cleanup(self):
 
@@ -73,24 +94,19 @@ class DatabaseManager():
             current, peak = tracemalloc.get_traced_memory()
             print(f"BEFORE memory usage is  {current / 10 ** 6}MB; Peak was {peak / 10 ** 6}MB")
 
-        deletedb = []
-        for dbkey in self.loadedDatabases:
+        for dbkey, db in list(self.loadedDatabases.items()):
             try:
-                db: TableDatabase = self.loadedDatabases[dbkey]
-
                 now = time.time()
-                if now - db.lastUsage() > self.getCleanupTime():
+                if now - db.lastUsage() > float(self.getCleanupTime()):
                     print("We cleanup the database: "+dbkey)
                     self.cleanupDatabase(db, dbkey)
-                    deletedb.append(dbkey)
             except Exception as e:
                 pass
 
-        for key in deletedb:
-            try:
-                del self.loadedDatabases[key]
-            except Exception as e:
-                pass
+        self.enforceMemoryBudget()
+
+        if self.retentionJob.isDue() and self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.retentionJob.run(), self.loop)
 
         if self.isDebug():
             current, peak = tracemalloc.get_traced_memory()
@@ -101,12 +117,71 @@ class DatabaseManager():
 
     def cleanupDatabase(self, db: TableDatabase, dbkey):
         try:
-            db.cleanup()
+            # writers wait for the checkpoint and load the collection again afterwards
+            with db.writeLock(EVICTION_LOCK_TIMEOUT):
+                db.cleanup()
+                if self.loadedDatabases.get(dbkey) is db:
+                    del self.loadedDatabases[dbkey]
         except Exception as e:
-            pass
+            print("Error on cleanup of database", dbkey, str(e))
+            return False
+
+        return True
+
+    def getMemoryUsage(self):
+        usage = {}
+        for name, db in list(self.loadedDatabases.items()):
+            try:
+                usage[name] = db.getMemoryUsage()
+            except Exception as e:
+                usage[name] = 0
+        return usage
+
+    def enforceMemoryBudget(self, keep=None):
+        if MEMORY_BUDGET_MB <= 0:
+            return True
+        if not self._evictLock.acquire(blocking=False):
+            # another thread is already evicting
+            return True
+
+        try:
+            budget = MEMORY_BUDGET_MB * 1024 * 1024
+            usage = self.getMemoryUsage()
+            used = sum(usage.values())
+            if used <= budget:
+                return True
+
+            candidates = []
+            for name, size in usage.items():
+                db = self.loadedDatabases.get(name)
+                if name != keep and size > 0 and db is not None:
+                    candidates.append((db.lastUsage(), name, db))
+
+            for lastUsage, name, db in sorted(candidates, key=lambda c: c[0]):
+                if used <= budget:
+                    break
+                print("We evict the database: "+name, usage[name])
+                if self.cleanupDatabase(db, name):
+                    used = used - usage[name]
+                    self._evictions = self._evictions + 1
+        finally:
+            self._evictLock.release()
 
         return True
 
+    def getMemoryStats(self):
+        usage = self.getMemoryUsage()
+        collections = {}
+        for name, size in usage.items():
+            db = self.loadedDatabases.get(name)
+            collections[name] = {"bytes": size, "lastUsed": db.lastUsage() if db is not None else None}
+        return {
+            "budget": int(MEMORY_BUDGET_MB * 1024 * 1024),
+            "used": sum(usage.values()),
+            "evictions": self._evictions,
+            "collections": collections,
+        }
+
     def getCleanupTime(self):
         if os.getenv("cleanup_timer"):
             return os.getenv("cleanup_timer")
@@ -116,13 +191,13 @@ class DatabaseManager():
         thread = threading.Timer(30, self.cleanup)
         thread.start()
 
-    async def createNewDatabase(self, name, type, indexType="timeseries"):
+    async def createNewDatabase(self, name, type, indexType="timeseries", partitioning=None, storagePolicy=None):
 
         try:
-            await self.db_execute("INSERT INTO collections (name, type, indextype, col_columns, col_domains, lastedit) "
-                              "VALUES (?, ?, ?, ?, ?, DATETIME())",
+            await self.db_execute("INSERT INTO collections (name, type, indextype, col_columns, col_domains, partitioning, storage_policy, lastedit) "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, DATETIME())",
                               [
-                                    name, type, indexType, "", ""
+                                    name, type, indexType, "", "", partitioning, storagePolicy
                                 ])
         except Exception as e:
             print("ERror in creating database", str(e))
@@ -246,7 +321,8 @@ class DatabaseManager():
 
         return self.createDocument(directory, document, type=type)
 
-    async def getOrCreateDatabaseObject(self, name, type, indextype="timeseries", create_new=True):
+    async def getOrCreateDatabaseObject(self, name, type, indextype="timeseries", create_new=True, partitioning=None,
+                                        storagePolicy=None):
 
         info = await self.getCollectionInfoByName(name)
         if info is not None:
@@ -255,15 +331,27 @@ class DatabaseManager():
             else:
                 return self.loadedDatabases[name]
         if create_new:
-            return await self.createNewDatabase(name, type, indexType=indextype)
+            return await self.createNewDatabase(name, type, indexType=indextype, partitioning=partitioning,
+                                                storagePolicy=storagePolicy)
         else:
             return None
 
     async def loadDatabaseFromFile(self, name, create=False):
 
+        if name not in self._loadingDatabases:
+            task = asyncio.ensure_future(self.loadDatabaseObject(name, create=create))
+            self._loadingDatabases[name] = task
+            task.add_done_callback(lambda t: self._loadingDatabases.pop(name, None))
+
+        # concurrent requests for the same collection wait for the same load
+        return await asyncio.shield(self._loadingDatabases[name])
+
+    async def loadDatabaseObject(self, name, create=False):
         try:
             info = await self.getCollectionInfoByName(name)
-            self.loadedDatabases[name] = TableDatabase(info, self, create=create)
+            # loading reads the whole file, so it must not run on the event loop
+            self.loadedDatabases[name] = await self.pools.run(TableDatabase, info, self, create=create)
+            await self.pools.run(self.enforceMemoryBudget, name)
         except Exception as e:
             print("Error on loading database", str(e))
 
@@ -280,6 +368,9 @@ class DatabaseManager():
         #for collection in self.loadedStorages:
         #    self.loadedStorages[collection].save()
 
+        self.saveScheduler.shutdown()
+        self.pools.shutdown()
+
         return True
 
     async def loadFromFileSystem(self):
@@ -308,26 +399,91 @@ class DatabaseManager():
             indextype = "timeseries"
         else:
             indextype = "raw"
-        dbObject = await self.getOrCreateDatabaseObject(collection, "table", indextype=indextype)
+        partitioning = info["partitioning"] if "partitioning" in info else None
+        # only used when the collection is created, e.g. "integers,float32,strings" or "none"
+        storagePolicy = info["storage_policy"] if "storage_policy" in info else None
+        if storagePolicy is not None and not StoragePolicy.isValid(storagePolicy):
+            raise Exception("invalid_storage_policy", storagePolicy)
+        dbObject = await self.getOrCreateDatabaseObject(collection, "table", indextype=indextype, partitioning=partitioning,
+                                                        storagePolicy=storagePolicy)
 
         #if "__index_level_0__" not in df.columns.tolist():
         #    raise Exception("no_index_in_dataframe", "Your dataframe has no index")
 
-        dbObject.addDataframeToDatabase(df, mode, domain=domain)
-
-    async def getDataFrameFromCollection(self, collection, columns, domains=[]):
+        await self.saveScheduler.waitForCapacity()
+        while True:
+            async with dbObject.writeLock():
+                if not dbObject.isEvicted():
+                    await self.pools.run(dbObject.addDataframeToDatabase, df, mode, domain=domain)
+                    break
+            # evicted while waiting for the lock, the next lookup loads it again
+            dbObject = await self.getOrCreateDatabaseObject(collection, "table", indextype=indextype, partitioning=partitioning,
+                                                            storagePolicy=storagePolicy)
+
+        await self.pools.run(self.enforceMemoryBudget, collection)
+
+    async def getDataFrameFromCollection(self, collection, columns, domains=[], start=None, end=None):
+
+        if (start is not None or end is not None) and collection not in self.loadedDatabases:
+            # partitioned collections can answer a time range without loading everything
+            info = await self.getCollectionInfoByName(collection)
+            if info is not None and "partitioning" in info:
+                dbObject = TableDatabase(info, self, load=False)
+                try:
+                    return await self.pools.run(self.getFrameFromPartitions, dbObject, columns, domains, start, end)
+                finally:
+                    dbObject.closeConnections()
 
         dbObject = await self.getOrCreateDatabaseObject(collection, "table")
-        df = dbObject.df(domains=domains)
+        return await self.pools.run(self.getFrameFromTable, dbObject, columns, domains, start, end)
 
+    def getFrameFromPartitions(self, dbObject, columns, domains, start, end):
+        df = dbObject.readPartitions(start=start, end=end)
+        if len(domains) > 0:
+            df = dbObject.filter_df_by_prefix(df, domains)
         df = df.dropna(axis=0, how="all", subset=[n for n in df if n != 'datetime'])
+        return df[columns] if len(columns) > 0 else df
+
+    def getFrameFromTable(self, dbObject, columns, domains, start, end):
+        version = dbObject.getVersion()
+        df = dbObject.df(domains=domains)
+        if start is not None or end is not None:
+            df = dbObject.sliceTimeRange(df, start, end)
+
+        if dbObject.mayHaveEmptyRows(df.columns.tolist(), version):
+            df = df.dropna(axis=0, how="all", subset=[n for n in df if n != 'datetime'])
 
         return df[columns] if len(columns) > 0 else df
 
+    async def getArrowFromCollection(self, collection, columns):
+
+        dbObject = await self.getOrCreateDatabaseObject(collection, "table")
+        if dbObject.isArrowEngine():
+            # serialize the arrow state directly, without a pandas round trip
+            return await self.pools.run(dbObject.getArrow, columns)
+
+        df = await self.getDataFrameFromCollection(collection, columns)
+        return await self.pools.run(pa.Table.from_pandas, df)
+
+    def getStats(self):
+        return {
+            "pools": self.pools.getStats(),
+            "saves": self.saveScheduler.getStats(),
+            "loadedCollections": len(self.loadedDatabases),
+            "loadingCollections": len(self._loadingDatabases),
+            "loadedStorages": len(self.loadedStorages),
+            "loadedDocuments": len(self.loadedDocuments),
+            "memory": self.getMemoryStats(),
+            "queryCache": self.queryCache.getStats(),
+            "catalog": self.catalog.getStats(),
+            "parser": dict(get_parse_cache_stats(), time=round(self._parseTime, 3)),
+            "retention": self.retentionJob.getStats(),
+        }
+
     async def blockUntilOperationsFinished(self, collection):
         dbObject = await self.getOrCreateDatabaseObject(collection, "table", create_new=False)
         if dbObject is not None:
-            return dbObject.waitUntilOperationsFinished()
+            return await dbObject.waitUntilOperationsFinishedAsync()
         return True
 
 
@@ -370,7 +526,7 @@ class DatabaseManager():
             pass
 
         ## thats for some problems when master file is not correct
-        if os.path.isfile(self.dbPath+"/tables/"+name+".duck"):
+        if os.path.isfile(self.dbPath+"/tables/"+name+".duck") or os.path.isdir(self.dbPath+"/tables/"+name):
             ## fallback defaults
             return {
                 "name": name,
@@ -467,12 +623,88 @@ class DatabaseManager():
     async def dropColumns(self, collection, columns, domain=None):
         try:
             if collection in self.loadedDatabases:
-                self.loadedDatabases[collection].dropColumns(columns, domain=domain)
+                dbObject = self.loadedDatabases[collection]
+                while True:
+                    async with dbObject.writeLock():
+                        if not dbObject.isEvicted():
+                            await self.pools.run(dbObject.dropColumns, columns, domain=domain)
+                            break
+                    dbObject = await self.getOrCreateDatabaseObject(collection, "table", create_new=False)
         except Exception as e:
             pass
 
         return True
 
+    async def getRetentions(self, table):
+        keys = {"collections": "name", "storages": "document", "documents": "directory, document"}
+        try:
+            df = await self.db_query("SELECT "+keys[table]+", retention FROM "+table+" WHERE retention IS NOT NULL AND retention != ''")
+            return df.to_dict("records")
+        except Exception as e:
+            print("Error on reading the retentions of", table, str(e))
+            return []
+
+    async def setRetention(self, kind, name, retention, directory=None):
+        try:
+            RetentionJob.parseRetention(retention)
+        except Exception as e:
+            raise Exception("invalid_retention", retention)
+        retention = None if retention is None or str(retention).strip() == "" else str(retention).strip()
+        if kind == "collection":
+            await self.db_execute("UPDATE collections SET retention=? WHERE name=?", [retention, name])
+        elif kind == "storage":
+            await self.db_execute("UPDATE storages SET retention=? WHERE document=?", [retention, name])
+        else:
+            await self.db_execute("UPDATE documents SET retention=? WHERE directory=? AND document=?", [retention, directory, name])
+        return True
+
+    async def applyCollectionRetention(self, name, cutoff):
+        try:
+            if name in self._loadingDatabases:
+                # the next run gets it
+                return 0
+            while name in self.loadedDatabases:
+                dbObject = self.loadedDatabases[name]
+                async with dbObject.writeLock():
+                    if not dbObject.isEvicted():
+                        return await self.pools.run(dbObject.applyRetention, cutoff)
+            info = await self.getCollectionInfoByName(name)
+            if info is None:
+                return 0
+            # not loaded, so only the files are changed
+            dbObject = TableDatabase(info, self, load=False)
+            try:
+                return await self.pools.run(dbObject.applyRetention, cutoff)
+            finally:
+                dbObject.closeConnections()
+        except Exception as e:
+            print("Error on retention of collection", name, str(e))
+            return None
+
+    async def applyStorageRetention(self, document, cutoff):
+        try:
+            storage = await self.getOrLoadStorageFromFile(document)
+            if storage is None:
+                return None
+            return await self.pools.run(storage.applyRetention, cutoff)
+        except Exception as e:
+            print("Error on retention of storage", document, str(e))
+            return None
+
+    async def applyDocumentRetention(self, directory, document, cutoff):
+        try:
+            if directory+"."+document not in self.loadedDocuments:
+                df = await self.db_query("SELECT type FROM documents WHERE directory='"+directory+"' AND document='"+document+"'")
+                if df.shape[0] == 0 or not os.path.isfile(self.dbPath+"/documents/"+directory+"/"+document+".json"):
+                    return 0
+                self.loadedDocuments[directory+"."+document] = DocumentDatabase(
+                    {"document": document, "directory": directory, "type": df["type"].iloc[0]}, self)
+            doc = self.loadedDocuments[directory+"."+document]
+            return await self.pools.run(doc.applyRetention, cutoff)
+        except Exception as e:
+            print("Error on retention of document", directory, document, str(e))
+            return None
+
     async def getAllCollections(self):
         df = await self.db_query("SELECT * FROM collections")
         if 'lastedit' in df.columns:
@@ -486,7 +718,7 @@ class DatabaseManager():
     async def initializeMasterFile(self):
         await self.db_exeucte_multiple([
             "CREATE TABLE info(key VARCHAR(20), value VARCHAR(20))",
-            "CREATE TABLE collections(name VARCHAR(50), col_columns VARCHAR(900), col_domains VARCHAR(900), type VARCHAR(20), rows INTEGER, indextype VARCHAR(30), lastedit TIMESTAMP)",
+            "CREATE TABLE collections(name VARCHAR(50), col_columns VARCHAR(900), col_domains VARCHAR(900), type VARCHAR(20), rows INTEGER, indextype VARCHAR(30), partitioning VARCHAR(10), storage_policy VARCHAR(100), retention VARCHAR(50), lastedit TIMESTAMP)",
             "CREATE TABLE documents(document VARCHAR(50), directory VARCHAR(50), retention VARCHAR(50), type VARCHAR(20), size INTEGER, lastedit TIMESTAMP)",
             "CREATE TABLE storages(document VARCHAR(50), rows INTEGER, keys VARCHAR(900), retention VARCHAR(50), type VARCHAR(20), size INTEGER, lastedit TIMESTAMP)",
             "CREATE UNIQUE INDEX name_idx_storages ON storages (document)",
@@ -496,6 +728,22 @@ class DatabaseManager():
             "INSERT INTO info (key, value) VALUES ('lowerversion', '" + str(self.lowerVersion) + "')"
         ])
 
+    async def upgradeMasterColumns(self):
+        # columns which were added after the first master file version
+        missing = {
+            "collections": {"partitioning": "VARCHAR(10)", "storage_policy": "VARCHAR(100)", "retention": "VARCHAR(50)"},
+        }
+        execs = []
+        for table in missing:
+            df = await self.db_query("PRAGMA table_info('"+table+"')")
+            existing = df["name"].tolist() if "name" in df.columns else []
+            for col in missing[table]:
+                if col not in existing:
+                    execs.append("ALTER TABLE "+table+" ADD COLUMN "+col+" "+missing[table][col])
+        if len(execs) > 0:
+            await self.db_exeucte_multiple(execs, [[] for e in execs])
+        return True
+
     async def block_or_wait_for_db_queue(self):
         for i in range(100):
             if os.path.exists(self.getLockFile()):
@@ -555,21 +803,20 @@ class DatabaseManager():
         if oldVersion <= 1:
             print("Update not needed")
 
-    async def query(self, query, options={}, domains=[], targetTable=None):
+    async def query(self, query, options={}, domains=[], targetTable=None, arrow=False):
         start = time.time()
-        statements = sqlparse.parse(query)
+        # parsing and routing only depend on the text, repeated queries are answered from the cache
+        statements = parse_query(query)
+        self._parseTime = self._parseTime + (time.time() - start)
+        self.printTiming(start, "query_parse")
         res = []
-        targetTable = None
-        for q in statements:
-            if targetTable is None:
-                targetTables = extract_tables(q.value)
-                if len(targetTables) > 0:
-                    targetTable = targetTables[0]
-
+        for statement, targetTable, tables in statements:
             data_df = None
             columns = None
-            if targetTable is None:
-                data_df = await self.db_query(q.value)
+            if len(tables) > 1:
+                data_df, columns = await self.queryCatalog(statement, tables, domains)
+            elif targetTable is None:
+                data_df = await self.db_query(statement)
                 bstart = printTiming(None)
                 columns = self.getColumnsDescription(data_df)
                 printTiming(bstart, "getColumnsDescription", _name=self.__class__.__name__)
@@ -580,7 +827,7 @@ class DatabaseManager():
                 if dbo == False or dbo is None:
 
                     try:
-                        data_df = await self.db_query(q.value)
+                        data_df = await self.db_query(statement)
                         bstart = printTiming(None)
                         columns = self.getColumnsDescription(data_df)
                         printTiming(bstart, "getColumnsDescription", _name=self.__class__.__name__)
@@ -588,7 +835,7 @@ class DatabaseManager():
                         raise Exception("table_not_existent", "The table "+targetTable+" does not exist")
 
                 else:
-                    data_df, columns = dbo.query(q.value, domains=domains)
+                    data_df, columns = await self.pools.run(dbo.query, statement, domains=domains, arrow=arrow)
 
             res.append((data_df, columns))
 
@@ -596,6 +843,18 @@ class DatabaseManager():
 
         return res
 
+    async def queryCatalog(self, statement, tables, domains=[]):
+        # a statement over several collections runs on the shared catalog, unloaded collections are loaded first
+        collections = {}
+        for table in tables:
+            dbo = await self.getOrCreateDatabaseObject(table, "table", create_new=False)
+            if dbo is None:
+                raise Exception("table_not_existent", "The table "+table+" does not exist")
+            collections[table] = dbo
+        data_df, columns = await self.pools.run(self.catalog.query, statement, collections, domains=domains)
+        await self.pools.run(self.enforceMemoryBudget)
+        return data_df, columns
+
     def printTiming(self, start, label):
         end = time.time()
         if self._printTime:
@@ -617,6 +876,9 @@ class DatabaseManager():
             os.mkdir(self.dbPath+"/documents")
         if not os.path.isfile(self.dbPath+"/master.db"):
             await self.initializeMasterFile()
+        await self.upgradeMasterColumns()
+        # worker and save threads hand their master updates over to this loop
+        self.loop = asyncio.get_running_loop()
 
         await self.loadFromFileSystem()
         await self.unblock_db_queue()
@@ -625,11 +887,7 @@ class DatabaseManager():
         return True
 
     def isInternalQuery(self, q):
-        if "DESCRIBE " in q.upper():
-            return True
-        if "SHOW " in q.upper():
-            return True
-        return False
+        return is_internal_query(q)
 
     async def getDfOfSchemas(self):
         df = pd.DataFrame(columns=["name"])
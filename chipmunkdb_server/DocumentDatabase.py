@@ -1,5 +1,6 @@
 import time
 import os
+import pandas as pd
 from tinydb import TinyDB, Query
 
 
@@ -46,12 +47,39 @@ class DocumentDatabase():
             self._type = "single"
 
         if isinstance(data, list):
-            self._db.insert_multiple(data)
+            ids = self._db.insert_multiple(data)
         else:
-            self._db.insert(data)
+            ids = [self._db.insert(data)]
+        if self._type == "list":
+            # kept in its own table, so the items stay as they were sent
+            now = time.time()
+            self._db.table("_inserted").insert_multiple([{"id": i, "time": now} for i in ids])
 
         return self.getData()
 
+    def applyRetention(self, cutoff):
+        # removes the list items which were inserted before the cutoff (naive utc)
+        if cutoff is None or self._type != "list":
+            return 0
+        limit = cutoff.tz_localize("UTC").timestamp()
+        inserted = self._db.table("_inserted")
+        times = {entry["id"]: entry["time"] for entry in inserted.all()}
+        expired = []
+        for item in self._db.all():
+            when = times.get(item.doc_id)
+            if when is None and "datetime" in item:
+                # items from before the insert times were kept
+                try:
+                    when = pd.Timestamp(item["datetime"]).timestamp()
+                except Exception as e:
+                    when = None
+            if when is not None and when < limit:
+                expired.append(item.doc_id)
+        if len(expired) > 0:
+            self._db.remove(doc_ids=expired)
+            inserted.remove(Query().id.one_of(expired))
+        return len(expired)
+
     def data(self):
         return self.getData()
 
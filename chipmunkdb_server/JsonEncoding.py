@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+class JsonEncoding():
+    """
+    Encodes query results to the same json as a dumps of their records, but column by column:
+    numbers, timestamps and nulls are formatted for the whole column at once, strings once per distinct value.
+    Only columns with other values (lists, timedeltas, ...) are encoded value by value.
+    Besides the records, a result can be written as rows of arrays with the names once ("split") or as one list per column ("columnar").
+    """
+    def __init__(self, dumps):
+        # the encoder of the response, used for the names, the distinct values and the fallback
+        self._dumps = dumps
+
+    def encodeRecords(self, frame):
+        return "[" + ", ".join(self.encodeRows(frame)) + "]"
+
+    def encodeSplit(self, frame):
+        # {"columns": [...], "data": [[...], ...]}, the names once instead of in every row
+        names, values = self.encodeColumns(frame)
+        return '{"columns": ' + self._dumps([str(n) for n in names]) + ', "data": [' + ", ".join(self.joinArrays(values)) + "]}"
+
+    def encodeColumnar(self, frame):
+        # {"column": [values], ...}, every column as one list
+        names, values = self.encodeColumns(frame)
+        return "{" + ", ".join([self.encodeKey(n) + "[" + ", ".join(v) + "]" for n, v in zip(names, values)]) + "}"
+
+    def encodeShape(self, frame, shape="records"):
+        if shape == "split":
+            return self.encodeSplit(frame)
+        if shape == "columnar":
+            return self.encodeColumnar(frame)
+        return self.encodeRecords(frame)
+
+    def encodeColumns(self, frame):
+        """
+        returns the names and the json text of the values of every column
+        """
+        if isinstance(frame, pa.Table):
+            names = frame.column_names
+            columns = [frame.column(i).to_pandas() for i in range(frame.num_columns)]
+        else:
+            names = frame.columns.tolist()
+            columns = [frame.iloc[:, i] for i in range(frame.shape[1])]
+        return names, [self.encodeColumn(series) for series in columns]
+
+    def encodeKey(self, name):
+        # '"name": ', the same way as the dumps writes a key
+        return self._dumps({name: None})[1:-len("null}")]
+
+    def encodeRows(self, frame):
+        """
+        returns the json object of every row as a list of strings
+        """
+        names, values = self.encodeColumns(frame)
+        if len(names) == 0:
+            # like to_dict("records"), a frame without columns has no records
+            return []
+        fragments = [np.asarray(self.encodeKey(name), dtype=object) + encoded for name, encoded in zip(names, values)]
+        return ["{" + ", ".join(row) + "}" for row in zip(*fragments)]
+
+    def encodeArrays(self, frame):
+        """
+        returns the json array of the values of every row as a list of strings
+        """
+        return self.joinArrays(self.encodeColumns(frame)[1])
+
+    def joinArrays(self, values):
+        return ["[" + ", ".join(row) + "]" for row in zip(*values)]
+
+    def encodeColumn(self, series):
+        """
+        returns the json text of every value of the column as an object array
+        """
+        dtype = series.dtype
+        if isinstance(dtype, np.dtype):
+            if dtype.kind == "f":
+                return self.encodeFloats(series.to_numpy())
+            if dtype.kind in "iu":
+                return series.to_numpy().astype(str).astype(object)
+            if dtype.kind == "b":
+                return np.where(series.to_numpy(), "true", "false").astype(object)
+            if dtype.kind == "M":
+                encoded = self.encodeDatetimes(series)
+                if encoded is not None:
+                    return encoded
+        elif isinstance(dtype, pd.DatetimeTZDtype):
+            encoded = self.encodeTimestamps(series)
+            if encoded is not None:
+                return encoded
+        if dtype.kind not in "mM":
+            encoded = self.encodeDistinct(series)
+            if encoded is not None:
+                return encoded
+        return np.array([self._dumps(v) for v in series.astype(object).tolist()], dtype=object)
+
+    def encodeFloats(self, values):
+        # numpy writes the shortest repr like python does, only the widening of float32 has to happen first
+        values = values.astype(np.float64)
+        encoded = values.astype(str).astype(object)
+        encoded[~np.isfinite(values)] = "null"
+        return encoded
+
+    def encodeDatetimes(self, series):
+        # the query results format naive timestamps with strftime('%Y-%m-%d %H:%M:%S+00:00')
+        values = series.to_numpy()
+        if np.isnat(values).any():
+            # strftime fails on NaT, so the whole column is encoded as timestamps instead
+            return None
+        text = self.formatSeconds(values)
+        if text is None:
+            return None
+        # "T" between the date and the time becomes a space, directly in the fixed width characters
+        text.view(np.uint32).reshape(-1, 19)[:, 10] = ord(" ")
+        return np.char.add(np.char.add('"', text), '+00:00"').astype(object)
+
+    def formatSeconds(self, values):
+        # "YYYY-MM-DDTHH:MM:SS" with a fixed width, so it only works for years with four digits
+        if len(values) > 0:
+            years = np.array([values.min(), values.max()]).astype("datetime64[Y]").astype(np.int64) + 1970
+            if years[0] < 1000 or years[1] > 9999:
+                return None
+        return np.datetime_as_string(values, unit="s").astype("U19")
+
+    def encodeTimestamps(self, series):
+        # timestamps with a timezone are written as isoformat() + ".000Z"
+        local = series.dt.tz_localize(None).to_numpy()
+        if np.isnat(local).any() or (local != local.astype("datetime64[s]")).any():
+            # isoformat adds fractions of a second
+            return None
+        text = self.formatSeconds(local)
+        if text is None:
+            return None
+        minutes = (local - series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy()).astype("timedelta64[m]").astype(np.int64)
+        offsets, inverse = np.unique(minutes, return_inverse=True)
+        suffixes = np.array([("-" if m < 0 else "+") + "%02d:%02d" % divmod(abs(int(m)), 60) + '.000Z"' for m in offsets], dtype="U16")
+        return np.char.add(np.char.add('"', text), suffixes[inverse]).astype(object)
+
+    def encodeDistinct(self, series):
+        # strings repeat a lot in results, every distinct value is only encoded once
+        try:
+            codes, uniques = pd.factorize(series, use_na_sentinel=True)
+        except TypeError:
+            # unhashable values like lists
+            return None
+        encoded = np.array([self._dumps(v) for v in np.asarray(uniques, dtype=object).tolist()] + ["null"], dtype=object)
+        return encoded[codes]
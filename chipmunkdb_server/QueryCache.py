@@ -0,0 +1,94 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# memory for cached query results over all collections, 0 disables the cache
+QUERY_CACHE_MB = float(os.getenv("QUERY_CACHE_MB", "256"))
+# a single result bigger than this part of the cache is not cached
+QUERY_CACHE_MAX_ENTRY_SHARE = float(os.getenv("QUERY_CACHE_MAX_ENTRY_SHARE", "0.25"))
+
+# whitespace outside of quoted literals and identifiers
+WHITESPACE = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+")
+# results of these functions change without a new version of the collection
+VOLATILE = re.compile(r"\b(now|random|uuid|gen_random_uuid|today|current_timestamp|current_date|current_time|"
+                      r"get_current_timestamp|transaction_timestamp|setseed)\b", re.IGNORECASE)
+
+
+class QueryCache():
+    """
+    LRU cache for query results. A key contains the version of the collection, so a write
+    makes the old entries unreachable and they age out. The cached frames are shared, callers must not change them.
+    """
+    def __init__(self, maxBytes=QUERY_CACHE_MB * 1024 * 1024):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._maxBytes = int(maxBytes)
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "uncacheable": 0}
+
+    def isEnabled(self):
+        return self._maxBytes > 0
+
+    def normalize(self, query):
+        query = WHITESPACE.sub(lambda m: m.group(1) if m.group(1) is not None else " ", query)
+        return query.strip().rstrip(";").strip()
+
+    def isCacheable(self, query):
+        return VOLATILE.search(query) is None
+
+    def getKey(self, collection, query, domains, version, kind="pandas"):
+        # kind tells results of the same query apart which are kept in another format
+        return (collection, self.normalize(query), tuple(domains or []), version, kind)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] = self._stats["misses"] + 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] = self._stats["hits"] + 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self._maxBytes * QUERY_CACHE_MAX_ENTRY_SHARE:
+            with self._lock:
+                self._stats["uncacheable"] = self._stats["uncacheable"] + 1
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes = self._bytes - old[1]
+            self._entries[key] = (value, size)
+            self._bytes = self._bytes + size
+            while self._bytes > self._maxBytes and len(self._entries) > 0:
+                oldKey, oldEntry = self._entries.popitem(last=False)
+                self._bytes = self._bytes - oldEntry[1]
+                self._stats["evictions"] = self._stats["evictions"] + 1
+        return True
+
+    def invalidate(self, collection):
+        # a reloaded collection starts counting its versions again, joined results contain it too
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == collection or (isinstance(k[0], tuple) and collection in k[0])]:
+                self._bytes = self._bytes - self._entries.pop(key)[1]
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._bytes = 0
+        return True
+
+    def getStats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["maxBytes"] = self._maxBytes
+        return stats
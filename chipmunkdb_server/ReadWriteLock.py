@@ -0,0 +1,157 @@
+import asyncio
+import threading
+
+
+class ReadWriteLock():
+    """
+    A writer preferring read/write lock, which can be used from threads (save thread)
+    and can be awaited from the event loop without blocking it.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waitingWriters = 0
+        self._asyncWaiters = []
+
+    def _canRead(self):
+        return not self._writer and self._waitingWriters == 0
+
+    def _canWrite(self):
+        return not self._writer and self._readers == 0
+
+    def _notify(self):
+        # has to be called while holding self._cond
+        self._cond.notify_all()
+        waiters = self._asyncWaiters
+        self._asyncWaiters = []
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                # the loop is already closed
+                pass
+
+    def _wake(self, future):
+        if not future.done():
+            future.set_result(True)
+
+    def acquireRead(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(self._canRead, timeout):
+                raise Exception("Error in blocking", "One of the scripts does block too long")
+            self._readers = self._readers + 1
+        return True
+
+    def releaseRead(self):
+        with self._cond:
+            self._readers = self._readers - 1
+            self._notify()
+        return True
+
+    def acquireWrite(self, timeout=None):
+        with self._cond:
+            self._waitingWriters = self._waitingWriters + 1
+            try:
+                if not self._cond.wait_for(self._canWrite, timeout):
+                    raise Exception("Error in blocking", "One of the scripts does block too long")
+                self._writer = True
+            finally:
+                self._waitingWriters = self._waitingWriters - 1
+                self._notify()
+        return True
+
+    def releaseWrite(self):
+        with self._cond:
+            self._writer = False
+            self._notify()
+        return True
+
+    async def acquireReadAsync(self, timeout=None):
+        return await self._acquireAsync(False, timeout)
+
+    async def acquireWriteAsync(self, timeout=None):
+        return await self._acquireAsync(True, timeout)
+
+    async def _acquireAsync(self, write, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        if write:
+            with self._cond:
+                self._waitingWriters = self._waitingWriters + 1
+        try:
+            while True:
+                with self._cond:
+                    if write and self._canWrite():
+                        self._writer = True
+                        return True
+                    if not write and self._canRead():
+                        self._readers = self._readers + 1
+                        return True
+                    future = loop.create_future()
+                    self._asyncWaiters.append((loop, future))
+
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("Error in blocking", "One of the scripts does block too long")
+                try:
+                    await asyncio.wait_for(future, remaining)
+                except asyncio.TimeoutError:
+                    raise Exception("Error in blocking", "One of the scripts does block too long")
+        finally:
+            if write:
+                with self._cond:
+                    self._waitingWriters = self._waitingWriters - 1
+                    self._notify()
+
+    def readLocked(self, timeout=None):
+        return LockContext(self, False, timeout)
+
+    def writeLocked(self, timeout=None):
+        return LockContext(self, True, timeout)
+
+    def getState(self):
+        with self._cond:
+            return {
+                "readers": self._readers,
+                "writer": self._writer,
+                "waitingWriters": self._waitingWriters,
+            }
+
+
+class LockContext():
+    """
+    usable as "with lock.readLocked():" in threads and as "async with lock.readLocked():" in handlers
+    """
+    def __init__(self, lock, write, timeout=None):
+        self._lock = lock
+        self._write = write
+        self._timeout = timeout
+
+    def __enter__(self):
+        if self._write:
+            self._lock.acquireWrite(self._timeout)
+        else:
+            self._lock.acquireRead(self._timeout)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    async def __aenter__(self):
+        if self._write:
+            await self._lock.acquireWriteAsync(self._timeout)
+        else:
+            await self._lock.acquireReadAsync(self._timeout)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+    def release(self):
+        if self._write:
+            self._lock.releaseWrite()
+        else:
+            self._lock.releaseRead()
@@ -17,9 +17,20 @@ import pyarrow as pa
 import simplejson as json
 
 from chipmunkdb_server.helper import printTiming
+from chipmunkdb_server.JsonEncoding import JsonEncoding
 
 load_dotenv()
 HTTP_PORT = os.getenv("HTTP_PORT")
+# rows which are encoded and written at once by a streamed query response
+STREAM_BATCH_ROWS = int(os.getenv("STREAM_BATCH_ROWS", "10000"))
+# rows per record batch of an arrow stream response
+ARROW_BATCH_ROWS = int(os.getenv("ARROW_BATCH_ROWS", "65536"))
+# rows per parquet row group of a rawStream download, every row group is sent as soon as it is encoded
+RAWSTREAM_ROW_GROUP_ROWS = int(os.getenv("RAWSTREAM_ROW_GROUP_ROWS", "131072"))
+# parquet compression of a rawStream download (zstd, snappy, gzip, none), it is not compressed again by http
+RAWSTREAM_COMPRESSION = os.getenv("RAWSTREAM_COMPRESSION", "zstd")
+
+ARROW_STREAM_TYPE = "application/vnd.apache.arrow.stream"
 registrar = Registrar()
 
 def getDatabase() -> DatabaseManager:
@@ -46,20 +57,249 @@ class ComplexEncoder(json.JSONEncoder):
 
 
 
+def dumpJson(data):
+    return json.dumps(data, cls=ComplexEncoder, ignore_nan=True, allow_nan=True)
+
+
+jsonEncoding = JsonEncoding(dumpJson)
+
+
 def json_response(data, status=200):
     start = printTiming()
     try:
-        data_json = json.dumps(data, cls=ComplexEncoder, ignore_nan=True, allow_nan=True)
+        data_json = dumpJson(data)
     except Exception as e:
         data_json = json.dumps({"error": str(e)})
         # print stacktrace
         traceback.print_exc(file=sys.stderr)
         status = 500
     printTiming(start, "Json response dumping took: ", _name="RestAioHttpServer.py")
-    res = web.Response(text=data_json, content_type='application/json', status=status)
+    return text_response(data_json, status=status)
+
+
+def text_response(data_json, status=200):
+    res = web.Response(text=data_json, content_type='application/json', status=status,
+                       zlib_executor=getDatabase().pools.getExecutor())
     res.enable_compression(force=True)
     return res
 
+
+def getQueryFrames(frames, merge_mode):
+    if merge_mode:
+        summary_df = pd.concat(frames, axis=1)
+        summary_df = summary_df.loc[:, ~summary_df.columns.duplicated()]
+
+        # special case lets delete all "datetime" are Nat
+        summary_df = summary_df.dropna(axis=0, how="all", subset=["datetime"])
+        summary_df = summary_df.dropna(axis=0, how="all", subset=[n for n in summary_df if n != 'datetime' ])
+        return [summary_df]
+    return [df.loc[:, ~df.columns.duplicated()] for df in frames]
+
+
+def getResultShape(options):
+    # "split" returns {"columns": [...], "data": [[...], ...]}, "columnar" {"column": [values]}, otherwise the records
+    for shape in ["split", "columnar"]:
+        if shape in options:
+            return shape
+    return "records"
+
+
+def encodeQueryResult(frames, merge_mode, columns=None, shape="records"):
+    # runs in a worker (thread or process), the frames are encoded column by column into one body
+    results = [jsonEncoding.encodeShape(df, shape) for df in getQueryFrames(frames, merge_mode)]
+    body = '{"result": ' + (results[0] if len(results) == 1 else "[" + ", ".join(results) + "]")
+    if columns is not None:
+        body = body + ', "columns": ' + dumpJson(columns)
+    return body + "}"
+
+
+async def query_response(frames, merge_mode, columns=None, shape="records"):
+    start = printTiming()
+    try:
+        data_json = await getDatabase().pools.runCpu(encodeQueryResult, frames, merge_mode, columns, shape)
+    except Exception as e:
+        return json_response({"error": str(e)}, 400)
+    printTiming(start, "Encoding the query result took: ", _name="RestAioHttpServer.py")
+    return text_response(data_json, status=200)
+
+
+def wantsArrow(request):
+    return ARROW_STREAM_TYPE in request.headers.get("Accept", "") or request.rel_url.query.get("format", "json") == "arrow"
+
+
+async def send_query_result(request, frames, merge_mode, columns=None, shape="records"):
+    # "format=ndjson" or "stream=true" write the rows in batches instead of one json body, ndjson always as records
+    if wantsArrow(request):
+        return await arrow_query_response(request, frames, merge_mode)
+    output = request.rel_url.query.get("format", "json")
+    if output == "ndjson" or request.rel_url.query.get("stream", "false").lower() == "true":
+        return await stream_query_response(request, frames, merge_mode, columns=columns, ndjson=output == "ndjson",
+                                           shape="records" if output == "ndjson" else shape)
+    return await query_response(frames, merge_mode, columns=columns, shape=shape)
+
+
+def getArrowTables(frames, merge_mode):
+    # internal and joined queries still return dataframes
+    if merge_mode:
+        frames = getQueryFrames([f.to_pandas() if isinstance(f, pa.Table) else f for f in frames], merge_mode)
+    return [f if isinstance(f, pa.Table) else pa.Table.from_pandas(f, preserve_index=False) for f in frames]
+
+
+class ArrowStreamBuffer():
+    """
+    sink of an arrow stream or parquet writer, the written bytes are taken out after every batch.
+    The position keeps counting, parquet writes the offsets of its row groups into the footer
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position = self._position + len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def startArrowStream(buffer, table):
+    writer = pa.ipc.new_stream(buffer, table.schema)
+    return writer, table.to_batches(max_chunksize=ARROW_BATCH_ROWS)
+
+
+def writeArrowBatch(buffer, writer, batch=None):
+    if batch is None:
+        writer.close()
+    else:
+        writer.write_batch(batch)
+    return buffer.take()
+
+
+async def arrow_query_response(request, frames, merge_mode):
+    """
+    writes the results as arrow ipc streams, one after another when there are several, batch by batch
+    """
+    try:
+        tables = await getDatabase().pools.run(getArrowTables, frames, merge_mode)
+    except Exception as e:
+        return json_response({"error": str(e)}, 400)
+
+    response = web.StreamResponse(
+        status=200,
+        reason='OK',
+        headers={'Content-Type': ARROW_STREAM_TYPE},
+    )
+    await response.prepare(request)
+
+    start = printTiming()
+    try:
+        for table in tables:
+            buffer = ArrowStreamBuffer()
+            writer, batches = await getDatabase().pools.run(startArrowStream, buffer, table)
+            for batch in batches + [None]:
+                await response.write(await getDatabase().pools.run(writeArrowBatch, buffer, writer, batch))
+    except Exception as e:
+        print("Error while streaming the arrow result", traceback.format_exc())
+        return response
+    await response.write_eof()
+    printTiming(start, "Streaming the arrow result took: ", _name="RestAioHttpServer.py")
+    return response
+
+
+def getStreamLayout(df, shape):
+    # what is written before and after the batches of a result, and how many rows or columns are in one batch
+    if shape == "columnar":
+        # the batches are columns, with about as many values as a batch of rows
+        return "{", "}", df.shape[1], max(1, STREAM_BATCH_ROWS // max(1, df.shape[0]))
+    if shape == "split":
+        return '{"columns": ' + dumpJson([str(c) for c in df.columns]) + ', "data": [', "]}", df.shape[0], STREAM_BATCH_ROWS
+    return "[", "]", df.shape[0], STREAM_BATCH_ROWS
+
+
+def encodeStreamBatch(df, lo, hi, ndjson, shape="records"):
+    if shape == "columnar":
+        return jsonEncoding.encodeColumnar(df.iloc[:, lo:hi])[1:-1]
+    rows = jsonEncoding.encodeArrays(df.iloc[lo:hi]) if shape == "split" else jsonEncoding.encodeRows(df.iloc[lo:hi])
+    if ndjson:
+        return "".join([row + "\n" for row in rows])
+    # the rows without the brackets around them, the caller writes them around all batches
+    return ", ".join(rows)
+
+
+async def stream_query_response(request, frames, merge_mode, columns=None, ndjson=False, shape="records"):
+    """
+    writes the result in batches of rows, so the whole body is never in memory and the first rows are sent early.
+    ndjson writes one row per line, otherwise the body is the same json as the one of query_response
+    """
+    try:
+        frames = await getDatabase().pools.run(getQueryFrames, frames, merge_mode)
+    except Exception as e:
+        return json_response({"error": str(e)}, 400)
+
+    response = web.StreamResponse(
+        status=200,
+        reason='OK',
+        headers={'Content-Type': 'application/x-ndjson' if ndjson else 'application/json'},
+    )
+    response.enable_compression(force=True)
+    await response.prepare(request)
+
+    start = printTiming()
+    try:
+        if not ndjson:
+            # a single result is not wrapped into a list, like in encodeQueryResult
+            await response.write(b'{"result": ' + (b'[' if len(frames) != 1 else b''))
+        for index, df in enumerate(frames):
+            head, tail, count, step = getStreamLayout(df, shape)
+            if not ndjson:
+                await response.write(((", " if index > 0 else "") + head).encode("utf-8"))
+            written = False
+            for lo in range(0, count, step):
+                body = await getDatabase().pools.run(encodeStreamBatch, df, lo, lo + step, ndjson, shape)
+                if not ndjson and written and body != "":
+                    body = ", " + body
+                written = written or body != ""
+                await response.write(body.encode("utf-8"))
+            if not ndjson:
+                await response.write(tail.encode("utf-8"))
+        if not ndjson:
+            if len(frames) != 1:
+                await response.write(b']')
+            if columns is not None:
+                await response.write(b', "columns": ' + dumpJson(columns).encode("utf-8"))
+            await response.write(b'}')
+    except Exception as e:
+        # the status is already sent, the client sees a body which is not complete
+        print("Error while streaming the query result", traceback.format_exc())
+        return response
+    await response.write_eof()
+    printTiming(start, "Streaming the query result took: ", _name="RestAioHttpServer.py")
+    return response
+
+
+@routes.get('/health')
+async def getHealth(request):
+    # answered directly on the loop, it never waits for the workers
+    return web.json_response({"status": "ok"})
+
+
+@routes.get('/stats')
+async def getStats(request):
+    return web.json_response(getDatabase().getStats())
+
 @routes.get('/documents')
 async def getDocuments(request):
     try:
@@ -94,6 +334,17 @@ async def getDocument(request):
         return json_response({"error": str(e)})
     return json_response({"data": doc["data"], "type": doc["type"], "document": document, "directory": directory})
 
+@routes.post('/directory/{directory}/{document}/retention')
+async def setDocumentRetention(request):
+    try:
+        directory = request.match_info.get("directory")
+        document = request.match_info.get("document")
+        data_json = json.loads(await request.content.read())
+        await getDatabase().setRetention("document", document, data_json.get("retention"), directory=directory)
+    except Exception as e:
+        return json_response({"error": str(e)}, status=400)
+    return json_response({"success": True}, status=200)
+
 @routes.get('/directory/{directory}')
 async def getDirectory(request):
     try:
@@ -181,13 +432,30 @@ async def dropCollection(request):
     return json_response({"success": True}, status=200)
 
 
+@routes.post("/collection/{collection}/retention")
+async def setCollectionRetention(request):
+    try:
+        collection = request.match_info.get("collection")
+        data_json = json.loads(await request.content.read())
+        await getDatabase().setRetention("collection", collection, data_json.get("retention"))
+    except Exception as e:
+        return json_response({"error": str(e)}, status=400)
+
+    return json_response({"success": True}, status=200)
+
+
+@routes.post("/retention/run")
+async def runRetention(request):
+    # runs the retention job now instead of waiting for its interval
+    return json_response(await getDatabase().retentionJob.run(), status=200)
+
+
 @routes.post("/collection/{collection}/insertData")
 async def addRawJsonToCollection(request):
 
     try:
         collection = request.match_info.get("collection")
         data_raw = await request.content.read()
-        data = json.loads(data_raw)["data"]
 
         headerData = {
             "mode": "append"
@@ -196,10 +464,7 @@ async def addRawJsonToCollection(request):
         if headerDataInfo is not None:
             headerData = json.loads(headerDataInfo)
 
-        df = pd.DataFrame(data)
-        df["datetime"] = pd.to_datetime(df["datetime"])
-        df = df.set_index(['datetime'])
-        df.index = df.index.round("s")
+        df = await getDatabase().pools.run(readJsonUpload, data_raw)
 
         await getDatabase().blockUntilOperationsFinished(collection)
         await getDatabase().addDataframeToDatabase(df, collection, headerData)
@@ -212,6 +477,37 @@ async def addRawJsonToCollection(request):
 
 buffered_dataframes={}
 
+
+def readJsonUpload(data_raw):
+    data = json.loads(data_raw)["data"]
+    df = pd.DataFrame(data)
+    df["datetime"] = pd.to_datetime(df["datetime"])
+    df = df.set_index(['datetime'])
+    df.index = df.index.round("s")
+    return df
+
+
+def readParquetUpload(file_Data):
+    file_Data = file_Data.split(b'\r\n\r\n')[1].split(b'\r\n--')[0]
+    # zlib uncompress content
+    file_Data = gzip.decompress(file_Data)
+    with io.BytesIO(file_Data) as pq_file:
+        return pd.read_parquet(pq_file)
+
+
+def startParquetStream(buffer, table):
+    writer = pq.ParquetWriter(buffer, table.schema, compression=RAWSTREAM_COMPRESSION)
+    return writer, list(range(0, table.num_rows, RAWSTREAM_ROW_GROUP_ROWS))
+
+
+def writeParquetRowGroup(buffer, writer, table, lo=None):
+    # the footer is written by the close, after the last row group
+    if lo is None:
+        writer.close()
+    else:
+        writer.write_table(table.slice(lo, RAWSTREAM_ROW_GROUP_ROWS), row_group_size=RAWSTREAM_ROW_GROUP_ROWS)
+    return buffer.take()
+
 @routes.post("/collection/{collection}/save")
 async def saveCollection(request):
     collection = request.match_info.get("collection")
@@ -227,23 +523,17 @@ async def addColumnsToDatabase(request):
 
         collection = request.match_info.get("collection")
         file_Data = await request.content.read()
-        # zlib uncompress content
-        file_Data = file_Data.split(b'\r\n\r\n')[1].split(b'\r\n--')[0]
 
         headerDataInfo = request.headers.get("x-data")
         headerData = json.loads(headerDataInfo)
 
-        file_Data = gzip.decompress(file_Data)
-
-        pq_file = io.BytesIO(file_Data)
-        df = pd.read_parquet(pq_file)
+        df = await getDatabase().pools.run(readParquetUpload, file_Data)
 
 
         if "session_id" in headerData:
             if "end" in headerData and headerData["end"] == True:
                 if headerData["session_id"]  in buffered_dataframes:
-                    for subdf in buffered_dataframes[headerData["session_id"]]:
-                        df = pd.concat([df, subdf])
+                    df = await getDatabase().pools.run(pd.concat, [df] + buffered_dataframes[headerData["session_id"]])
             else:
                 if headerData["session_id"] not in buffered_dataframes:
                     buffered_dataframes[headerData["session_id"]] = []
@@ -254,7 +544,6 @@ async def addColumnsToDatabase(request):
         await getDatabase().blockUntilOperationsFinished(collection)
         await getDatabase().addDataframeToDatabase(df, collection, headerData)
 
-        pq_file.close()
         df = None
 
     except Exception as e:
@@ -295,54 +584,18 @@ async def queryData(request):
 
         targetTable = request.match_info.get("collection")
 
-        ret_data = []
-        index = 0
         table = await (getDatabase()).getOrCreateDatabaseObject(targetTable, "table", create_new=False)
-        for q in query:
-            q = getDatabase().replaceSchemas(q)
-            df = table.query(q, domains[index])
-
-            if merge_mode:
-                ret_data.append(df)
-            else:
-                df = df.loc[:, ~df.columns.duplicated()]
-                datetimec_columns = df.select_dtypes(include=['datetime64']).columns.tolist()
-                for c in datetimec_columns:
-                    try:
-                        df[c] = df[c].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S+00:00'))
-                    except Exception as ie:
-                        pass
-                ret_data.append(df.to_dict("records"))
-            index = index + 1
-
-        if merge_mode:
-            flatList = []
-            for d in ret_data:
-                for r in d:
-                    flatList.append(r)
-
-            ret_data = []
-            summary_df = pd.concat(flatList, axis=1)
-            summary_df = summary_df.loc[:, ~summary_df.columns.duplicated()]
-            datetimec_columns = summary_df.select_dtypes(include=['datetime64']).columns.tolist()
-
-            summary_df = summary_df.dropna(axis=0, how="all", subset=["datetime"])
-            for c in datetimec_columns:
-                try:
-                    summary_df[c] = summary_df[c].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S+00:00'))
-                except Exception as ie:
-                    pass
-            summary_df = summary_df.dropna(axis=0, how="all", subset=[n for n in summary_df if n != 'datetime' ])
-            # special case lets delete all "datetime" are Nat
-            ret_data.append(summary_df.to_dict("records"))
-
-        if len(ret_data) == 1:
-            ret_data = ret_data[0]
+        # every statement gets its own cursor, so they run side by side in the worker pool
+        arrow = wantsArrow(request)
+        results = await getDatabase().pools.gather([getDatabase().pools.run(table.query, getDatabase().replaceSchemas(q), domains[index],
+                                                                            arrow=arrow)
+                                                    for index, q in enumerate(query)])
+        frames = [df for df, columns in results]
 
     except Exception as e:
         return json_response({"error": str(e)}, 400)
 
-    return json_response({"result": ret_data}, status=200)
+    return await send_query_result(request, frames, merge_mode, shape=getResultShape(options))
 
 
 
@@ -379,66 +632,24 @@ async def queryData(request):
 
 
 
-        ret_data = []
-        index = 0
-        for q in query:
+        async def runStatement(q, d):
             q = getDatabase().replaceSchemas(q)
-
             if getDatabase().isInternalQuery(q):
-                data = [await getDatabase().internalQuery(q, options=options, domains=domains[index])]
-
-            else:
-                data = await getDatabase().query(q, options=options, domains=domains[index])
-
-            if merge_mode:
-                ret_data.append(data)
-            else:
-                for df, columns in data:
-                    bstart = printTiming(None)
-                    df = df.loc[:, ~df.columns.duplicated()]
-                    datetimec_columns = df.select_dtypes(include=['datetime64']).columns.tolist()
-                    for c in datetimec_columns:
-                        try:
-                            df[c] = df[c].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S+00:00'))
-                        except Exception as ie:
-                            pass
-                    bstart = printTiming(bstart, "Query chaning datetime formats took: ", _name="RestAioHttpServer.py")
-                    ret_data.append(df.to_dict("records"))
-                    printTiming(bstart, "Converting to dict took: ", _name="RestAioHttpServer")
-
-            index = index + 1
+                return [await getDatabase().internalQuery(q, options=options, domains=d)]
+            return await getDatabase().query(q, options=options, domains=d, arrow=arrow)
 
-        if merge_mode:
-            mstart = printTiming(None)
-            flatList = []
-            for d in ret_data:
-                for r in d:
-                    flatList.append(r)
-
-            ret_data = []
-            summary_df = pd.concat(flatList, axis=1)
-            summary_df = summary_df.loc[:, ~summary_df.columns.duplicated()]
-            datetimec_columns = summary_df.select_dtypes(include=['datetime64']).columns.tolist()
-
-            summary_df = summary_df.dropna(axis=0, how="all", subset=["datetime"])
-            for c in datetimec_columns:
-                try:
-                    summary_df[c] = summary_df[c].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S+00:00'))
-                except Exception as ie:
-                    pass
-            summary_df = summary_df.dropna(axis=0, how="all", subset=[n for n in summary_df if n != 'datetime' ])
-            # special case lets delete all "datetime" are Nat
-            ret_data.append(summary_df.to_dict("records"))
-            printTiming(mstart, "Merging dataframes took: ", _name="RestAioHttpServer.py")
-
-        if len(ret_data) == 1:
-            ret_data = ret_data[0]
+        # independent statements run at the same time, their results keep the order of the request
+        arrow = wantsArrow(request)
+        frames = []
+        for data in await getDatabase().pools.gather([runStatement(q, domains[index]) for index, q in enumerate(query)]):
+            for df, columns in data:
+                frames.append(df)
 
     except Exception as e:
         return json_response({"error": str(e)}, 400)
 
 
-    d = json_response({"result": ret_data, "columns": columns}, status=200)
+    d = await send_query_result(request, frames, merge_mode, columns=columns, shape=getResultShape(options))
     printTiming(full_query, "Full query took: ", _name="RestAioHttpServer.py")
     return d
 
@@ -581,6 +792,18 @@ async def saveStorageKeyValue(request):
     return json_response({"error": "saving_error", "message": error_message}, status=400)
 
 
+@routes.post("/storage/{storage}/retention")
+async def setStorageRetention(request):
+    try:
+        storage = request.match_info.get("storage")
+        data = json.loads(await request.content.read())
+        await getDatabase().setRetention("storage", storage, data.get("retention"))
+    except Exception as e:
+        return json_response({"error": "retention_error", "message": str(e)}, status=400)
+
+    return json_response({"status": "success"}, status=200)
+
+
 @routes.get("/collection/{collection}/rawStream")
 async def downloadLargeCollection(request):
     try:
@@ -591,31 +814,33 @@ async def downloadLargeCollection(request):
         options = headerData["options"] if "options" in headerData else {"mergeOptions": "merge"}
         columns = headerData["columns"] if "columns" in headerData else []
         domains = headerData["domain"] if "domain" in headerData else None
+        start = headerData["start"] if "start" in headerData else None
+        end = headerData["end"] if "end" in headerData else None
         if domains is not None:
             domains = domains.split(",")
         else:
             domains = []
 
-        await getDatabase().blockUntilOperationsFinished(collection)
-
-        df = await getDatabase().getDataFrameFromCollection(collection, columns, domains=domains)
-
-        if len(additionalCollections) > 0:
-            for addc in additionalCollections:
-                adf = await getDatabase().getDataFrameFromCollection(addc, [])
-
-                if "mergeOptions" in options:
-                    mergeOptions = options["mergeOptions"]
-                    if "merge" in mergeOptions:
-                        df = df.merge(adf, left_index=True, right_index=True, how='outer')
+        # reads the published version of the collection, so there is no need to wait for running writes
+        if len(additionalCollections) == 0 and len(domains) == 0 and start is None and end is None:
+            table = await getDatabase().getArrowFromCollection(collection, columns)
+        else:
+            df = await getDatabase().getDataFrameFromCollection(collection, columns, domains=domains, start=start, end=end)
 
+            if len(additionalCollections) > 0:
+                for addc in additionalCollections:
+                    adf = await getDatabase().getDataFrameFromCollection(addc, [])
 
+                    if "mergeOptions" in options:
+                        mergeOptions = options["mergeOptions"]
+                        if "merge" in mergeOptions:
+                            df = await getDatabase().pools.run(df.merge, adf, left_index=True, right_index=True, how='outer')
 
+            table = await getDatabase().pools.run(pa.Table.from_pandas, df)
+            df = None
 
-        fh = io.BytesIO()
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, fh)
-        fh.seek(0, 0)
+        buffer = ArrowStreamBuffer()
+        writer, groups = await getDatabase().pools.run(startParquetStream, buffer, table)
 
         response = web.StreamResponse(
             status=200,
@@ -623,17 +848,21 @@ async def downloadLargeCollection(request):
             headers={'Content-Type': 'application/octet-stream'},
 
         )
-        response.enable_compression(force=True)
-        await response.prepare(request)
-        await response.write(fh.read())
-        table = None
-        fh.close()
-
-        return response
-
     except Exception as e:
         print(traceback.format_exc())
         return json_response({"error": traceback.format_exc()}, status=400)
-    pass
 
-    return json_response({"error": "loading_error"}, status=400)
+    # one parquet file, written row group by row group, so only one encoded row group is in memory at a time
+    await response.prepare(request)
+    start = printTiming()
+    try:
+        for lo in groups + [None]:
+            await response.write(await getDatabase().pools.run(writeParquetRowGroup, buffer, writer, table, lo))
+    except Exception as e:
+        # the status is already sent, the client sees a file which is not complete
+        print("Error while streaming the collection", traceback.format_exc())
+        return response
+    table = None
+    await response.write_eof()
+    printTiming(start, "Streaming the collection took: ", _name="RestAioHttpServer.py")
+    return response
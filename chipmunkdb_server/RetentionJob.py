@@ -0,0 +1,90 @@
+import os
+import time
+
+import pandas as pd
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# seconds between two runs of the retention job
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+
+
+class RetentionJob():
+    """
+    Removes what is older than the retention of its collection, storage or document list.
+    Only the expired rows, entries and items are deleted, nothing is loaded or written again completely.
+    """
+    def __init__(self, dbManager):
+        self._dbManager = dbManager
+        self._running = False
+        self._lastRun = time.time()
+        self._stats = {"runs": 0, "rows": 0, "entries": 0, "items": 0, "failed": 0, "lastRun": None, "duration": 0.0}
+
+    @staticmethod
+    def parseRetention(retention):
+        # "90 days", "keep 90 days" or "12h", empty disables the retention, raises on anything else
+        if retention is None:
+            return None
+        text = str(retention).strip().lower()
+        if text.startswith("keep"):
+            text = text[len("keep"):].strip()
+        if text in ["", "none", "forever"]:
+            return None
+        duration = pd.Timedelta(text)
+        if duration <= pd.Timedelta(0):
+            raise ValueError("retention has to be positive")
+        return duration
+
+    @staticmethod
+    def getCutoff(retention):
+        duration = RetentionJob.parseRetention(retention)
+        if duration is None:
+            return None
+        return pd.Timestamp.utcnow().tz_localize(None) - duration
+
+    def isDue(self):
+        return not self._running and time.time() - self._lastRun >= RETENTION_INTERVAL
+
+    async def run(self):
+        if self._running:
+            return self.getStats()
+        self._running = True
+        start = time.time()
+        manager = self._dbManager
+        try:
+            for row in await manager.getRetentions("collections"):
+                await self.applyRow("rows", row, manager.applyCollectionRetention, "name")
+            for row in await manager.getRetentions("storages"):
+                await self.applyRow("entries", row, manager.applyStorageRetention, "document")
+            for row in await manager.getRetentions("documents"):
+                await self.applyRow("items", row, manager.applyDocumentRetention, "directory", "document")
+        finally:
+            self._running = False
+            self._lastRun = time.time()
+            self._stats["runs"] = self._stats["runs"] + 1
+            self._stats["lastRun"] = pd.Timestamp.utcnow().isoformat()
+            self._stats["duration"] = round(time.time() - start, 3)
+        return self.getStats()
+
+    async def applyRow(self, kind, row, apply, *keys):
+        # a retention which can not be read only fails its own row
+        try:
+            cutoff = self.getCutoff(row["retention"])
+        except Exception as e:
+            print("Error on reading the retention", row["retention"], str(e))
+            self.count(kind, None)
+            return
+        self.count(kind, await apply(*[row[key] for key in keys], cutoff))
+
+    def count(self, kind, removed):
+        if removed is None:
+            self._stats["failed"] = self._stats["failed"] + 1
+        else:
+            self._stats[kind] = self._stats[kind] + removed
+
+    def getStats(self):
+        stats = dict(self._stats)
+        stats["running"] = self._running
+        stats["interval"] = RETENTION_INTERVAL
+        return stats
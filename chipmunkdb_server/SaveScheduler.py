@@ -0,0 +1,200 @@
+import asyncio
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# number of threads which write checkpoints, independent of the number of collections
+SAVE_WORKERS = int(os.getenv("SAVE_WORKERS", "2"))
+# seconds a dirty collection can wait before its age outweighs a bigger one
+SAVE_AGE_WEIGHT = float(os.getenv("SAVE_AGE_WEIGHT", "30"))
+# when checkpoints take longer than this on average, the disk is saturated and only one worker writes
+SAVE_SLOW_SECONDS = float(os.getenv("SAVE_SLOW_SECONDS", "5"))
+# writers wait while more than this many megabytes are dirty and not yet checkpointed
+SAVE_MAX_DIRTY_MB = float(os.getenv("SAVE_MAX_DIRTY_MB", "1024"))
+# the longest time a writer waits for the checkpoints to catch up
+SAVE_BACKPRESSURE_TIMEOUT = float(os.getenv("SAVE_BACKPRESSURE_TIMEOUT", "30"))
+
+
+class SaveRequest():
+    def __init__(self, target, update, due):
+        self.target = target
+        self.update = update
+        self.due = due
+        self.requested = time.time()
+        self.running = False
+        self.cancelled = False
+        self.again = None
+
+
+class SaveScheduler():
+    """
+    Owns a fixed pool of checkpoint workers. Every collection has at most one queued request,
+    repeated requests are coalesced into it, and the most valuable checkpoint (dirty bytes and age) runs first.
+    """
+    def __init__(self, workers=SAVE_WORKERS):
+        self._cond = threading.Condition()
+        self._requests = {}
+        self._workers = max(1, workers)
+        self._threads = []
+        self._active = 0
+        self._stopped = False
+        self._avgDuration = 0.0
+        self._stats = {"requested": 0, "coalesced": 0, "saved": 0, "failed": 0}
+
+    def start(self):
+        with self._cond:
+            if len(self._threads) > 0:
+                return True
+            self._stopped = False
+            for i in range(self._workers):
+                thread = threading.Thread(target=self.work, name="chipmunkdb-save-"+str(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return True
+
+    def request(self, target, update=False, delay=0):
+        self.start()
+        due = time.time() + max(0, delay)
+        with self._cond:
+            self._stats["requested"] = self._stats["requested"] + 1
+            key = id(target)
+            current = self._requests.get(key)
+            if current is None:
+                self._requests[key] = SaveRequest(target, update, due)
+            elif current.running and current.again is None:
+                # the running checkpoint might miss the latest changes, so there has to be another one
+                current.again = SaveRequest(target, update, due)
+            else:
+                queued = current.again if current.running else current
+                queued.due = min(queued.due, due)
+                queued.update = queued.update or update
+                self._stats["coalesced"] = self._stats["coalesced"] + 1
+            self._cond.notify()
+        return True
+
+    def cancel(self, target):
+        with self._cond:
+            current = self._requests.get(id(target))
+            if current is not None:
+                if current.running:
+                    current.again = None
+                    current.cancelled = True
+                else:
+                    del self._requests[id(target)]
+        return True
+
+    def getPriority(self, request, now):
+        try:
+            dirtyBytes = request.target.getDirtyBytes()
+        except Exception:
+            dirtyBytes = 0
+        return (dirtyBytes + 1) * (1 + (now - request.requested) / SAVE_AGE_WEIGHT)
+
+    def isSaturated(self):
+        return self._avgDuration > SAVE_SLOW_SECONDS
+
+    def getMaxActive(self):
+        return 1 if self.isSaturated() else self._workers
+
+    def nextRequest(self):
+        # has to be called while holding self._cond
+        now = time.time()
+        # with too much dirty data the throttle is ignored, the writers are waiting for these checkpoints
+        backlogged = self.isBacklogged()
+        due = [r for r in self._requests.values() if not r.running and (r.due <= now or backlogged)]
+        if len(due) == 0 or self._active >= self.getMaxActive():
+            waiting = [r.due for r in self._requests.values() if not r.running]
+            return None, (min(waiting) - now if len(waiting) > 0 and self._active < self.getMaxActive() else None)
+        return max(due, key=lambda r: self.getPriority(r, now)), None
+
+    def work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    request, timeout = self.nextRequest()
+                    if request is not None:
+                        break
+                    self._cond.wait(timeout)
+                request.running = True
+                self._active = self._active + 1
+
+            start = time.time()
+            failed = False
+            try:
+                request.target.checkpoint(request.update)
+            except Exception as e:
+                failed = True
+                print("Error in checkpoint", str(e))
+            duration = time.time() - start
+
+            with self._cond:
+                self._active = self._active - 1
+                self._avgDuration = self._avgDuration * 0.8 + duration * 0.2
+                self._stats["failed" if failed else "saved"] = self._stats["failed" if failed else "saved"] + 1
+                key = id(request.target)
+                if failed and request.again is None and not request.cancelled:
+                    # try again later, the dirty state was kept by the target
+                    request.again = SaveRequest(request.target, request.update, time.time() + SAVE_AGE_WEIGHT)
+                if request.again is not None:
+                    self._requests[key] = request.again
+                else:
+                    del self._requests[key]
+                self._cond.notify_all()
+
+    def getDirtyBytes(self):
+        with self._cond:
+            targets = [r.target for r in self._requests.values()]
+        dirtyBytes = 0
+        for target in targets:
+            try:
+                dirtyBytes = dirtyBytes + target.getDirtyBytes()
+            except Exception:
+                pass
+        return dirtyBytes
+
+    def isBacklogged(self):
+        return self.getDirtyBytes() > SAVE_MAX_DIRTY_MB * 1024 * 1024
+
+    async def waitForCapacity(self, timeout=SAVE_BACKPRESSURE_TIMEOUT):
+        # backpressure for writers, they wait until the checkpoints caught up with the dirty data
+        start = time.time()
+        while self.isBacklogged() and time.time() - start < timeout:
+            await asyncio.sleep(0.1)
+        return True
+
+    def flush(self, timeout=None):
+        # runs everything which is queued right now, without waiting for the throttle
+        with self._cond:
+            for request in self._requests.values():
+                request.due = 0
+                if request.again is not None:
+                    request.again.due = 0
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: len(self._requests) == 0 or len(self._threads) == 0, timeout)
+        return True
+
+    def shutdown(self, flush=True, timeout=60):
+        if flush and len(self._threads) > 0:
+            self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            self._threads = []
+            self._cond.notify_all()
+        return True
+
+    def getStats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["workers"] = self._workers
+            stats["active"] = self._active
+            stats["queued"] = len([r for r in self._requests.values() if not r.running])
+            stats["averageDuration"] = round(self._avgDuration, 3)
+            stats["saturated"] = self.isSaturated()
+        stats["dirtyBytes"] = self.getDirtyBytes()
+        return stats
@@ -0,0 +1,66 @@
+import threading
+
+import duckdb
+
+
+class SharedCatalog():
+    """
+    One duckdb database for statements over several collections, like JOINs and UNIONs.
+    Every query gets its own cursor on which the published versions of its collections are registered
+    under their own names, so a write during the query is never seen.
+    """
+    def __init__(self, queryCache):
+        self._db = duckdb.connect(":memory:", read_only=False)
+        self._lock = threading.Lock()
+        self._queryCache = queryCache
+        self._stats = {"queries": 0, "registered": 0}
+
+    def query(self, statement, collections, domains=[]):
+        # collections maps every table name of the statement to its TableDatabase
+        names = sorted(collections.keys())
+        cache = self._queryCache
+        cacheKey = None
+        if cache.isEnabled() and cache.isCacheable(statement):
+            cacheKey = cache.getKey(tuple(names), statement, domains, tuple([collections[n].getVersion() for n in names]))
+            cached = cache.get(cacheKey)
+            if cached is not None:
+                return cached
+
+        with self._lock:
+            # creating cursors on a shared connection is not thread safe
+            cursor = self._db.cursor()
+            self._stats["queries"] = self._stats["queries"] + 1
+            self._stats["registered"] = self._stats["registered"] + len(names)
+        try:
+            for name in names:
+                collections[name].registerSnapshot(cursor, collections[name].getCatalogSnapshot(), name)
+            df = cursor.execute(statement.replace("`", "'")).df()
+        except Exception as e:
+            print(str(e))
+            raise(Exception("query error", str(e)))
+        finally:
+            cursor.close()
+
+        if domains is not None and len(domains) > 0:
+            df = collections[names[0]].filter_df_by_prefix(df, domains, adding_datetime="datetime" in df.columns)
+
+        columns = self.getColumnsDescription(df)
+        if cacheKey is not None:
+            cache.put(cacheKey, (df, columns), int(df.memory_usage(deep=True, index=True).sum()))
+        return df, columns
+
+    def getColumnsDescription(self, df):
+        columns = []
+        for col in df.columns:
+            columns.append({
+                "Field": col,
+                "Type": str(df[col].dtype),
+                "Null": "YES" if df[col].isnull().any() else "NO",
+                "Key": "",
+                "Default": "",
+            })
+        return columns
+
+    def getStats(self):
+        with self._lock:
+            return dict(self._stats)
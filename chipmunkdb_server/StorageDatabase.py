@@ -1,6 +1,3 @@
-import threading
-
-
 from datetime import datetime
 
 import numpy as np
@@ -20,7 +17,7 @@ class StorageDatabase():
         self._rows = 0
         self._keys = []
         self._dbPath = "db"
-        self.saveTimer = None
+        self._dirtyKeys = 0
         self._documentPath = self._dbPath+'/storage/'+self._document+".store"
         if not os.path.isdir(self._dbPath+"/storage"):
             os.mkdir(self._dbPath+"/storage")
@@ -52,7 +49,8 @@ class StorageDatabase():
 
     def setKey(self, key, value, dt=None, tags=None):
         if dt is None:
-            dt = datetime.now()
+            # utc, like the label of the format and the cutoff of the retention
+            dt = datetime.utcnow()
         else:
             if isinstance(dt, str):
                 dt = datetime.strftime(dt, '%Y-%m-%d %H:%M:%S+00:00')
@@ -82,7 +80,23 @@ class StorageDatabase():
         self.saveTrigger()
         return True
 
+    def applyRetention(self, cutoff):
+        # removes the entries which were set before the cutoff (naive utc)
+        if cutoff is None:
+            return 0
+        limit = cutoff.strftime('%Y-%m-%d %H:%M:%S+00:00')
+        # the datetime strings all have the same format, so they compare like the timestamps
+        expired = [k for k, d in list(self._data.items()) if str(d.get("datetime", "")) < limit]
+        for k in expired:
+            # runs in a worker, a key which was set again in the meantime is kept
+            if str(self._data.get(k, {}).get("datetime", "")) < limit:
+                self._data.pop(k, None)
+        if len(expired) > 0:
+            self.saveTrigger()
+        return len(expired)
+
     def drop(self):
+        self._dbManager.saveScheduler.cancel(self)
         os.remove(self._documentPath+".npy")
         return True
 
@@ -119,12 +133,18 @@ class StorageDatabase():
 
     def saveTrigger(self):
         self._changed = True
+        self._dirtyKeys = self._dirtyKeys + 1
+
+        # repeated changes within the delay end up in one save
+        self._dbManager.saveScheduler.request(self, delay=2.0)
+
+    def getDirtyBytes(self):
+        # every entry is a small dict, so a rough size per changed key is good enough
+        return self._dirtyKeys * 256
 
-        if self.saveTimer is not None:
-            self.saveTimer.cancel()
-            self.saveTimer = None
-        self.saveTimer = threading.Timer(2.0, self.save)
-        self.saveTimer.start()
+    def checkpoint(self, update=False):
+        self._dirtyKeys = 0
+        return self.save()
 
     def save(self):
         self.updateView()
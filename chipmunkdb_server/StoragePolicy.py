@@ -0,0 +1,154 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# encodings for collections which were created without a storage policy: integers, float32, strings or none
+STORAGE_POLICY = os.getenv("STORAGE_POLICY", "none")
+# a string column becomes a categorical when it has at most this many distinct values
+STORAGE_CATEGORY_MAX = int(os.getenv("STORAGE_CATEGORY_MAX", "1024"))
+# ... and when the distinct values are at most this part of its rows
+STORAGE_CATEGORY_RATIO = float(os.getenv("STORAGE_CATEGORY_RATIO", "0.5"))
+# rows which are looked at first, so high cardinality columns are not hashed completely on every write
+STORAGE_SAMPLE_ROWS = int(os.getenv("STORAGE_SAMPLE_ROWS", "10000"))
+
+POLICY_OPTIONS = ["integers", "float32", "strings"]
+# pandas, arrow and duckdb names of the narrowed integers and the type a query sees them with
+WIDE_INTEGERS = {"int8": "BIGINT", "int16": "BIGINT", "int32": "BIGINT", "uint8": "UBIGINT", "uint16": "UBIGINT", "uint32": "UBIGINT",
+                 "TINYINT": "BIGINT", "SMALLINT": "BIGINT", "INTEGER": "BIGINT",
+                 "UTINYINT": "UBIGINT", "USMALLINT": "UBIGINT", "UINTEGER": "UBIGINT"}
+
+
+class StoragePolicy():
+    """
+    Compact dtypes for the columns of a collection. "integers" narrows integers without loss,
+    "float32" stores floats with single precision and "strings" keeps low cardinality strings as categoricals.
+    """
+    def __init__(self, policy=None):
+        if policy is None or str(policy).strip() == "":
+            policy = STORAGE_POLICY
+        self.options = [o for o in POLICY_OPTIONS if o in [p.strip().lower() for p in str(policy).split(",")]]
+
+    @staticmethod
+    def isValid(policy):
+        return all([p.strip().lower() in POLICY_OPTIONS + ["none", ""] for p in str(policy).split(",")])
+
+    def isEnabled(self):
+        return len(self.options) > 0
+
+    def isEncodable(self, column):
+        # index and time columns have to keep the types they are restored with
+        return column != "datetime" and not str(column).startswith("index_") and not str(column).startswith("_index")
+
+    def isCategory(self, series):
+        count = series.shape[0]
+        if count == 0:
+            return False
+        try:
+            sample = series.iloc[:STORAGE_SAMPLE_ROWS]
+            if sample.nunique(dropna=True) > min(STORAGE_CATEGORY_MAX, max(1, sample.shape[0] * STORAGE_CATEGORY_RATIO)):
+                return False
+            unique = series.nunique(dropna=True)
+        except TypeError:
+            # unhashable values like lists
+            return False
+        return unique <= STORAGE_CATEGORY_MAX and unique <= max(1, count * STORAGE_CATEGORY_RATIO)
+
+    def encodeSeries(self, series):
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            return series
+        if "integers" in self.options and dtype.kind in "iu" and isinstance(dtype, np.dtype):
+            return pd.to_numeric(series, downcast="integer" if dtype.kind == "i" else "unsigned")
+        if "float32" in self.options and dtype.kind == "f" and isinstance(dtype, np.dtype) and dtype.itemsize > 4:
+            return series.astype(np.float32)
+        if "strings" in self.options and dtype.kind == "O" and self.isCategory(series):
+            return series.astype("category")
+        return series
+
+    def encodeFrame(self, df, columns=None):
+        """
+        encodes the given columns (all when None) of a frame which is not published yet
+        """
+        if not self.isEnabled():
+            return df
+        for column in (df.columns.tolist() if columns is None else columns):
+            if column not in df.columns or not self.isEncodable(column):
+                continue
+            encoded = self.encodeSeries(df[column])
+            if encoded is not df[column]:
+                df[column] = encoded
+        return df
+
+    def decodeFrame(self, df, columns):
+        # widens the columns a write is going to change, so any value can be stored in place
+        for column in columns:
+            if column not in df.columns:
+                continue
+            dtype = df[column].dtype
+            if isinstance(dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(object)
+            elif isinstance(dtype, np.dtype) and dtype.kind in "iu" and dtype.itemsize < 8:
+                df[column] = df[column].astype(np.int64 if dtype.kind == "i" else np.uint64)
+            elif isinstance(dtype, np.dtype) and dtype.kind == "f" and dtype.itemsize < 8:
+                df[column] = df[column].astype(np.float64)
+        return df
+
+    def getWideTypes(self, types):
+        """
+        column -> duckdb type for the integers which are stored narrowed, given the column -> type of a frame or a file.
+        Queries see them with the wide type again, so arithmetic does not overflow the small types
+        """
+        if "integers" not in self.options:
+            return {}
+        return {column: WIDE_INTEGERS[str(t)] for column, t in types.items()
+                if self.isEncodable(column) and str(t) in WIDE_INTEGERS}
+
+    def conformAppend(self, df, append):
+        """
+        converts appended rows to the encodings of the existing columns where this is lossless,
+        so a concat keeps them instead of falling back to the wide types
+        """
+        df = df.copy(deep=False)
+        for column in append.columns:
+            if column not in df.columns:
+                continue
+            dtype = df[column].dtype
+            values = append[column]
+            try:
+                if isinstance(dtype, pd.CategoricalDtype):
+                    new = [v for v in values.dropna().unique() if v not in dtype.categories]
+                    if len(dtype.categories) + len(new) > STORAGE_CATEGORY_MAX:
+                        continue
+                    categories = dtype.categories.append(pd.Index(new)) if len(new) > 0 else dtype.categories
+                    if len(new) > 0:
+                        df[column] = df[column].cat.set_categories(categories)
+                    append[column] = pd.Categorical(values, categories=categories, ordered=dtype.ordered)
+                elif isinstance(dtype, np.dtype) and dtype.kind in "iu" and values.dtype.kind in "iu" and values.dtype != dtype \
+                        and np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max:
+                    append[column] = values.astype(dtype)
+                elif isinstance(dtype, np.dtype) and dtype == np.float32 and values.dtype.kind == "f" \
+                        and "float32" in self.options:
+                    append[column] = values.astype(np.float32)
+            except Exception:
+                # the concat widens the column instead
+                pass
+        return df, append
+
+    def conformArrow(self, table, schema):
+        # casts appended arrow columns to the types of the existing table, raises when this would lose values
+        for name in table.column_names:
+            if schema.get_field_index(name) < 0:
+                continue
+            field = schema.field(name)
+            if table.schema.field(name).type != field.type:
+                table = table.set_column(table.schema.get_field_index(name), pa.field(name, field.type),
+                                         table.column(name).cast(field.type))
+        return table
+
+    def getOptions(self):
+        return ",".join(self.options)
@@ -2,19 +2,72 @@ from enum import Enum
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import os
+import json
 import duckdb
 from dotenv import load_dotenv
 import threading
 import time
 import asyncio
+import shutil
 
-from chipmunkdb_server.helper import printTiming
+from chipmunkdb_server.helper import printTiming, parse_time_range, parse_column_predicates, parse_aggregate_query
+from chipmunkdb_server.ColumnStatistics import ColumnStatistics
+from chipmunkdb_server.StoragePolicy import StoragePolicy
+from chipmunkdb_server.ReadWriteLock import ReadWriteLock
 
 load_dotenv()
 
 DATABASE_DIRECTORY = os.getenv("DATABASE_DIRECTORY", "db")
 DEBUG = os.getenv("DEBUG", "False")
+# "delta" only writes the rows/columns touched since the last checkpoint, "full" rewrites the table on every save
+PERSISTENCE_MODE = os.getenv("PERSISTENCE_MODE", "delta")
+# after this many delta segments the next save compacts everything into the base table
+DELTA_SEGMENT_LIMIT = int(os.getenv("DELTA_SEGMENT_LIMIT", "20"))
+
+# when enabled, loading a collection only reads its schema and queries run directly against the files
+QUERY_ON_DISK = os.getenv("QUERY_ON_DISK", "False").lower() == "true"
+
+# evicted collections leave an arrow file next to the .duck file, which is memory-mapped when they are used again
+ARROW_SNAPSHOTS = os.getenv("ARROW_SNAPSHOTS", "True").lower() == "true"
+
+# "pandas" keeps the hot state as a DataFrame, "arrow" keeps it as an arrow table which duckdb scans zero-copy
+TABLE_ENGINE = os.getenv("TABLE_ENGINE", "pandas")
+
+# seconds a reader or writer waits for the collection lock before giving up
+LOCK_TIMEOUT = float(os.getenv("LOCK_TIMEOUT", "60"))
+
+# time range bounds which depend on a time zone (now(), tz-aware data or literals) are widened by this
+TIME_RANGE_SLACK = pd.Timedelta(os.getenv("TIME_RANGE_SLACK", "1 day"))
+
+# a collection is checkpointed at most once in this many seconds
+SAVE_INTERVAL = float(os.getenv("SAVE_INTERVAL", "120"))
+
+# partition key format per partitioning of a timeseries collection
+PARTITION_FORMATS = {
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+    "year": "%Y",
+}
+PARTITION_LENGTHS = {
+    "day": pd.DateOffset(days=1),
+    "month": pd.DateOffset(months=1),
+    "year": pd.DateOffset(years=1),
+}
+
+def concatArrowTables(tables):
+    try:
+        return pa.concat_tables(tables, promote_options="default")
+    except TypeError:
+        # pyarrow < 14
+        return pa.concat_tables(tables, promote=True)
+
+def fetchArrow(relation):
+    # newer duckdb versions return a record batch reader instead of a table
+    result = relation.arrow()
+    return result.read_all() if isinstance(result, pa.RecordBatchReader) else result
 
 class ModeEnum(Enum):
     APPEND = "append"
@@ -24,44 +77,328 @@ class ModeEnum(Enum):
     DROPBEFORE = "dropbefore"
 
 class TableDatabase():
-    def __init__(self, dataRow, dbManager, create=False):
+    def __init__(self, dataRow, dbManager, create=False, load=True):
         self._df = pd.DataFrame()
         self._currentlySaving = False
-        self._timer = None
+        self._saveLock = threading.Lock()
         self._domains = []
-        self._operationsFinished = False
+        self._lock = ReadWriteLock()
+        self._hydrateLock = threading.Lock()
         self._type = "table"
         self._name = dataRow["name"]
         self._changed = True
         self._columns = []
         self._indexType = dataRow["indextype"]
+        self._partitioning = dataRow["partitioning"] if "partitioning" in dataRow else None
+        self._storagePolicy = StoragePolicy(dataRow["storage_policy"] if "storage_policy" in dataRow else None)
         self._rows = {}
         self._lastModified = time.time()
         self._lastUsed = time.time()
         self._last_backup_saved = 0
         self._lastSaved = 0
         self._printTime = True
+        self._dirtyIndex = None
+        self._dirtyColumns = set()
+        self._fullRewrite = True
+        self._pendingIndex = None
+        self._pendingColumns = set()
+        self._pendingFullRewrite = False
+        self._stateLock = threading.Lock()
+        self._version = 0
+        self._memoryUsage = (-1, 0)
+        self._statistics = None
+        self._statisticsLock = threading.Lock()
+        self._evicted = False
+        self._persistedColumns = []
+        self._segments = 0
+        self._hydrated = True
+        self._engine = TABLE_ENGINE
+        self._arrow = None
+        self._schema = {}
+        self._fileDb = None
+        self._diskGeneration = 0
+        self._attachedPartitions = None
         self._dbManager = dbManager
         self._db = duckdb.connect(":memory:", read_only=False)
-        self.loadInfos(create=create)
+        if load:
+            if QUERY_ON_DISK and not create:
+                self.loadSchema()
+            else:
+                self.loadInfos(create=create)
 
-    def blockOperations(self):
-        self._operationsFinished = False
+    def readLock(self, timeout=LOCK_TIMEOUT):
+        return self._lock.readLocked(timeout)
 
-    def unblockOperations(self):
-        self._operationsFinished = True
+    def writeLock(self, timeout=LOCK_TIMEOUT):
+        return self._lock.writeLocked(timeout)
 
     def isTimeseries(self):
         return self._indexType == "timeseries" or self._indexType == "time"
 
+    def isPartitioned(self):
+        return self.isTimeseries() and self._partitioning in PARTITION_FORMATS
+
+    def isArrowEngine(self):
+        return self._engine == "arrow"
+
+    def toArrow(self, df):
+        if isinstance(df.index, pd.RangeIndex):
+            # a range index is only stored as metadata, but we need it as a real column
+            df = df.set_index(pd.Index(np.asarray(df.index)))
+        return pa.Table.from_pandas(df, preserve_index=True)
+
+    def getArrowIndexColumns(self, table):
+        metadata = table.schema.pandas_metadata or {}
+        return [c for c in metadata.get("index_columns", []) if isinstance(c, str)]
+
+    def getArrowView(self, table):
+        # the index columns are only needed to restore the pandas index
+        return table.drop_columns(self.getArrowIndexColumns(table))
+
+    def getArrowForDisk(self, table):
+        indexColumns = self.getArrowIndexColumns(table)
+        if len(indexColumns) > 1:
+            names = [("_index"+str(indexColumns.index(c))+"_"+c if c in indexColumns else c) for c in table.column_names]
+            return table.rename_columns(names).replace_schema_metadata(None)
+        table = table.replace_schema_metadata(None)
+        if self.isTimeseries():
+            return table.drop_columns(indexColumns)
+        return table.rename_columns([("_index" if c in indexColumns else c) for c in table.column_names])
+
+    def beginWrite(self):
+        # a writer works on its own shallow copy, the published version is never changed in place
+        self.ensureHydrated()
+        if self._df is None:
+            return self._arrow.to_pandas() if self._arrow is not None else pd.DataFrame()
+        return self._df.copy(deep=False)
+
+    def commitFrame(self, frame):
+        # publish the new version, running queries and saves keep the version they started with
+        if isinstance(frame, pa.Table):
+            df, arrow = None, frame
+        elif self.isArrowEngine():
+            df, arrow = None, self.toArrow(frame)
+        else:
+            df, arrow = frame, None
+        statistics = self._statistics
+        if statistics is not None and statistics[0] == self._version:
+            # only the chunks from the first changed row on are computed again
+            statistics = statistics[1].update(self.getArrowView(arrow) if df is None else df, self.getFirstChangedRow(frame))
+        else:
+            statistics = None
+        with self._stateLock:
+            self._df = df
+            self._arrow = arrow
+            self.mergeDirtyState((self._pendingIndex, self._pendingColumns, self._pendingFullRewrite))
+            self.resetPendingState()
+            self._version = self._version + 1
+            self._statistics = (self._version, statistics) if statistics is not None else None
+        return True
+
+    def getFirstChangedRow(self, frame):
+        # the rows of a timeseries before the first written timestamp keep their values and positions
+        if self._pendingFullRewrite or self._pendingIndex is None or len(self._pendingIndex) == 0 \
+                or not self.isTimeseries():
+            return 0
+        if isinstance(frame, pa.Table):
+            # arrow tables are only committed by appends after the last row
+            return self.getRowCount()
+        try:
+            return int(frame.index.searchsorted(self._pendingIndex.min(), side="left"))
+        except Exception as e:
+            return 0
+
+    def getStatistics(self):
+        # the published frame together with its column statistics, which are computed on first use
+        with self._stateLock:
+            version, frame, statistics = self._version, self.getSnapshot(), self._statistics
+        if statistics is not None and statistics[0] == version:
+            return frame, statistics[1]
+        with self._statisticsLock:
+            statistics = self._statistics
+            if statistics is not None and statistics[0] == version:
+                return frame, statistics[1]
+            start = time.time()
+            computed = ColumnStatistics.fromFrame(frame)
+            printTiming(start, "statistics_time")
+            with self._stateLock:
+                if self._version == version:
+                    self._statistics = (version, computed)
+        return frame, computed
+
+    def getVersion(self):
+        return self._version
+
+    def getMemoryUsage(self):
+        # bytes of the published version, only computed again after the next commit
+        if not self._hydrated:
+            return 0
+        with self._stateLock:
+            version, df, arrow = self._version, self._df, self._arrow
+        if self._memoryUsage[0] != version:
+            if df is None:
+                size = arrow.nbytes if arrow is not None else 0
+            else:
+                size = int(df.memory_usage(deep=True, index=True).sum())
+            self._memoryUsage = (version, size)
+        return self._memoryUsage[1]
+
+    def isEvicted(self):
+        return self._evicted
+
+    def getSnapshot(self):
+        # the frame which is registered for a query, either the dataframe or the arrow view
+        if self._df is None:
+            return self.getArrowView(self._arrow) if self._arrow is not None else pd.DataFrame()
+        return self._df
+
+    def getCatalogSnapshot(self):
+        # collections of a statement over several collections are loaded when they are used
+        self.ensureHydrated()
+        self._lastUsed = time.time()
+        return self.getSnapshot()
+
+    def getPandas(self):
+        if self._df is not None:
+            return self._df
+        if self._arrow is not None:
+            return self._arrow.to_pandas()
+        return pd.DataFrame()
+
+    def getRowCount(self):
+        if self._df is None:
+            return self._arrow.num_rows if self._arrow is not None else 0
+        return self._df.shape[0]
+
     def df(self, domains=[]):
         return self.getDf(domains=domains)
 
+    def loadSchema(self):
+        try:
+            start = time.time()
+            cursor = self.getDiskConnection().cursor()
+            try:
+                self.createDiskView(cursor)
+                describe = cursor.execute("DESCRIBE dataframe_view").df()
+            finally:
+                cursor.close()
+
+            if not self.isPartitioned():
+                self._segments = len(self.getDeltaSegments(self.getDiskConnection()))
+
+            self._schema = {}
+            for row in describe.to_dict("records"):
+                if self.isDiskIndexColumn(row["column_name"]):
+                    continue
+                self._schema[row["column_name"]] = row["column_type"]
+            self._columns = list(self._schema.keys())
+            self._domains = list(dict.fromkeys([c.split(".")[0] for c in self._columns if len(c.split(".")) > 1]))
+            self._hydrated = False
+            self._changed = False
+            self._fullRewrite = False
+            printTiming(start, "loading_schema")
+
+        except Exception as e:
+            if "does not exist" in str(e):
+                self._dbManager.onDatabaseLoadError(self, self._name)
+            print(e)
+
+        return True
+
+    def ensureHydrated(self):
+        if self._hydrated and not self._hydrateLock.locked():
+            return True
+        # several readers can hold the lock at once, only one of them may load
+        with self._hydrateLock:
+            if not self._hydrated:
+                self._hydrated = True
+                self.loadInfos()
+        return True
+
+    def isDiskIndexColumn(self, col):
+        return col == "_index" or ("_index" in col and col.count("_") > 1)
+
+    def canQueryOnDisk(self):
+        return not self._hydrated and (self.isPartitioned() or self._segments == 0)
+
+    def getDiskConnection(self):
+        if self.isPartitioned():
+            keys = self.getPartitionKeys()
+            if self._fileDb is None or self._attachedPartitions != (keys, self._diskGeneration):
+                self.closeDiskConnection()
+                self._fileDb = duckdb.connect(":memory:", read_only=False)
+                for key in keys:
+                    self._fileDb.execute("ATTACH '"+self.getPartitionFile(key)+"' AS \""+self.getPartitionAlias(key)+"\" (READ_ONLY)")
+                self._attachedPartitions = (keys, self._diskGeneration)
+        elif self._fileDb is None:
+            self._fileDb = duckdb.connect(database=self.getDatabaseFile(), read_only=False)
+        return self._fileDb
+
+    def closeDiskConnection(self):
+        if self._fileDb is not None:
+            try:
+                self._fileDb.close()
+            except Exception as e:
+                pass
+        self._fileDb = None
+        self._attachedPartitions = None
+
+    def closeConnections(self):
+        # an object which was only created to read or change the files releases its connections
+        self.closeDiskConnection()
+        try:
+            self._db.close()
+        except Exception as e:
+            print("Error on closing", self._name, str(e))
+        return True
+
+    def createDiskView(self, cursor, start=None, end=None, widen=False):
+        if self.isPartitioned():
+            keys = self.getPartitionKeysForRange(start, end)
+            if len(keys) == 0:
+                raise Exception("Table "+self._name+" does not exist")
+            sql = " UNION ALL BY NAME ".join(['SELECT * FROM "'+self.getPartitionAlias(k)+'"."'+self._name+'"' for k in keys])
+        else:
+            sql = 'SELECT * FROM "'+self._name+'"'
+        wide = self._storagePolicy.getWideTypes(self._schema) if widen else {}
+        if len(wide) > 0:
+            sql = self.getWideSelect(wide, "("+sql+")")
+        cursor.execute("CREATE OR REPLACE TEMP VIEW dataframe_view AS "+sql)
+        return True
+
+    def getWideSelect(self, wide, source):
+        casts = ['CAST("'+c.replace('"', '""')+'" AS '+t+') AS "'+c.replace('"', '""')+'"' for c, t in wide.items()]
+        return "SELECT * REPLACE ("+", ".join(casts)+") FROM "+source
+
+    def registerSnapshot(self, cursor, frame, name="dataframe_view"):
+        # the integers the storage policy narrowed are widened by a view over the registered frame, without a copy
+        wide = self._storagePolicy.getWideTypes(ColumnStatistics.getFrameColumns(frame))
+        if len(wide) == 0:
+            cursor.register(name, frame)
+            return True
+        cursor.register(name+"_encoded", frame)
+        cursor.execute('CREATE OR REPLACE TEMP VIEW "'+name.replace('"', '""')+'" AS '
+                       + self.getWideSelect(wide, '"'+(name+"_encoded").replace('"', '""')+'"'))
+        return True
+
     def loadInfos(self, create=False):
         try:
             start = time.time()
 
-            self.blockOperations()
+            if self.isPartitioned():
+                df = self.readPartitions()
+                if df.shape[0] == 0 and len(self.getPartitionKeys()) == 0:
+                    raise Exception("Table "+self._name+" does not exist")
+                self._fullRewrite = False
+                self.commitFrame(df)
+                self.updateView()
+                printTiming(start, "loading_database")
+                return True
+
+            if self.loadArrowSnapshot():
+                printTiming(start, "loading_snapshot")
+                return True
+
             file_db = duckdb.connect(database=self.getDatabaseFile(), read_only=False)
             try:
                 # Try to fetch the column information from the raw dataframe
@@ -77,59 +414,27 @@ class TableDatabase():
                 print("ERror while trying to pragmaing data of your dataframe", pragmaerr)
 
             ## okay table exists # lets load the dataframe
-            self._df = file_db.execute('SELECT * FROM "'+self._name+'"').df().copy()
-
-            multiIndexes = []
-            # check all columns if there is a index(n) column
-            for col in self._df.columns.tolist():
-                # when multiple "_" in column name
-                if "_index" in col and col.count("_") > 1:
-                    name = col.split("_")[-1]
-                    # rename the col to the name
-                    self._df.rename(columns={col: name}, inplace=True)
-                    multiIndexes.append(name)
-
-            self._df.dropna(axis=1, how="all", inplace=True)
-            if len(multiIndexes) > 0:
-                # delete the current index
-                self._df.reset_index(drop=True, inplace=True)
-                # if multiindex we need to set the index
-                self._df = self._df.set_index(multiIndexes)
-                # sort index
-                self._df.sort_index(inplace=True)
-            else:
-                if self.isTimeseries():
-                    # if timeseries we need to set the index
-                    self._df = self._df.set_index(['datetime'], append=True)
-                    self._df["datetime"] = pd.to_datetime(self._df.index)
-                else:
-                    self._df = self._df.set_index(['_index'], append=True)
-
-            if "datetime" in self._df.columns.tolist():
-                self._df["datetime"] = pd.to_datetime(self._df["datetime"])
-
-            if "date" in self._df.columns.tolist():
-                self._df["date"] = pd.to_datetime(self._df["date"])
-
-
-
-            # iterate over all columns and check if there are "date" or "time" in
-            # the column name
-            for col in self._df.columns.tolist():
-                if col == "datetime":
-                    continue
-                if "date" in col.lower() or "time" in col.lower():
-                    self._df[col] = pd.to_datetime(self._df[col], unit='ms')
-
-
-
+            rawdf = file_db.execute('SELECT * FROM "'+self._name+'"').df()
+            self._persistedColumns = rawdf.columns.tolist()
+            df = self.restoreFrameFromDisk(rawdf)
+
+            # replay all delta segments written since the last compaction
+            segments = self.getDeltaSegments(file_db)
+            for segment in segments:
+                delta = self.restoreFrameFromDisk(file_db.execute('SELECT * FROM "'+segment+'"').df(), dropEmpty=False)
+                df = self.applyDelta(df, delta)
+            self._segments = len(segments)
+            self._fullRewrite = False
+
+            # the loaded frame keeps the types of the file, only written columns are encoded
+            self.commitFrame(df)
+            self.loadStatistics()
             self.updateView()
             printTiming(start, "loading_database")
 
             file_db.close()
 
         except Exception as e:
-            self.unblockOperations()
             if not create:
                 if "does not exist" in str(e):
                     self._dbManager.onDatabaseLoadError(self, self._name)
@@ -137,22 +442,250 @@ class TableDatabase():
             print(e)
             pass
 
-        self.unblockOperations()
         return True
 
-    def saveDatabaseAsyncTimer(self, update):
-        self._timer = None
-        self.saveDatabaseAsync(update)
+    def getSnapshotFile(self):
+        return self.getDatabaseFilename()+".arrow"
 
-    def saveDatabaseAsync(self, update=False, timeout=0):
-        if timeout > 0 and self._timer is None:
-            self._timer = threading.Timer(timeout, self.saveDatabaseAsyncTimer, [update])
-            self._timer.start()
+    def getDiskSignature(self):
+        stat = os.stat(self.getDatabaseFile())
+        return str(stat.st_mtime_ns)+":"+str(stat.st_size)
+
+    def writeArrowSnapshot(self):
+        # only valid as long as the .duck file is not written again, so it carries the file signature
+        if not ARROW_SNAPSHOTS or not self._hydrated or self.isPartitioned() or self.getDirtyBytes() > 0:
+            return False
+        if os.path.isfile(self.getSnapshotFile()):
             return True
 
-        thread = threading.Thread(target=self.save, args=[update])
-        thread.start()
-        return thread
+        start = time.time()
+        tmpfile = self.getSnapshotFile()+".tmp"
+        try:
+            table = self._arrow if self._df is None else pa.Table.from_pandas(self._df, preserve_index=True)
+            if table is None:
+                return False
+            metadata = dict(table.schema.metadata or {})
+            metadata[b"chipmunkdb"] = json.dumps({
+                "signature": self.getDiskSignature(),
+                "persistedColumns": list(self._persistedColumns),
+                "segments": self._segments,
+            }).encode()
+            table = table.replace_schema_metadata(metadata)
+            with pa.OSFile(tmpfile, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmpfile, self.getSnapshotFile())
+        except Exception as e:
+            print("Error in writing arrow snapshot", str(e))
+            self.removeArrowSnapshot()
+            return False
+
+        printTiming(start, "snapshot_time")
+        return True
+
+    def loadArrowSnapshot(self):
+        if not ARROW_SNAPSHOTS or not os.path.isfile(self.getSnapshotFile()):
+            return False
+        try:
+            # the buffers point into the mapped file, nothing is parsed or converted
+            table = pa.ipc.open_file(pa.memory_map(self.getSnapshotFile(), "r")).read_all()
+            metadata = dict(table.schema.metadata)
+            info = json.loads(metadata.pop(b"chipmunkdb"))
+            if info["signature"] != self.getDiskSignature():
+                # the .duck file was written after the snapshot
+                self.removeArrowSnapshot()
+                return False
+        except Exception as e:
+            print("Error in loading arrow snapshot", str(e))
+            self.removeArrowSnapshot()
+            return False
+
+        table = table.replace_schema_metadata(metadata)
+        self._persistedColumns = info["persistedColumns"]
+        self._segments = info["segments"]
+        self._fullRewrite = False
+        self.commitFrame(table if self.isArrowEngine() else table.to_pandas())
+        self.loadStatistics()
+        self._columns = self.getColumns()
+        self._domains = list(dict.fromkeys([c.split(".")[0] for c in self._columns if len(c.split(".")) > 1]))
+        self.updateView()
+        return True
+
+    def removeArrowSnapshot(self):
+        for filename in [self.getSnapshotFile(), self.getSnapshotFile()+".tmp"]:
+            try:
+                os.remove(filename)
+            except Exception as e:
+                pass
+        return True
+
+    def getStatisticsFile(self):
+        return self.getDatabaseFilename()+".stats.json"
+
+    def writeStatistics(self):
+        # like the arrow snapshot, the statistics are only valid for the .duck file they were written with
+        if self.isPartitioned() or not self._hydrated:
+            return False
+        with self._stateLock:
+            statistics = self._statistics
+            if statistics is None or statistics[0] != self._version or self.getDirtyBytes() > 0:
+                return False
+        tmpfile = self.getStatisticsFile()+".tmp"
+        try:
+            with open(tmpfile, "w") as f:
+                f.write(statistics[1].toJson(self.getDiskSignature()))
+            os.replace(tmpfile, self.getStatisticsFile())
+        except Exception as e:
+            print("Error in writing statistics", str(e))
+            self.removeStatistics()
+            return False
+        return True
+
+    def loadStatistics(self):
+        if not os.path.isfile(self.getStatisticsFile()):
+            return False
+        try:
+            with open(self.getStatisticsFile(), "r") as f:
+                statistics = ColumnStatistics.fromJson(f.read(), self.getDiskSignature())
+        except Exception as e:
+            print("Error in loading statistics", str(e))
+            statistics = None
+        with self._stateLock:
+            frame = self.getSnapshot()
+            if statistics is None or statistics.getRowCount() != ColumnStatistics.getRows(frame) \
+                    or statistics.columns != ColumnStatistics.getFrameColumns(frame):
+                return False
+            self._statistics = (self._version, statistics)
+        return True
+
+    def removeStatistics(self):
+        for filename in [self.getStatisticsFile(), self.getStatisticsFile()+".tmp"]:
+            try:
+                os.remove(filename)
+            except Exception as e:
+                pass
+        return True
+
+    def restoreFrameFromDisk(self, df, dropEmpty=True):
+        multiIndexes = []
+        # check all columns if there is a index(n) column
+        for col in df.columns.tolist():
+            # when multiple "_" in column name
+            if "_index" in col and col.count("_") > 1:
+                name = col.split("_")[-1]
+                # rename the col to the name
+                df.rename(columns={col: name}, inplace=True)
+                multiIndexes.append(name)
+
+        if dropEmpty:
+            df.dropna(axis=1, how="all", inplace=True)
+        if len(multiIndexes) > 0:
+            # if multiindex we need to set the index
+            df = df.set_index(multiIndexes)
+            # sort index
+            df.sort_index(inplace=True)
+        else:
+            if self.isTimeseries():
+                # if timeseries we need to set the index
+                df["datetime"] = pd.to_datetime(df["datetime"])
+                df.index = pd.DatetimeIndex(df["datetime"]).rename(None)
+                if not df.index.is_monotonic_increasing:
+                    df.sort_index(inplace=True)
+            elif "_index" in df.columns.tolist():
+                df = df.set_index(['_index'])
+                df.index.name = None
+
+        if "datetime" in df.columns.tolist():
+            df["datetime"] = pd.to_datetime(df["datetime"])
+
+        if "date" in df.columns.tolist():
+            df["date"] = pd.to_datetime(df["date"])
+
+        # iterate over all columns and check if there are "date" or "time" in
+        # the column name
+        for col in df.columns.tolist():
+            if col == "datetime":
+                continue
+            if "date" in col.lower() or "time" in col.lower():
+                df[col] = pd.to_datetime(df[col], unit='ms')
+
+        return df
+
+    def applyDelta(self, df, delta):
+        if delta.shape[0] == 0:
+            return df
+        if not delta.index.isin(df.index).all():
+            df = df.reindex(df.index.union(delta.index))
+        for col in delta.columns.tolist():
+            if col not in df.columns:
+                df[col] = np.nan
+        df = self._storagePolicy.decodeFrame(df, delta.columns)
+        df.loc[delta.index, delta.columns] = delta
+        return df
+
+    def getDeltaSegmentName(self, number):
+        return self._name+"__delta_"+str(number)
+
+    def getDeltaSegments(self, file_db):
+        prefix = self._name+"__delta_"
+        tables = file_db.execute("SELECT table_name FROM information_schema.tables").df()["table_name"].tolist()
+        segments = [t for t in tables if t.startswith(prefix) and t[len(prefix):].isdigit()]
+        return sorted(segments, key=lambda t: int(t[len(prefix):]))
+
+    def markDirty(self, index, columns):
+        # collected for the running write and published together with its frame
+        if self._pendingIndex is None:
+            self._pendingIndex = index
+        else:
+            self._pendingIndex = self._pendingIndex.union(index)
+        self._pendingColumns.update(columns)
+
+    def markFullRewrite(self):
+        self._pendingFullRewrite = True
+
+    def resetPendingState(self):
+        self._pendingIndex = None
+        self._pendingColumns = set()
+        self._pendingFullRewrite = False
+
+    def mergeDirtyState(self, state):
+        dirtyIndex, dirtyColumns, fullRewrite = state
+        if dirtyIndex is not None:
+            if self._dirtyIndex is None:
+                self._dirtyIndex = dirtyIndex
+            else:
+                self._dirtyIndex = self._dirtyIndex.union(dirtyIndex)
+        self._dirtyColumns.update(dirtyColumns)
+        if fullRewrite:
+            self._fullRewrite = True
+
+    def takeSnapshotForSave(self):
+        # the dirty state always belongs to the published version, so both are taken together
+        with self._stateLock:
+            state = (self._dirtyIndex, self._dirtyColumns, self._fullRewrite)
+            self._dirtyIndex = None
+            self._dirtyColumns = set()
+            self._fullRewrite = False
+            return state, self.getDiskFrame()
+
+    def restoreDirtyState(self, state):
+        with self._stateLock:
+            self.mergeDirtyState(state)
+
+    def saveDatabaseAsync(self, update=False, timeout=0):
+        # the scheduler coalesces repeated requests, so the throttle is only the earliest start
+        delay = max(timeout, self._lastSaved + SAVE_INTERVAL - time.time())
+        return self._dbManager.saveScheduler.request(self, update=update, delay=delay)
+
+    def getDirtyBytes(self):
+        # rough estimate of what the next checkpoint has to write
+        if not self._hydrated:
+            return 0
+        if self._fullRewrite:
+            return self.getRowCount() * max(1, len(self.getColumns())) * 8
+        if self._dirtyIndex is None:
+            return 0
+        return len(self._dirtyIndex) * max(1, len(self._dirtyColumns)) * 8
 
     def getDatabaseFilename(self):
         return DATABASE_DIRECTORY+"/tables/"+self._name
@@ -160,35 +693,178 @@ class TableDatabase():
     def getDatabaseFile(self):
         return self.getDatabaseFilename()+".duck"
 
-    def updateView(self, update=False):
-        start = time.time()
-        self._db.unregister('dataframe_view')
+    def getPartitionKey(self, index):
+        return index.strftime(PARTITION_FORMATS[self._partitioning])
+
+    def getPartitionRange(self, key, tz=None):
+        start = pd.Timestamp(key)
+        if tz is not None:
+            start = start.tz_localize(tz)
+        return start, start + PARTITION_LENGTHS[self._partitioning]
+
+    def getPartitionAlias(self, key):
+        return "p_"+key.replace("-", "_")
+
+    def getPartitionFile(self, key):
+        return self.getDatabaseFilename()+"/"+key+".duck"
+
+    def getPartitionKeys(self):
+        if not os.path.isdir(self.getDatabaseFilename()):
+            return []
+        return sorted([f[:-len(".duck")] for f in os.listdir(self.getDatabaseFilename()) if f.endswith(".duck")])
+
+    def getPartitionKeysForRange(self, start=None, end=None):
+        keys = self.getPartitionKeys()
+        # partition keys sort like their timestamps, so we compare them on the same format
+        if start is not None:
+            startKey = self.getPartitionKey(pd.DatetimeIndex([pd.to_datetime(start)]))[0]
+            keys = [k for k in keys if k >= startKey]
+        if end is not None:
+            endKey = self.getPartitionKey(pd.DatetimeIndex([pd.to_datetime(end)]))[0]
+            keys = [k for k in keys if k <= endKey]
+        return keys
+
+    def readPartitions(self, start=None, end=None):
+        if len(self.getPartitionKeysForRange(start, end)) == 0:
+            return pd.DataFrame()
+
+        cursor = self.getDiskConnection().cursor()
         try:
-            self._db.register('dataframe_view', self._df)
-        except:
-            # ignore when df is empty.
-            pass
+            self.createDiskView(cursor, start=start, end=end)
+            where = []
+            params = []
+            if start is not None:
+                where.append("datetime >= ?")
+                params.append(pd.to_datetime(start))
+            if end is not None:
+                where.append("datetime <= ?")
+                params.append(pd.to_datetime(end))
+            sql = 'SELECT * FROM dataframe_view'
+            if len(where) > 0:
+                sql = sql + " WHERE " + " AND ".join(where)
+            rawdf = cursor.execute(sql, params).df()
+        finally:
+            cursor.close()
+
+        self._persistedColumns = rawdf.columns.tolist()
+        return self.restoreFrameFromDisk(rawdf)
+
+    def getQueryTimeRange(self, query):
+        # the rows a query can see at most, (None, None) when the predicates are unknown
+        if not self.isTimeseries():
+            return None, None
+        bounds = parse_time_range(query, "dataframe_view")
+        if bounds is None:
+            return None, None
+
+        start, end = None, None
+        for bound, value in bounds:
+            ts = self.resolveTimeBound(value, bound)
+            if ts is None:
+                continue
+            if bound == "start":
+                start = ts if start is None else max(start, ts)
+            else:
+                end = ts if end is None else min(end, ts)
+        return start, end
 
+    def resolveTimeBound(self, value, bound):
+        kind, text = value
+        try:
+            if kind == "now":
+                ts = pd.Timestamp.utcnow().tz_localize(None)
+                if text is not None:
+                    ts = ts - pd.Timedelta(text.lower())
+                widen = True
+            else:
+                ts = pd.Timestamp(text)
+                widen = ts.tzinfo is not None or self.getIndexTz() is not None
+                if ts.tzinfo is not None:
+                    ts = ts.tz_convert("UTC").tz_localize(None)
+        except Exception as e:
+            # e.g. month intervals, the bound is just not used
+            return None
+        if widen:
+            ts = ts - TIME_RANGE_SLACK if bound == "start" else ts + TIME_RANGE_SLACK
+        return ts
+
+    def sliceSnapshot(self, frame, start=None, end=None):
+        if start is None and end is None:
+            return frame
+        if isinstance(frame, pa.Table):
+            return self.sliceArrowTimeRange(frame, start, end)
+        tz = getattr(frame.index, "tz", None)
+        if tz is not None:
+            # the bounds are utc, widened by the slack
+            start = start.tz_localize("UTC") if start is not None else None
+            end = end.tz_localize("UTC") if end is not None else None
+        return self.sliceTimeRange(frame, start, end)
+
+    def sliceArrowTimeRange(self, table, start=None, end=None):
+        # the chunks are sorted, so their first and last values work like zone maps and only the border chunks are searched
+        if "datetime" not in table.column_names or table.num_rows == 0:
+            return table
+        column = table.column("datetime")
+        if column.null_count > 0 or not pa.types.is_timestamp(column.type):
+            return table
+        low = np.datetime64(start.to_datetime64()) if start is not None else None
+        high = np.datetime64(end.to_datetime64()) if end is not None else None
+
+        lo, hi = None, 0
+        offset = 0
+        previous = None
+        for chunk in column.chunks:
+            if len(chunk) == 0:
+                continue
+            values = chunk.to_numpy()
+            if previous is not None and values[0] < previous:
+                return table
+            previous = values[-1]
+            if lo is None and (low is None or values[-1] >= low):
+                lo = offset + (0 if low is None else int(values.searchsorted(low, side="left")))
+            if high is not None and values[0] > high:
+                break
+            hi = offset + (len(values) if high is None else int(values.searchsorted(high, side="right")))
+            offset = offset + len(values)
+        if lo is None or hi <= lo:
+            return table.slice(0, 0)
+        return table.slice(lo, hi - lo)
+
+    def sliceTimeRange(self, df, start=None, end=None):
+        if not isinstance(df.index, pd.DatetimeIndex) or not df.index.is_monotonic_increasing:
+            return df
+        lo = 0 if start is None else df.index.searchsorted(pd.to_datetime(start), side="left")
+        hi = len(df.index) if end is None else df.index.searchsorted(pd.to_datetime(end), side="right")
+        return df.iloc[lo:hi]
+
+    def updateView(self, update=False):
+        # queries register the published version on their own cursor, so only the master needs an update
+        start = time.time()
         self.updateDatabaseMaster(update)
 
         printTiming(start, "updateView ")
 
     def isTableEmpty(self):
-        return self._df.shape[0] == 0
+        return self.getRowCount() == 0
 
     def addDataframeToDatabase(self, dataFrame, mode: ModeEnum = ModeEnum.APPEND,
                                domain=None, leftIndex="__index_level_0__", rightIndex="__index_level_0__"):
 
+        df = None
         try:
 
-            self.blockOperations()
+            self.ensureHydrated()
+            self.resetPendingState()
             if domain is not None:
                 dataFrame = dataFrame.add_prefix(domain+".")
 
-            try:
-                dataFrame = dataFrame.tz_localize(self._df.index.tz)
-            except Exception as e:
-                pass
+            # naive rows get the time zone of the collection, the time zone of a first write is kept
+            tz = self.getIndexTz()
+            if tz is not None and isinstance(dataFrame.index, pd.DatetimeIndex) and dataFrame.index.tz is None:
+                try:
+                    dataFrame = dataFrame.tz_localize(tz)
+                except Exception as e:
+                    pass
 
             if isinstance(dataFrame.index, pd.core.indexes.datetimes.DatetimeIndex):
                 dataFrame.index = dataFrame.index.round("s")
@@ -217,79 +893,125 @@ class TableDatabase():
                         dataFrame[col] = pd.to_datetime(dataFrame[col], unit='ms')
 
             start = time.time()
-            if self.isTableEmpty():
+            sortedRuns = False
+            if mode == ModeEnum.APPEND.value or mode == ModeEnum.APPEND:
+                df = self.appendAfterLastRow(dataFrame)
+            if df is not None:
+                # new rows are all after the current end, so we only need to add them
+                bstart = printTiming(start, "append_dataframe_fast_path " + str(mode))
+                mode = "fastappend"
+                sortedRuns = True
+            else:
+                # encoded columns which are written are widened and encoded again before the commit
+                df = self._storagePolicy.decodeFrame(self.beginWrite(), dataFrame.columns)
+
+            if sortedRuns:
+                pass
+            elif self.isTableEmpty():
                 # if table is empty lets directly "create" it with the new dataFrame
-                self._df = dataFrame.copy()
+                df = dataFrame.copy()
+                self.markFullRewrite()
             else:
                 # merge it
                 join_df = dataFrame
                 if mode == ModeEnum.DROPBEFORE.value:
-                    self._df = self._df.drop(columns=[n for n in dataFrame.columns.tolist() if n != 'datetime'], errors="ignore")
-                    self.updateView()
-                    bstart = printTiming(start, "append_dataframe_dropbefore_updateView " + str(mode))
+                    df = df.drop(columns=[n for n in dataFrame.columns.tolist() if n != 'datetime'], errors="ignore")
+                    self.markFullRewrite()
+                    bstart = printTiming(start, "append_dataframe_dropbefore " + str(mode))
                     mode = "append"
 
                 if mode == ModeEnum.KEEP:
-                    self._df = self._df.merge(join_df, left_index=True, right_index=True)
+                    df = df.merge(join_df, left_index=True, right_index=True)
+                    self.markFullRewrite()
                     bstart = printTiming(start, "append_dataframe_update " + str(mode))
                 elif mode == ModeEnum.APPEND.value:
                     bstart = printTiming(start, "append_dataframe_prepared_datasets" + str(mode))
+                    # only the rows from the first new timestamp on can change, the head stays untouched
+                    head, base = self.splitSortedRun(df, join_df)
+                    sortedRuns = head is not None
+
                     marker_df = join_df.filter(regex='\:marker', axis=1)
                     for col in marker_df.columns:
-                        if col not in self._df.columns:
+                        if col not in base.columns:
                             marker_df.drop(col, axis=1, inplace=True)
 
                     bstart = printTiming(bstart, "append_dataframe_filter_and_drop_cols " + str(mode))
                     if len(marker_df.columns) > 0:
+                        if not sortedRuns:
+                            # base still shares its values with the published version
+                            base = base.copy()
                         try:
                             join_df.drop(marker_df.columns, axis=1, inplace=True)
 
                             marker_df[marker_df.columns] = marker_df[marker_df.columns].replace(np.nan, "[trash]")
                             marker_df[marker_df.columns] = marker_df[marker_df.columns].fillna("[trash]")
 
-                            self._df.update(marker_df)
+                            base.update(marker_df)
                         except Exception as err:
                             pass
                         finally:
-                            self._df.replace("[trash]", np.nan, inplace=True)
+                            base.replace("[trash]", np.nan, inplace=True)
 
                     bstart = printTiming(bstart, "append_dataframe_replaced_emptycols " + str(mode))
-                    
-                    self._df = self._df.merge(join_df, left_index=True, right_index=True,
+
+                    base = base.merge(join_df, left_index=True, right_index=True,
                                      how='outer', suffixes=('', '_y'))
                     bstart = printTiming(bstart, "append_dataframe_merged " + str(mode))
-                    self._df.drop(self._df.filter(regex='_y$').columns.tolist(), axis=1, inplace=True)
+                    base.drop(base.filter(regex='_y$').columns.tolist(), axis=1, inplace=True)
                     bstart = printTiming(bstart, "append_dataframe_drop " + str(mode))
-                    testdf = self._df.loc[join_df.index, join_df.columns].update(join_df, overwrite=True)
 
-                    self._df.loc[join_df.index, join_df.columns] = join_df
+                    base.loc[join_df.index, join_df.columns] = join_df
+                    if sortedRuns:
+                        base.sort_index(inplace=True)
+                        # a column can only be empty now when it is empty in the merged run and in the head
+                        emptyColumns = [c for c in base.columns if base[c].isnull().all()]
+                        emptyColumns = [c for c in emptyColumns if c not in head.columns or head[c].isnull().all()]
+                        base = pd.concat([head, base]) if head.shape[0] > 0 else base
+                        base = base.drop(columns=emptyColumns)
+                    df = base
+                    self.markDirty(join_df.index, join_df.columns.tolist() + marker_df.columns.tolist())
                     bstart = printTiming(bstart, "append_dataframe_update " + str(mode))
                 elif mode == ModeEnum.UPDATE.value:
-                    self._df.update(join_df)
+                    # only the updated columns are copied, the others are shared with the published version
+                    for col in join_df.columns:
+                        if col in df.columns:
+                            df[col] = df[col].copy()
+                    df.update(join_df)
+                    self.markDirty(join_df.index, join_df.columns.tolist())
                     bstart = printTiming(start, "append_dataframe_update " + str(mode))
                 elif mode == ModeEnum.OVERWRITE.value:
-                    self._df = self._df.merge(join_df, left_index=True, right_index=True)
+                    df = df.merge(join_df, left_index=True, right_index=True)
+                    self.markFullRewrite()
                     bstart = printTiming(start, "append_dataframe_update " + str(mode))
 
-            ## lets sort
-            if "datetime" in self._df.columns.tolist() or "date" in self._df.columns.tolist() or self.isTimeseries() \
-                 or "date" in self._df.index.names:
-                self._df.sort_index(inplace=True)
+            if not sortedRuns:
+                ## lets sort
+                if "datetime" in df.columns.tolist() or "date" in df.columns.tolist() or self.isTimeseries() \
+                     or "date" in df.index.names:
+                    df = df.sort_index()
 
-            self._df.dropna(axis=1, how="all", inplace=True)
+                df = df.dropna(axis=1, how="all")
 
             bstart = printTiming(None, "append_dataframe_before_index_creation ")
             # write the indexes to a column named "index_"+indexname
-            for index in self._df.index.names:
+            for index in (df.index.names if isinstance(df, pd.DataFrame) else []):
                 if index is None:
                     continue
                 if index != "datetime":
-                    self._df["index_"+index] = self._df.index.get_level_values(index)
+                    df["index_"+index] = df.index.get_level_values(index)
                     # convert the same type as the index
-                    self._df["index_"+index] = self._df["index_"+index].astype(self._df.index.get_level_values(index).dtype)
+                    df["index_"+index] = df["index_"+index].astype(df.index.get_level_values(index).dtype)
+                    self._pendingColumns.add("index_"+index)
             printTiming(bstart, "append_dataframe_after_index_creation ")
 
+            if isinstance(df, pd.DataFrame):
+                df = self._storagePolicy.encodeFrame(df, None if self._pendingFullRewrite else list(self._pendingColumns))
+                bstart = printTiming(bstart, "append_dataframe_encoded ")
+
+            self.commitFrame(df)
+
         except Exception as e:
+            # the published version stays untouched when the write fails
             print("Error in adding data", str(e))
         finally:
             self._changed = True
@@ -300,7 +1022,62 @@ class TableDatabase():
             self.saveDatabaseAsync(True)
             del dataFrame
 
-            self.unblockOperations()
+    def getIndexTz(self):
+        if self._df is None:
+            if self._arrow is not None and "datetime" in self._arrow.column_names:
+                return getattr(self._arrow.schema.field("datetime").type, "tz", None)
+            return None
+        return getattr(self._df.index, "tz", None)
+
+    def getLastTimestamp(self):
+        if self._df is None:
+            if self._arrow is None or self._arrow.num_rows == 0 or "datetime" not in self._arrow.column_names:
+                return None
+            return pd.Timestamp(self._arrow.column("datetime")[-1].as_py())
+        if self._df.shape[0] == 0 or not isinstance(self._df.index, pd.DatetimeIndex):
+            return None
+        # timeseries collections are always kept sorted by their index
+        return self._df.index[-1]
+
+    def appendAfterLastRow(self, dataFrame):
+        if not self.isTimeseries() or not isinstance(dataFrame.index, pd.DatetimeIndex) or dataFrame.shape[0] == 0:
+            return None
+        last = self.getLastTimestamp()
+        if last is None or pd.isnull(last) or not dataFrame.index.is_monotonic_increasing:
+            return None
+        try:
+            if dataFrame.index[0] <= last:
+                return None
+        except TypeError:
+            # e.g. tz-aware against tz-naive, the merge path handles it
+            return None
+
+        # marker columns which already exist only update existing rows, so they are not appended
+        markerColumns = [c for c in dataFrame.filter(regex=':marker', axis=1).columns if c in self.getColumns()]
+        appendDf = dataFrame.drop(columns=markerColumns)
+        newColumns = [c for c in appendDf.columns if c not in self.getColumns()]
+        appendDf = appendDf.drop(columns=[c for c in newColumns if appendDf[c].isnull().all()])
+
+        if self._df is None:
+            try:
+                frame = concatArrowTables([self._arrow, self._storagePolicy.conformArrow(self.toArrow(appendDf), self._arrow.schema)])
+            except Exception as e:
+                # incompatible types, we fall back to the merge path
+                return None
+        else:
+            frame = pd.concat(list(self._storagePolicy.conformAppend(self._df, appendDf)))
+
+        self.markDirty(appendDf.index, appendDf.columns.tolist())
+        return frame
+
+    def splitSortedRun(self, df, join_df):
+        if not self.isTimeseries() or not isinstance(df.index, pd.DatetimeIndex) or not isinstance(join_df.index, pd.DatetimeIndex):
+            return None, df
+        try:
+            pos = df.index.searchsorted(join_df.index.min(), side="left")
+        except TypeError:
+            return None, df
+        return df.iloc[:pos], df.iloc[pos:].copy()
 
     def dropAllUnneededBlocks(self, df, ignoreStats = False):
         if ignoreStats == False:
@@ -314,7 +1091,21 @@ class TableDatabase():
         query = query.replace("`", "'")
         return query
 
-    def query(self, query, domains=[]):
+    def query(self, query, domains=[], arrow=False):
+        """
+        runs the query on the published version, returns the result as a dataframe or,
+        with arrow, as an arrow table without converting it to pandas
+        """
+        cache = self._dbManager.queryCache
+        cacheKey = None
+        if cache.isEnabled() and cache.isCacheable(query):
+            # the version is read before the snapshot, so a cached result is never older than its key
+            cacheKey = cache.getKey(self._name, query, domains, self._version, kind="arrow" if arrow else "pandas")
+            cached = cache.get(cacheKey)
+            if cached is not None:
+                self._lastUsed = time.time()
+                return cached
+
         df = pd.DataFrame()
         columns = []
         try:
@@ -322,12 +1113,41 @@ class TableDatabase():
             query = self.safeQuery(query)
 
             self._lastUsed = time.time()
-            ret = self._db.execute(query)
-            df = ret.fetchdf()
+            # datetime predicates cut the scanned rows down before duckdb sees them
+            start, end = self.getQueryTimeRange(query)
+            if self.canQueryOnDisk():
+                # run directly against the persisted file, duckdb pushes projections and filters into the scan
+                cursor = self.getDiskConnection().cursor()
+                try:
+                    self.createDiskView(cursor, start=start, end=end, widen=True)
+                    df, filtered = self.fetchNonEmptyRows(cursor, query, domains, arrow=arrow)
+                finally:
+                    cursor.close()
+                if arrow:
+                    df = df.drop_columns([c for c in df.column_names if self.isDiskIndexColumn(c)])
+                else:
+                    df = df.drop(columns=[c for c in df.columns if self.isDiskIndexColumn(c)])
+            else:
+                self.ensureHydrated()
+                df, filtered = self.queryStatistics(query), False
+                if df is not None and arrow:
+                    df = pa.Table.from_pandas(df, preserve_index=False)
+                if df is None:
+                    # every query gets its own cursor with the version which is published right now
+                    cursor = self._db.cursor()
+                    try:
+                        self.registerSnapshot(cursor, self.sliceSnapshot(self.skipChunks(query), start, end))
+                        df, filtered = self.fetchNonEmptyRows(cursor, query, domains, arrow=arrow)
+                    finally:
+                        cursor.close()
+            if arrow:
+                return self.finishArrowResult(df, domains, filtered, cacheKey)
+
             if domains is not None and len(domains) > 0:
                 df = self.filter_df_by_prefix(df, domains, adding_datetime=True)
 
-            df = self.dropAllUnneededBlocks(df, True)
+            if not filtered:
+                df = self.dropAllUnneededBlocks(df, True)
         except Exception as e:
             print(str(e))
             raise(Exception("query error", str(e)))
@@ -335,16 +1155,154 @@ class TableDatabase():
         for col in df.columns:
             columns.append(self.getColumnDescription(col, df))
 
+        if cacheKey is not None:
+            cache.put(cacheKey, (df, columns), int(df.memory_usage(deep=True, index=True).sum()))
+
         return df, columns
 
+    def finishArrowResult(self, table, domains, filtered, cacheKey):
+        # the same domain filter and empty row removal as for a dataframe, done on the arrow columns
+        if domains is not None and len(domains) > 0:
+            table = self.filter_arrow_by_prefix(table, domains, adding_datetime=True)
+        if not filtered:
+            table = self.dropEmptyArrowRows(table)
+        for i, field in enumerate(table.schema):
+            # duckdb enums come with unsigned dictionary indices, which pandas and most clients can not read
+            if pa.types.is_dictionary(field.type) and pa.types.is_unsigned_integer(field.type.index_type):
+                table = table.set_column(i, field.name, table.column(i).cast(
+                    pa.dictionary(pa.int32(), field.type.value_type, field.type.ordered)))
+
+        columns = [{"Field": col, "Type": str(table.schema.field(i).type), "Null": "YES" if table.column(i).null_count > 0 else "NO",
+                    "Key": "", "Default": ""} for i, col in enumerate(table.column_names)]
+        if cacheKey is not None:
+            self._dbManager.queryCache.put(cacheKey, (table, columns), table.nbytes)
+        return table, columns
+
+    def dropEmptyArrowRows(self, table):
+        values = [i for i, c in enumerate(table.column_names) if c != "datetime"]
+        if len(values) == 0:
+            # like a dropna over an empty subset
+            return table.slice(0, 0)
+        valid = pc.is_valid(table.column(values[0]))
+        for i in values[1:]:
+            valid = pc.or_(valid, pc.is_valid(table.column(i)))
+        if pc.all(valid).as_py():
+            return table
+        return table.filter(valid)
+
+    def fetchNonEmptyRows(self, cursor, query, domains=[], arrow=False):
+        """
+        runs the query and lets duckdb remove the rows where every returned value column is empty,
+        returns the frame and whether the rows were filtered, otherwise the caller has to drop them
+        """
+        fetch = fetchArrow if arrow else lambda r: r.df()
+        relation = cursor.sql(query)
+        if relation is None:
+            return (pa.table({}) if arrow else pd.DataFrame()), False
+        names = relation.columns
+        columns = [c for c in names if c != "datetime" and not self.isDiskIndexColumn(c)
+                   and (domains is None or len(domains) == 0 or c.startswith(tuple(domains)))]
+        if len(columns) == 0 or len(set(names)) != len(names):
+            # a filter can not tell duplicate names apart
+            return fetch(relation), False
+        condition = " AND ".join(['"'+c.replace('"', '""')+'" IS NULL' for c in columns])
+        return fetch(relation.filter("NOT ("+condition+")")), True
+
+    def mayHaveEmptyRows(self, columns, version):
+        # the column statistics count the rows without any value, so most raw reads need no dropna
+        try:
+            frame, statistics = self.getStatistics()
+            published = self._statistics
+            if published is None or published[1] is not statistics or published[0] != version:
+                return True
+            values = [c for c in columns if c != "datetime"]
+            if any([statistics.hasColumn(c) and statistics.getNullCount(c) == 0 for c in values]):
+                return False
+            if set(values) == set([c for c in statistics.columns if c != "datetime"]):
+                return statistics.getEmptyRowCount() > 0
+        except Exception as e:
+            print("Error in checking for empty rows", str(e))
+        return True
+
+    def queryStatistics(self, query):
+        # COUNT, MIN and MAX over the whole collection are answered from the column statistics without a scan
+        aggregates = parse_aggregate_query(query, "dataframe_view")
+        if aggregates is None:
+            return None
+        frame, statistics = self.getStatistics()
+        result = {}
+        for function, column, alias in aggregates:
+            if column is not None and not statistics.hasColumn(column):
+                return None
+            if function == "count":
+                value = statistics.getRowCount() - (statistics.getNullCount(column) if column is not None else 0)
+                result[alias] = pd.Series([value], dtype="int64")
+                continue
+            if not statistics.hasRange(column):
+                return None
+            value = statistics.getMin(column) if function == "min" else statistics.getMax(column)
+            result[alias] = pd.Series([value])
+            if value is not None:
+                try:
+                    result[alias] = result[alias].astype(statistics.columns[column])
+                except Exception as e:
+                    pass
+        return pd.DataFrame(result)
+
+    def skipChunks(self, query):
+        # chunks whose min and max rule out the numeric predicates of the query are not registered at all
+        predicates = parse_column_predicates(query, "dataframe_view")
+        if predicates is None or len(predicates) == 0:
+            return self.getSnapshot()
+        frame, statistics = self.getStatistics()
+        ranges = statistics.getRowRanges(predicates)
+        if ranges is None:
+            return frame
+        if isinstance(frame, pa.Table):
+            return concatArrowTables([frame.slice(lo, hi - lo) for lo, hi in ranges]) if len(ranges) > 0 else frame.slice(0, 0)
+        return pd.concat([frame.iloc[lo:hi] for lo, hi in ranges]) if len(ranges) > 0 else frame.iloc[0:0]
+
     def getIndexColumns (self):
+        if self._df is None and self._arrow is not None:
+            return self.getArrowIndexColumns(self._arrow)
         return self._df.index.names
 
     def getColumns(self):
+        if not self._hydrated:
+            return list(self._columns)
+        if self._df is None:
+            return self.getArrowView(self._arrow).column_names if self._arrow is not None else []
         return self._df.columns.tolist()
 
     def getColumnDescription(self, col, df=None):
-        if df is not None and not col in self._df.columns.tolist():
+        if not self._hydrated:
+            return {
+                "Field": col,
+                "Type": str(df[col].dtype) if df is not None and col in df.columns else self._schema.get(col, ""),
+                "Null": "YES",
+                "Key": "",
+                "Default": "",
+            }
+        current = self._df
+        if current is None:
+            view = self.getArrowView(self._arrow) if self._arrow is not None else pa.table({})
+            if col not in view.column_names:
+                return {
+                    "Field": col,
+                    "Type": str(df[col].dtype) if df is not None and col in df.columns else "",
+                    "Null": "NO",
+                    "Key": "",
+                    "Default": "",
+                }
+            return {
+                "Field": col,
+                "Type": str(df[col].dtype) if df is not None and col in df.columns else str(view.schema.field(col).type),
+                # arrow keeps a null count per column, so this needs no scan
+                "Null": "YES" if view.column(col).null_count > 0 else "NO",
+                "Key": "",
+                "Default": "",
+            }
+        if df is not None and not col in current.columns.tolist():
             return {
                 "Field": col,
                 "Type": str(df[col].dtype),
@@ -352,10 +1310,12 @@ class TableDatabase():
                 "Key": "",
                 "Default": "",
             }
+        frame, statistics = self.getStatistics()
+        nulls = statistics.getNullCount(col) if statistics.hasColumn(col) else int(current[col].isnull().sum())
         return {
                 "Field": col,
-                "Type": str(self._df[col].dtype),
-                "Null": "YES" if self._df[col].isnull().values.any() else "NO",
+                "Type": str(current[col].dtype),
+                "Null": "YES" if nulls > 0 else "NO",
                 "Key": "",
                 "Default": "",
             }
@@ -369,7 +1329,8 @@ class TableDatabase():
 
     def dropColumns(self, columns, domain=None):
 
-        self.blockOperations()
+        df = self.beginWrite()
+        self.resetPendingState()
 
         try:
             if len(columns) > 0 and columns[0] == "*":
@@ -387,19 +1348,20 @@ class TableDatabase():
 
                 columns = all_columns_starting_with
 
-            self._df = self._df.drop(columns=columns)
+            df = df.drop(columns=columns)
 
             # drop all rows where all are nan
-            self._df = self.dropAllUnneededBlocks(self._df)
+            df = self.dropAllUnneededBlocks(df)
 
             self._lastUsed = time.time()
             self._changed = True
-            self.updateView()
+            self.markFullRewrite()
+            self.commitFrame(df)
 
         except Exception as e:
             print("Error in Drop Columns", str(e))
 
-        self.unblockOperations()
+        self.updateView()
 
         return True
 
@@ -407,7 +1369,14 @@ class TableDatabase():
         return self.getColumns()
 
     def drop(self):
+        self._dbManager.saveScheduler.cancel(self)
+        self._dbManager.queryCache.invalidate(self._name)
         self._db.close()
+        self.closeDiskConnection()
+        self.removeArrowSnapshot()
+        self.removeStatistics()
+        if os.path.isdir(self.getDatabaseFilename()):
+            shutil.rmtree(self.getDatabaseFilename(), ignore_errors=True)
         try:
             os.remove(self.getDatabaseFilename()+".duck")
         except Exception as e:
@@ -430,15 +1399,44 @@ class TableDatabase():
             filtered_df.columns = filtered_df.columns.str.replace('^'+domain + ".", "")
         return filtered_df
 
+    def filter_arrow_by_prefix(self, table, domains, adding_datetime=False):
+        filter_col = [i for i, col in enumerate(table.column_names) if col.startswith(tuple(domains))]
+        if self.isTimeseries() and adding_datetime:
+            filter_col.append(table.column_names.index("datetime"))
+        filtered = table.select(filter_col)
+        # the names are changed the same way as in filter_df_by_prefix
+        names = pd.Index(filtered.column_names)
+        for domain in domains:
+            names = names.str.replace('^'+domain + ".", "")
+        return filtered.rename_columns(names.tolist())
+
     def getDf(self, domains=[]):
+        self.ensureHydrated()
         if domains is not None and len(domains) > 0:
-            ret_df = self.filter_df_by_prefix(self._df, domains)
+            ret_df = self.filter_df_by_prefix(self.getPandas(), domains)
             return ret_df
-        return self._df
+        return self.getPandas()
+
+    def getArrow(self, columns=[]):
+        self.ensureHydrated()
+        if self._arrow is None:
+            return self.toArrow(self.getPandas())
+        table = self._arrow
+        if len(columns) > 0:
+            table = table.select(self.getArrowIndexColumns(table) + [c for c in columns if c in table.column_names])
+        # drop all rows where every value column is empty
+        valueColumns = [c for c in table.column_names if c != "datetime" and c not in self.getArrowIndexColumns(table)]
+        if len(valueColumns) > 0:
+            mask = pc.is_valid(table.column(valueColumns[0]))
+            for c in valueColumns[1:]:
+                mask = pc.or_(mask, pc.is_valid(table.column(c)))
+            if pc.all(mask).as_py() == False:
+                table = table.filter(mask)
+        return table
 
     def updateDatabaseMaster(self, update=False):
         if self._changed:
-            self._columns = self._df.columns.tolist()
+            self._columns = self.getColumns()
 
             self._domains = []
             for k in self._columns:
@@ -449,7 +1447,7 @@ class TableDatabase():
                     self._domains.append(splits[0])
             self._domains = list(dict.fromkeys(self._domains))
 
-            self.run_coro(self._dbManager.updateDatabaseInfo(self._name, self._columns, self._domains, self._df.shape[0], update))
+            self.run_coro(self._dbManager.updateDatabaseInfo(self._name, self._columns, self._domains, self.getRowCount(), update))
             self._changed = False
 
     def run_coro(self, coro):
@@ -459,7 +1457,15 @@ class TableDatabase():
         try:
             loop = asyncio.get_running_loop()
         except RuntimeError:
-            loop = asyncio.get_event_loop()
+            managerLoop = getattr(self._dbManager, "loop", None)
+            if managerLoop is not None and managerLoop.is_running():
+                # called from a worker or save thread, the master is only touched from the loop of the manager
+                return asyncio.run_coroutine_threadsafe(coro, managerLoop)
+            try:
+                loop = asyncio.get_event_loop()
+            except RuntimeError:
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
 
         task = loop.create_task(coro)
         # Storing the task in a container may be useful for non-REPL (for `asyncio.gather(*tasks)`
@@ -477,27 +1483,124 @@ class TableDatabase():
         return self._lastUsed
 
     def cleanup(self):
-        self.updateDatabaseMaster()
-        del self._df
-        self._db.close()
-        del self._db
+        # a pending checkpoint is written now, afterwards the data is only on disk
+        self._dbManager.saveScheduler.cancel(self)
+        with self._saveLock:
+            if self._hydrated and self.getDirtyBytes() > 0:
+                self.writeCheckpoint()
+            self.updateDatabaseMaster()
+            self.closeDiskConnection()
+            self.writeArrowSnapshot()
+            self.writeStatistics()
+            self._dbManager.queryCache.invalidate(self._name)
+            self._evicted = True
+            # queries which still hold this object load it again or read from disk
+            with self._stateLock:
+                self._hydrated = False
+                self._df = pd.DataFrame()
+                self._arrow = None
+                self._memoryUsage = (-1, 0)
+                self._statistics = None
 
         return True
 
-    def waitUntilOperationsFinished(self):
-
-        if self._operationsFinished == False:
-            counter = 0
-            while True:
-                print("waiting for opertions")
-                time.sleep(0.05)
-                if counter > 100:
-                    self._operationsFinished = True
-                    raise Exception("Error in blocking", "One of the scripts does block too long")
-                if self._operationsFinished:
+    def applyRetention(self, cutoff):
+        """
+        removes the rows before the cutoff (naive utc) from memory and from the files,
+        a loaded collection has to be write locked by the caller
+        """
+        if not self.isTimeseries() or cutoff is None:
+            return 0
+        removed = 0
+        with self._saveLock:
+            if self._hydrated and self.getRowCount() > 0:
+                removed = self.dropRowsBefore(cutoff)
+            removedOnDisk = self.deleteRowsBefore(cutoff)
+        if removed > 0:
+            self._changed = True
+            self._lastModified = time.time()
+            self.updateView(True)
+        elif removedOnDisk > 0:
+            # nothing was committed, queries on the files still need a new version for their cached results
+            with self._stateLock:
+                self._version = self._version + 1
+        if removed > 0 or removedOnDisk > 0:
+            self._dbManager.queryCache.invalidate(self._name)
+        return max(removed, removedOnDisk)
+
+    def dropRowsBefore(self, cutoff):
+        tz = self.getIndexTz()
+        ts = cutoff.tz_localize("UTC").tz_convert(tz) if tz is not None else cutoff
+        if self._df is None:
+            column = self._arrow.column("datetime")
+            position = int(pc.sum(pc.less(column, pa.scalar(ts, type=column.type))).as_py() or 0)
+            # chunks before the cutoff are released, only the border chunk stays shared
+            frame = self._arrow.slice(position)
+        else:
+            if not isinstance(self._df.index, pd.DatetimeIndex) or not self._df.index.is_monotonic_increasing:
+                return 0
+            position = int(self._df.index.searchsorted(ts, side="left"))
+            # a copy, otherwise the slice keeps the expired rows in memory
+            frame = self._df.iloc[position:].copy()
+        if position == 0:
+            return 0
+        self.resetPendingState()
+        self.commitFrame(frame)
+        return position
+
+    def deleteRowsBefore(self, cutoff):
+        # deleted in place, partitions which ended before the cutoff are removed as a whole
+        self.closeDiskConnection()
+        removed = 0
+        if self.isPartitioned():
+            for key in self.getPartitionKeys():
+                partStart, partEnd = self.getPartitionRange(key)
+                # the keys are in the timezone of the index, so the slack covers every offset
+                if partStart - TIME_RANGE_SLACK >= cutoff:
                     break
-                counter = counter + 1
+                file_db = duckdb.connect(database=self.getPartitionFile(key), read_only=False)
+                try:
+                    if partEnd + TIME_RANGE_SLACK <= cutoff:
+                        expired = file_db.execute('SELECT count(*) FROM "'+self._name+'"').fetchone()[0]
+                        empty = True
+                    else:
+                        expired = self.deleteRowsFromTable(file_db, self._name, cutoff)
+                        empty = file_db.execute('SELECT count(*) FROM "'+self._name+'"').fetchone()[0] == 0
+                finally:
+                    file_db.close()
+                removed = removed + expired
+                if empty:
+                    os.remove(self.getPartitionFile(key))
+            self._diskGeneration = self._diskGeneration + 1
+            return removed
+
+        if not os.path.isfile(self.getDatabaseFile()):
+            return 0
+        self.removeArrowSnapshot()
+        file_db = duckdb.connect(database=self.getDatabaseFile(), read_only=False)
+        try:
+            for table in [self._name] + self.getDeltaSegments(file_db):
+                removed = removed + self.deleteRowsFromTable(file_db, table, cutoff)
+        finally:
+            file_db.close()
+        return removed
 
+    def deleteRowsFromTable(self, file_db, table, cutoff):
+        types = file_db.execute("SELECT data_type FROM information_schema.columns WHERE table_name = ? AND column_name = 'datetime'",
+                                [table]).fetchall()
+        if len(types) == 0:
+            return 0
+        value = cutoff.tz_localize("UTC") if "TIME ZONE" in types[0][0].upper() else cutoff
+        return file_db.execute('DELETE FROM "'+table+'" WHERE datetime < ?', [value.to_pydatetime()]).fetchone()[0]
+
+    def waitUntilOperationsFinished(self):
+        with self.readLock():
+            pass
+        return True
+
+    async def waitUntilOperationsFinishedAsync(self):
+        async with self.readLock():
+            pass
         return True
 
     def createFileBackup(self):
@@ -509,23 +1612,69 @@ class TableDatabase():
 
     def save(self, update=True):
 
-        if time.time() - self._lastSaved < 2 * 60 or self._currentlySaving == True:
-            if self._timer is not None:
-                return False
+        if time.time() - self._lastSaved < SAVE_INTERVAL or self._currentlySaving == True:
             print("Saving to quickly")
-            return self.saveDatabaseAsync(timeout=2*60)
+            return self.saveDatabaseAsync(update)
+
+        return self.checkpoint(update)
+
+    def checkpoint(self, update=True):
+
+        if not self._hydrated:
+            # nothing was loaded, so nothing can have changed
+            return True
 
-        self.waitUntilOperationsFinished()
+        with self._saveLock:
+            if not self._hydrated:
+                # cleaned up while waiting for the lock
+                return True
+            return self.writeCheckpoint()
 
+    def writeCheckpoint(self):
         self._currentlySaving = True
 
         start = time.time()
 
-        # before we save the file, we copy it as a backup and delete it after all works fine
-        self.createFileBackup()
+        # the save works on the published version, writers can go on meanwhile
+        dirtyState, frame = self.takeSnapshotForSave()
+        dirtyIndex, dirtyColumns, fullRewrite = dirtyState
 
+        if self.isPartitioned():
+            try:
+                self.savePartitions(frame, dirtyIndex, fullRewrite)
+            except Exception as e:
+                print("Error in saving partitions", str(e))
+                self.restoreDirtyState(dirtyState)
+            self._currentlySaving = False
+            printTiming(start, "save_time")
+            self._lastSaved = time.time()
+            return True
+
+        # the snapshot would not match the file anymore
+        self.removeArrowSnapshot()
         file_db = duckdb.connect(database=self.getDatabaseFile(), read_only=False)
-        copydf = self._df.copy()
+        try:
+            if fullRewrite or PERSISTENCE_MODE != "delta" or self._segments >= DELTA_SEGMENT_LIMIT \
+                    or not set(self._persistedColumns).issubset(self.getFrameColumns(frame)):
+                self.compact(file_db, frame)
+            elif dirtyIndex is not None:
+                self.saveDelta(file_db, frame, dirtyIndex, dirtyColumns)
+        except Exception as e:
+            print("Error in saving", str(e))
+            self.restoreDirtyState(dirtyState)
+        finally:
+            file_db.close()
+        self.writeStatistics()
+
+        self._currentlySaving = False
+        printTiming(start, "save_time")
+
+        self._lastSaved = time.time()
+
+        return True
+
+    def prepareFrameForDisk(self, df):
+        copydf = df.copy(deep=False)
         # check if the Index is a "MutliIndex" and if so, save every column as _index(n)
         if isinstance(copydf.index, pd.MultiIndex):
             for i in range(len(copydf.index.levels)):
@@ -536,39 +1685,127 @@ class TableDatabase():
 
                 # lets build the index column
                 copydf["_index"] = copydf.index
+        return copydf
+
+    def getDiskFrame(self):
+        # the current state in the on-disk layout, either as dataframe or as arrow table
+        if self._df is None:
+            return self.getArrowForDisk(self._arrow) if self._arrow is not None else pd.DataFrame()
+        return self.prepareFrameForDisk(self._df)
+
+    def getFrameColumns(self, frame):
+        if isinstance(frame, pa.Table):
+            return frame.column_names
+        return frame.columns.tolist()
+
+    def getFrameRowCount(self, frame):
+        if isinstance(frame, pa.Table):
+            return frame.num_rows
+        return frame.shape[0]
+
+    def getFrameKeys(self, frame):
+        keyColumns = [c for c in self.getFrameColumns(frame) if self.isDiskIndexColumn(c)]
+        if len(keyColumns) == 0:
+            keyColumns = ["datetime"]
+        keys = frame.select(keyColumns).to_pandas() if isinstance(frame, pa.Table) else frame[keyColumns]
+        if len(keyColumns) > 1:
+            return pd.MultiIndex.from_frame(keys)
+        if keyColumns[0] == "datetime":
+            return pd.DatetimeIndex(keys["datetime"])
+        return pd.Index(keys[keyColumns[0]])
+
+    def sliceFrame(self, frame, lo, hi):
+        if isinstance(frame, pa.Table):
+            return frame.slice(lo, hi - lo)
+        return frame.iloc[lo:hi]
+
+    def saveDelta(self, file_db, frame, dirtyIndex, dirtyColumns):
+        start = time.time()
+        mask = np.asarray(self.getFrameKeys(frame).isin(dirtyIndex))
+        columns = [c for c in self.getFrameColumns(frame) if c in dirtyColumns or self.isDiskIndexColumn(c)
+                   or (c == "datetime" and self.isTimeseries())]
+        if not mask.any() or len(columns) == 0:
+            return True
 
-        try:
-            file_db.register("dataframe_view", copydf)
-        except:
-            pass
-
-        try:
-            file_db.execute('DROP TABLE "'+self._name+'"')
-        except Exception as e:
-            print(str(e))
-            pass
+        if isinstance(frame, pa.Table):
+            delta = frame.filter(pa.array(mask)).select(columns)
+        else:
+            delta = frame.loc[mask, columns]
+        segment = self.getDeltaSegmentName(self._segments)
 
+        file_db.register("delta_view", delta)
         try:
-            file_db.execute('CREATE TABLE "'+self._name+'" AS SELECT * FROM dataframe_view')
+            file_db.execute('CREATE TABLE "'+segment+'" AS SELECT * FROM delta_view')
+        finally:
+            file_db.unregister("delta_view")
 
-            test = file_db.query("SELECT * FROM "+self._name).df()
+        self._segments = self._segments + 1
+        printTiming(start, "saved delta segment "+segment+" with "+str(self.getFrameRowCount(delta))+" rows")
+        return True
 
-            file_db.unregister("dataframe_view")
-        except Exception as e:
-            print(str(e))
-            pass
+    def savePartitions(self, frame, dirtyIndex, fullRewrite):
+        start = time.time()
+        if not os.path.isdir(self.getDatabaseFilename()):
+            os.makedirs(self.getDatabaseFilename())
+
+        times = self.getFrameKeys(frame)
+        if fullRewrite:
+            keys = list(self.getPartitionKey(times).unique())
+            # partitions which have no rows anymore are removed
+            for key in self.getPartitionKeys():
+                if key not in keys:
+                    os.remove(self.getPartitionFile(key))
+        elif dirtyIndex is not None:
+            keys = list(self.getPartitionKey(pd.DatetimeIndex(dirtyIndex)).unique())
+        else:
+            return True
 
-        try:
-            file_db.execute('DROP VIEW dataframe_view')
-        except Exception as e:
-            print(str(e))
-            pass
+        for key in keys:
+            partStart, partEnd = self.getPartitionRange(key, tz=times.tz)
+            partdf = self.sliceFrame(frame, times.searchsorted(partStart, side="left"), times.searchsorted(partEnd, side="left"))
+            filename = self.getPartitionFile(key)
+            if self.getFrameRowCount(partdf) == 0:
+                if os.path.exists(filename):
+                    os.remove(filename)
+                continue
+
+            # write into a temporary file and swap it, so a partition is never half written
+            tmpfile = filename+".tmp"
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            file_db = duckdb.connect(database=tmpfile, read_only=False)
+            try:
+                file_db.register("dataframe_view", partdf)
+                file_db.execute('CREATE TABLE "'+self._name+'" AS SELECT * FROM dataframe_view')
+                file_db.unregister("dataframe_view")
+            finally:
+                file_db.close()
+            os.replace(tmpfile, filename)
+
+        # attached partitions still point to the replaced files
+        self._diskGeneration = self._diskGeneration + 1
+        printTiming(start, "saved "+str(len(keys))+" partitions")
+        return True
 
-        file_db.close()
+    def compact(self, file_db, frame):
+        # before we rewrite the file, we copy it as a backup
+        self.createFileBackup()
 
-        self._currentlySaving = False
-        printTiming(start, "save_time")
+        file_db.register("dataframe_view", frame)
 
-        self._lastSaved = time.time()
+        try:
+            file_db.execute("BEGIN TRANSACTION")
+            file_db.execute('DROP TABLE IF EXISTS "'+self._name+'"')
+            for segment in self.getDeltaSegments(file_db):
+                file_db.execute('DROP TABLE "'+segment+'"')
+            file_db.execute('CREATE TABLE "'+self._name+'" AS SELECT * FROM dataframe_view')
+            file_db.execute("COMMIT")
+        except Exception as e:
+            file_db.execute("ROLLBACK")
+            raise e
+        finally:
+            file_db.unregister("dataframe_view")
 
+        self._segments = 0
+        self._persistedColumns = self.getFrameColumns(frame)
         return True
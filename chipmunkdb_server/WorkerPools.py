@@ -0,0 +1,159 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# duckdb, pyarrow and most of pandas release the GIL, so the heavy work runs in this thread pool
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", str(min(32, (os.cpu_count() or 1) + 4))))
+# pure python work like json encoding can be moved into processes, 0 keeps it in the thread pool
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+# statements of one request which run at the same time
+REQUEST_CONCURRENCY = int(os.getenv("REQUEST_CONCURRENCY", "4"))
+
+
+class PoolStats():
+    def __init__(self, name, workers, tracksRunning=True):
+        self._lock = threading.Lock()
+        self.name = name
+        self.workers = workers
+        # a process pool does not tell when a job starts, so running is estimated from the pending jobs
+        self.tracksRunning = tracksRunning
+        self.submitted = 0
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.maxPending = 0
+        self.busyTime = 0.0
+
+    def onSubmit(self):
+        with self._lock:
+            self.submitted = self.submitted + 1
+            self.pending = self.pending + 1
+            self.maxPending = max(self.maxPending, self.pending)
+
+    def onStart(self):
+        with self._lock:
+            self.running = self.running + 1
+
+    def onFinish(self, duration, failed=False, started=True):
+        with self._lock:
+            self.pending = self.pending - 1
+            if started:
+                self.running = self.running - 1
+            self.busyTime = self.busyTime + duration
+            if failed:
+                self.failed = self.failed + 1
+            else:
+                self.completed = self.completed + 1
+
+    def getStats(self):
+        with self._lock:
+            running = self.running if self.tracksRunning else min(self.pending, self.workers)
+            return {
+                "workers": self.workers,
+                "queued": max(0, self.pending - running),
+                "running": running,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "maxQueued": max(0, self.maxPending - self.workers),
+                "busyTime": round(self.busyTime, 3),
+            }
+
+
+class WorkerPools():
+    def __init__(self, threads=WORKER_THREADS, processes=WORKER_PROCESSES):
+        self._threads = max(1, threads)
+        self._processes = max(0, processes)
+        self._threadPool = ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix="chipmunkdb-worker")
+        self._processPool = None
+        self._processLock = threading.Lock()
+        self._threadStats = PoolStats("threads", self._threads)
+        self._processStats = PoolStats("processes", self._processes, tracksRunning=False)
+
+    def getProcessPool(self):
+        if self._processes == 0:
+            return None
+        with self._processLock:
+            if self._processPool is None:
+                # spawn, forking a process which runs duckdb threads is not safe
+                self._processPool = ProcessPoolExecutor(max_workers=self._processes,
+                                                        mp_context=multiprocessing.get_context("spawn"))
+        return self._processPool
+
+    async def run(self, func, *args, **kwargs):
+        """
+        runs blocking work (pandas, duckdb, pyarrow) in the thread pool and waits for it without blocking the loop
+        """
+        stats = self._threadStats
+        stats.onSubmit()
+        state = {"started": False, "start": time.time()}
+
+        def job():
+            state["started"] = True
+            state["start"] = time.time()
+            stats.onStart()
+            return func(*args, **kwargs)
+
+        failed = False
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._threadPool, job)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            stats.onFinish(time.time() - state["start"], failed=failed, started=state["started"])
+
+    async def runCpu(self, func, *args):
+        """
+        runs pure python work in the process pool, the function and its arguments have to be picklable
+        """
+        pool = self.getProcessPool()
+        if pool is None:
+            return await self.run(func, *args)
+
+        stats = self._processStats
+        stats.onSubmit()
+        start = time.time()
+        failed = False
+        try:
+            return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            stats.onFinish(time.time() - start, failed=failed, started=False)
+
+    async def gather(self, coroutines, limit=REQUEST_CONCURRENCY):
+        """
+        awaits independent coroutines at the same time, at most limit of them, the results keep their order
+        """
+        semaphore = asyncio.Semaphore(max(1, limit))
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[limited(c) for c in coroutines])
+
+    def getExecutor(self):
+        return self._threadPool
+
+    def getStats(self):
+        stats = {"threads": self._threadStats.getStats()}
+        if self._processes > 0:
+            stats["processes"] = self._processStats.getStats()
+        return stats
+
+    def shutdown(self, wait=False):
+        self._threadPool.shutdown(wait=wait)
+        if self._processPool is not None:
+            self._processPool.shutdown(wait=wait)
+        return True
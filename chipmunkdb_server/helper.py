@@ -2,8 +2,11 @@ import os
 import sys
 import importlib
 import subprocess
+import re
 import time
+from functools import lru_cache
 
+import sqlparse
 from dotenv import load_dotenv
 from sqlparse.sql import IdentifierList, Identifier
 from sqlparse.tokens import Keyword, DML
@@ -14,6 +17,8 @@ load_dotenv()
 
 
 DEBUG = os.getenv("DEBUG", "False")
+# number of distinct query texts whose parsing and routing is remembered
+QUERY_PARSE_CACHE_SIZE = int(os.getenv("QUERY_PARSE_CACHE_SIZE", "1024"))
 
 
 def is_subselect(parsed):
@@ -74,6 +79,251 @@ def extract_tables(sql):
     #return list(extract_table_identifiers(stream))
 
 
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def parse_query(sql):
+    """
+    splits the sql into statements and routes them, the first table found is the target of all following statements,
+    returns a tuple of (statement, target, all tables of the statement)
+    """
+    routes = []
+    targetTable = None
+    for statement in sqlparse.parse(sql):
+        try:
+            tables = tuple(dict.fromkeys(extract_tables(statement.value)))
+        except Exception as e:
+            if targetTable is None:
+                raise e
+            # the statement still goes to the target of the ones before
+            tables = ()
+        if targetTable is None and len(tables) > 0:
+            targetTable = tables[0]
+        routes.append((statement.value, targetTable, tables))
+    return tuple(routes)
+
+
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def replace_schemas(sql):
+    return sql.replace("default.", "").replace("'default'.", "").replace('"default".', "").replace("`default`.", "")
+
+
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def is_internal_query(sql):
+    upper = sql.upper()
+    return "DESCRIBE " in upper or "SHOW " in upper
+
+
+LITERAL = re.compile(r"'(?:[^']|'')*'")
+# keywords which can turn a predicate into something else than a plain restriction of the rows
+UNSAFE_RANGE_KEYWORDS = re.compile(r"\b(OR|NOT|UNION|INTERSECT|EXCEPT|JOIN|CASE|EXISTS|ANY|ALL|USING)\b", re.I)
+CLAUSE_END = re.compile(r"\b(GROUP\s+BY|ORDER\s+BY|LIMIT|HAVING|QUALIFY|WINDOW|OFFSET)\b", re.I)
+# the index column, only qualified outside of the quotes, so a quoted domain column like "sig.datetime" is not it
+TIME_COLUMN = r'(?<![\w".])(?:(?P<qualifier>"\w+"|\w+)\.)?(?:"DATETIME"|DATETIME)(?![\w"])'
+TIME_VALUE = r"(?:(?:TIMESTAMPTZ|TIMESTAMP|DATE)\s*)?@(\d+)@(?:\s*::\s*\w+)?" \
+             r"|(?:NOW\(\)|CURRENT_TIMESTAMP)(?:\s*::\s*\w+)?(?:\s*-\s*INTERVAL\s*(?:@(\d+)@|(\d+)\s*([A-Z]+)))?"
+TIME_PREDICATES = [
+    (re.compile(TIME_COLUMN+r"\s*BETWEEN\s*(?P<low>"+TIME_VALUE+r")\s*AND\s*(?P<high>"+TIME_VALUE+r")", re.I), "between"),
+    (re.compile(TIME_COLUMN+r"\s*(?P<op>>=|<=|>|<|=)\s*(?P<value>"+TIME_VALUE+r")", re.I), "column"),
+    (re.compile(r"(?P<value>"+TIME_VALUE+r")\s*(?P<op>>=|<=|>|<|=)\s*"+TIME_COLUMN, re.I), "value"),
+]
+COLUMN = r'(?:(?:"[^"]+"|\w+)\.)?("[^"]+"|\w+)'
+NUMBER = r"([-+]?\d+(?:\.\d+)?(?:E[-+]?\d+)?)"
+COLUMN_PREDICATES = [
+    (re.compile(COLUMN+r"\s*BETWEEN\s*"+NUMBER+r"\s*AND\s*"+NUMBER, re.I), "between"),
+    (re.compile(COLUMN+r"\s*(>=|<=|>|<|=)\s*"+NUMBER, re.I), "column"),
+    (re.compile(NUMBER+r"\s*(>=|<=|>|<|=)\s*"+COLUMN, re.I), "value"),
+]
+AGGREGATE = r'(COUNT|MIN|MAX)\s*\(\s*(\*|"[^"]+"|\w+)\s*\)\s+AS\s+("[^"]+"|\w+)'
+FLIPPED = {">": "<", ">=": "<=", "<": ">", "<=": ">="}
+
+
+def parse_time_value(literals, match):
+    # ("literal", text) or ("now", interval text) for values relative to the time the query runs
+    text = match.strip()
+    found = re.fullmatch(TIME_VALUE, text, re.I)
+    if found is None:
+        return None
+    if found.group(1) is not None:
+        return ("literal", literals[int(found.group(1))])
+    if found.group(2) is not None:
+        return ("now", literals[int(found.group(2))])
+    if found.group(3) is not None:
+        return ("now", found.group(3)+" "+found.group(4))
+    return ("now", None)
+
+
+def get_enclosing_group(text, start, end):
+    # positions of the unmatched parentheses around text[start:end], (-1, -1) at the top level, None when they do not balance
+    depth, opened = 0, -1
+    for i in range(start - 1, -1, -1):
+        depth = depth + (text[i] == ")") - (text[i] == "(")
+        if depth < 0:
+            opened = i
+            break
+    depth, closed = 0, -1
+    for i in range(end, len(text)):
+        depth = depth + (text[i] == "(") - (text[i] == ")")
+        if depth < 0:
+            closed = i
+            break
+    if (opened < 0) != (closed < 0):
+        return None
+    return opened, closed
+
+
+def is_predicate_boundary(where, start, end):
+    """
+    the predicate has to be a condition of its own, joined with AND to the rest of the where clause,
+    and so has every group of parentheses around it, otherwise it is an operand of a comparison, an IS or a function
+    """
+    # parentheses inside of quoted names do not count
+    text = re.sub(r'"[^"]*"', lambda m: '"'+"_"*(len(m.group(0)) - 2)+'"', where).upper()
+    while True:
+        group = get_enclosing_group(text, start, end)
+        if group is None:
+            return False
+        opened, closed = group
+        before = text[opened + 1:start].rstrip()
+        after = (text[end:closed] if closed >= 0 else text[end:]).lstrip()
+        if before != "" and re.search(r"\bAND$", before) is None:
+            return False
+        if after != "" and re.match(r"AND\b", after) is None:
+            return False
+        if opened < 0:
+            return True
+        start, end = opened, closed + 1
+
+
+def get_bounds(op):
+    bounds = []
+    if op in [">", ">=", "="]:
+        bounds.append("start")
+    if op in ["<", "<=", "="]:
+        bounds.append("end")
+    return bounds
+
+
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def get_where_clause(sql, table):
+    """
+    the conditions of a single select over the given table, with the string literals replaced by @n@,
+    returns (where, literals, names of the table and its alias) or None when the conditions might not only restrict the rows of the table
+    """
+    literals = []
+
+    def mask(m):
+        literals.append(m.group(0)[1:-1].replace("''", "'"))
+        return "@"+str(len(literals) - 1)+"@"
+
+    masked = LITERAL.sub(mask, sql)
+    masked = re.sub(r"\bIS\s+NOT\s+NULL\b", "IS_NOT_NULL", masked, flags=re.I)
+    if len(re.findall(r"\bSELECT\b", masked, re.I)) != 1 or len(re.findall(r"\bWHERE\b", masked, re.I)) != 1 \
+            or UNSAFE_RANGE_KEYWORDS.search(masked) is not None:
+        return None
+
+    source = re.search(r"\bFROM\b(.*?)\bWHERE\b", masked, re.S | re.I)
+    if source is None:
+        return None
+    found = re.fullmatch(r'\s*"?'+re.escape(table)+r'"?(?:\s+(?:AS\s+)?(\w+))?\s*', source.group(1), re.I)
+    if found is None:
+        return None
+    names = (table.lower(),) if found.group(1) is None else (table.lower(), found.group(1).lower())
+
+    where = masked[source.end():]
+    clauseEnd = CLAUSE_END.search(where)
+    where = " "+(where[:clauseEnd.start()] if clauseEnd is not None else where).strip().rstrip(";")
+    return where, tuple(literals), names
+
+
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def parse_time_range(sql, table):
+    """
+    finds the datetime bounds a single select over the given table has to keep,
+    returns a tuple of (bound, value) with bound "start" or "end", or None when the query is not simple enough
+    """
+    clause = get_where_clause(sql, table)
+    if clause is None:
+        return None
+    where, literals, names = clause
+
+    bounds = []
+    for pattern, kind in TIME_PREDICATES:
+        for m in pattern.finditer(where):
+            if not is_predicate_boundary(where, m.start(), m.end()):
+                continue
+            if m.group("qualifier") is not None and m.group("qualifier").strip('"').lower() not in names:
+                # a column of another relation or a field of a struct
+                continue
+            if kind == "between":
+                low, high = parse_time_value(literals, m.group("low")), parse_time_value(literals, m.group("high"))
+                if low is not None and high is not None:
+                    bounds = bounds + [("start", low), ("end", high)]
+                continue
+            op, value = m.group("op"), m.group("value")
+            if kind == "value":
+                op = FLIPPED.get(op, op)
+            value = parse_time_value(literals, value)
+            if value is not None:
+                bounds = bounds + [(bound, value) for bound in get_bounds(op)]
+    return tuple(bounds)
+
+
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def parse_column_predicates(sql, table):
+    """
+    finds numeric bounds on columns of a single select over the given table,
+    returns a tuple of (column, bound, value) or None when the query is not simple enough
+    """
+    clause = get_where_clause(sql, table)
+    if clause is None:
+        return None
+    where, literals, names = clause
+
+    bounds = []
+    for pattern, kind in COLUMN_PREDICATES:
+        for m in pattern.finditer(where):
+            if not is_predicate_boundary(where, m.start(), m.end()):
+                continue
+            if kind == "between":
+                column = m.group(1).strip('"')
+                bounds = bounds + [(column, "start", float(m.group(2))), (column, "end", float(m.group(3)))]
+                continue
+            if kind == "column":
+                column, op, value = m.group(1), m.group(2), m.group(3)
+            else:
+                column, op, value = m.group(3), FLIPPED.get(m.group(2), m.group(2)), m.group(1)
+            bounds = bounds + [(column.strip('"'), bound, float(value)) for bound in get_bounds(op)]
+    return tuple(bounds)
+
+
+@lru_cache(maxsize=QUERY_PARSE_CACHE_SIZE)
+def parse_aggregate_query(sql, table):
+    """
+    recognizes "SELECT COUNT(*) AS a, MIN(col) AS b, MAX(col) AS c FROM table" without conditions,
+    returns a tuple of (function, column, alias) or None
+    """
+    found = re.fullmatch(r'\s*SELECT\s+('+AGGREGATE+r'(?:\s*,\s*'+AGGREGATE+r')*)\s+FROM\s+"?'+re.escape(table)+r'"?\s*;?\s*',
+                         sql, re.I)
+    if found is None:
+        return None
+    aggregates = []
+    for m in re.finditer(AGGREGATE, found.group(1), re.I):
+        function, column, alias = m.group(1).lower(), m.group(2).strip('"'), m.group(3).strip('"')
+        if column == "*" and function != "count":
+            return None
+        aggregates.append((function, None if column == "*" else column, alias))
+    return tuple(aggregates)
+
+
+def get_parse_cache_stats():
+    stats = {}
+    for name, func in [("parse", parse_query), ("schemas", replace_schemas), ("internal", is_internal_query),
+                       ("where", get_where_clause), ("timeRange", parse_time_range),
+                       ("columnPredicates", parse_column_predicates), ("aggregates", parse_aggregate_query)]:
+        info = func.cache_info()
+        stats[name] = {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxSize": info.maxsize}
+    return stats
+
+
 currentfile = sys.argv[0]
 
 
@@ -1,17 +1,94 @@
 import asyncio
+import io
+import os
+import threading
+import time
 import unittest
 import pandas as pd
 import numpy as np
-from aiohttp import web
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-from chipmunkdb.ChipmunkDb import ChipmunkDb
 from chipmunkdb_server.DatabaseManager import DatabaseManager
+import chipmunkdb_server.TableDatabase as TableDatabaseModule
 from chipmunkdb_server.TableDatabase import TableDatabase
-from chipmunkdb_server.server import getThreaderServer, cleanDatabase
+from chipmunkdb_server.ReadWriteLock import ReadWriteLock
+from chipmunkdb_server.SaveScheduler import SaveScheduler
+from chipmunkdb_server.WorkerPools import WorkerPools
+from chipmunkdb_server.RetentionJob import RetentionJob
+from chipmunkdb_server.SharedCatalog import SharedCatalog
+from chipmunkdb_server.helper import parse_query, parse_column_predicates, replace_schemas, is_internal_query, \
+    get_parse_cache_stats
+from chipmunkdb_server.ColumnStatistics import STATS_CHUNK_ROWS
+from chipmunkdb_server.RestAioHttpServer import encodeStreamBatch, encodeQueryResult, dumpJson, getStreamLayout, \
+    ArrowStreamBuffer, startParquetStream, writeParquetRowGroup, RAWSTREAM_ROW_GROUP_ROWS
+
+
+def closeFrame(rows, freq="1min", start="2021-01-01"):
+    # the frame most tests write, one close value per period
+    return pd.DataFrame({"close": np.arange(float(rows))}, index=pd.date_range(start, periods=rows, freq=freq))
+
+
+def formatRecords(df):
+    """
+    the records of a result with the naive timestamps formatted like the json responses,
+    the reference the column encoders are compared with
+    """
+    df = df.loc[:, ~df.columns.duplicated()].copy()
+    for c in df.select_dtypes(include=['datetime64']).columns.tolist():
+        try:
+            df[c] = df[c].apply(lambda x: x.strftime('%Y-%m-%d %H:%M:%S+00:00'))
+        except Exception:
+            # NaT can not be formatted, the column keeps its timestamps
+            pass
+    return df.to_dict("records")
 
 
 class TEstInternalData(unittest.TestCase):
 
+    def setUp(self):
+        self.dbmng = DatabaseManager()
+        self.collections = []
+
+    def tearDown(self):
+        for table in self.collections:
+            table.drop()
+
+    def createCollection(self, name, rows=0, freq="1min", **info):
+        """
+        a new timeseries collection with the rows of closeFrame, dropped after the test.
+        It is only saved when the test asks for it
+        """
+        table = TableDatabase(dict({"name": name, "indextype": "timeseries"}, **info), self.dbmng, create=True)
+        table.saveDatabaseAsync = lambda *args, **kwargs: True
+        self.collections.append(table)
+        if rows > 0:
+            table.addDataframeToDatabase(closeFrame(rows, freq), mode="append")
+        return table
+
+    def loadCollection(self, name, onDisk=False, **info):
+        # another object on the files of a collection, with onDisk it is only loaded when a query needs it
+        previous = TableDatabaseModule.QUERY_ON_DISK
+        TableDatabaseModule.QUERY_ON_DISK = onDisk
+        try:
+            return TableDatabase(dict({"name": name, "indextype": "timeseries"}, **info), self.dbmng)
+        finally:
+            TableDatabaseModule.QUERY_ON_DISK = previous
+
+    def collectClosedObjects(self):
+        # the objects whose connections are closed during the test
+        closed = []
+        closeConnections = TableDatabase.closeConnections
+
+        def collect(dbObject):
+            closeConnections(dbObject)
+            closed.append(dbObject)
+
+        TableDatabase.closeConnections = collect
+        self.addCleanup(setattr, TableDatabase, "closeConnections", closeConnections)
+        return closed
+
     def testBasicRW(self):
 
         dbmng = DatabaseManager()
@@ -42,8 +119,651 @@ class TEstInternalData(unittest.TestCase):
         print(q)
 
 
+    def testPartitions(self):
+
+        table = self.createCollection("test_py_partitions", rows=12, freq="6h", partitioning="day")
+        table.checkpoint()
+
+        # one file per day
+        keys = ["2021-01-01", "2021-01-02", "2021-01-03"]
+        self.assertEqual(table.getPartitionKeys(), keys)
+        files = {key: os.stat(table.getPartitionFile(key)).st_ino for key in keys}
+
+        df2 = pd.DataFrame({"close": [100.0]}, index=pd.DatetimeIndex(["2021-01-03 21:00"]))
+        table.addDataframeToDatabase(df2, mode="append")
+        table.checkpoint()
+
+        # only the partition with the new row was swapped
+        self.assertEqual(os.stat(table.getPartitionFile("2021-01-01")).st_ino, files["2021-01-01"])
+        self.assertEqual(os.stat(table.getPartitionFile("2021-01-02")).st_ino, files["2021-01-02"])
+        self.assertNotEqual(os.stat(table.getPartitionFile("2021-01-03")).st_ino, files["2021-01-03"])
+
+        # the partitions are merged in time order on load
+        reloaded = self.loadCollection("test_py_partitions", partitioning="day")
+        expected = pd.concat([closeFrame(12, "6h"), df2])
+        self.assertEqual(reloaded.getRowCount(), 13)
+        self.assertEqual(reloaded.getPandas().index.tolist(), expected.index.tolist())
+        self.assertEqual(reloaded.getPandas()["close"].tolist(), expected["close"].tolist())
+
+        # a range only reads the overlapping partitions
+        self.assertEqual(reloaded.readPartitions(start="2021-01-02", end="2021-01-02 23:59").shape[0], 4)
+
+        # without a loaded collection the range is read by a temporary object, which closes its connections
+        async def collectionInfo(name):
+            return {"name": name, "indextype": "timeseries", "partitioning": "day"}
+
+        self.dbmng.getCollectionInfoByName = collectionInfo
+        closed = self.collectClosedObjects()
+        loop = asyncio.new_event_loop()
+        df = loop.run_until_complete(self.dbmng.getDataFrameFromCollection("test_py_partitions", [], start="2021-01-02",
+                                                                           end="2021-01-02 23:59"))
+        loop.close()
+        self.assertEqual(df.shape[0], 4)
+        self.assertEqual(len(closed), 1)
+        self.assertIsNone(closed[0]._fileDb)
+        with self.assertRaises(duckdb.ConnectionException):
+            closed[0]._db.execute("SELECT 1")
+
+    def testQueryOnDisk(self):
+
+        for name, info in [("test_py_ondisk", {}), ("test_py_ondisk_parts", {"partitioning": "day"})]:
+            table = self.createCollection(name, rows=72, freq="1h", **info)
+            table.checkpoint()
+
+            onDisk = self.loadCollection(name, onDisk=True, **info)
+            self.assertTrue(onDisk.canQueryOnDisk())
+            self.assertEqual(sorted(onDisk.getColumns()), sorted(table.getColumns()))
+
+            for query in ["SELECT * FROM "+name,
+                          "SELECT count(*) c, sum(close) s FROM "+name,
+                          "SELECT datetime, close FROM "+name+" WHERE datetime >= '2021-01-02 12:00' AND close < 60"]:
+                # both objects share the cache and start at the same version
+                self.dbmng.queryCache.invalidate(name)
+                result, columns = onDisk.query(query)
+                self.dbmng.queryCache.invalidate(name)
+                expected, columns = table.query(query)
+                pd.testing.assert_frame_equal(result, expected)
+
+            # the queries ran on the files, only a write loads the collection
+            self.assertFalse(onDisk._hydrated)
+            onDisk.addDataframeToDatabase(closeFrame(1, start="2021-01-04"), mode="append")
+            self.assertTrue(onDisk._hydrated)
+            self.assertEqual(onDisk.getRowCount(), 73)
+
+    def testArrowEngine(self):
+
+        previous = TableDatabaseModule.TABLE_ENGINE
+        TableDatabaseModule.TABLE_ENGINE = "arrow"
+        try:
+            table = self.createCollection("test_py_arrow_engine", rows=20)
+            table.addDataframeToDatabase(pd.DataFrame({"close": [-1.0]}, index=closeFrame(20).index[3:4]), mode="update")
+            table.addDataframeToDatabase(closeFrame(5, start="2021-01-01 00:20") + 20.0, mode="append")
+            table.checkpoint()
+            reloaded = self.loadCollection("test_py_arrow_engine")
+        finally:
+            TableDatabaseModule.TABLE_ENGINE = previous
+
+        # the writes went through pandas, the published version is arrow again
+        self.assertIsNone(table._df)
+        self.assertIsInstance(table._arrow, pa.Table)
+
+        expected = pd.concat([closeFrame(20), closeFrame(5, start="2021-01-01 00:20") + 20.0])
+        expected.loc[expected.index[3], "close"] = -1.0
+        result, columns = table.query("SELECT sum(close) s, count(*) c FROM test_py_arrow_engine")
+        self.assertEqual(result["s"].iloc[0], expected["close"].sum())
+        self.assertEqual(result["c"].iloc[0], 25)
+
+        # both engines read the same files
+        self.assertIsNone(reloaded._df)
+        pandasEngine = self.loadCollection("test_py_arrow_engine")
+        self.assertIsNotNone(pandasEngine._df)
+        for frame in [table.getPandas(), reloaded.getPandas(), pandasEngine.getPandas()]:
+            self.assertEqual(frame.index.tolist(), expected.index.tolist())
+            self.assertEqual(frame["close"].tolist(), expected["close"].tolist())
+
+    def testSortedAppends(self):
+
+        table = self.createCollection("test_py_sorted_appends", rows=10)
+        after = closeFrame(5, start="2021-01-01 00:10") + 10.0
+        late = pd.DataFrame({"close": [-1.0, -1.0, -1.0], "vol": [1.0, 2.0, 3.0]},
+                            index=pd.date_range("2021-01-01 00:05", periods=3, freq="1min"))
+
+        # only rows after the last timestamp take the fast path
+        self.assertIsNotNone(table.appendAfterLastRow(after))
+        self.assertIsNone(table.appendAfterLastRow(late))
+        head, run = table.splitSortedRun(table.getPandas(), late)
+        self.assertEqual(head.index.tolist(), closeFrame(5).index.tolist())
+        self.assertEqual(run.shape[0], 5)
+
+        table.addDataframeToDatabase(after, mode="append")
+        self.assertEqual(table.getPandas()["close"].tolist(), np.arange(15.0).tolist())
+
+        # late rows are merged into the run from their first timestamp, the head stays as it is
+        table.addDataframeToDatabase(late, mode="append")
+        between = pd.DataFrame({"close": [3.5]}, index=pd.DatetimeIndex(["2021-01-01 00:03:30"]))
+        table.addDataframeToDatabase(between, mode="append")
+        frame = table.getPandas()
+        self.assertTrue(frame.index.is_monotonic_increasing)
+        self.assertEqual(frame.shape[0], 16)
+        self.assertEqual(frame["close"].tolist(), [0.0, 1.0, 2.0, 3.0, 3.5, 4.0, -1.0, -1.0, -1.0] + np.arange(8.0, 15.0).tolist())
+        self.assertEqual(frame["vol"].iloc[6:9].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(int(frame["vol"].isnull().sum()), 13)
+
+        # a marker column which exists already is not appended to new rows
+        marker = pd.DataFrame({"close": [15.0], "sig:marker": ["buy"]}, index=pd.DatetimeIndex(["2021-01-01 00:15"]))
+        table.addDataframeToDatabase(marker, mode="append")
+        self.assertEqual(table.getPandas()["sig:marker"].iloc[-1], "buy")
+        marker = pd.DataFrame({"close": [16.0], "sig:marker": ["sell"]}, index=pd.DatetimeIndex(["2021-01-01 00:16"]))
+        table.addDataframeToDatabase(marker, mode="append")
+        self.assertEqual(table.getPandas()["close"].iloc[-1], 16.0)
+        self.assertTrue(pd.isnull(table.getPandas()["sig:marker"].iloc[-1]))
+
+    def testAppendTimeZone(self):
+
+        table = self.createCollection("test_py_append_tz")
+        table.addDataframeToDatabase(closeFrame(5).tz_localize("UTC"), mode="append")
+        self.assertEqual(str(table.getPandas().index.tz), "UTC")
+
+        # naive rows are read in the time zone of the collection
+        table.addDataframeToDatabase(closeFrame(2, start="2021-01-01 00:05"), mode="append")
+        self.assertEqual(str(table.getPandas().index.tz), "UTC")
+        self.assertEqual(table.getPandas().index.tolist(), closeFrame(7).tz_localize("UTC").index.tolist())
+
+    def testWorkerPools(self):
+
+        pools = WorkerPools(threads=2, processes=0)
+        ticks = []
+
+        def blocking(value):
+            time.sleep(0.3)
+            ticks.append("done")
+            return value, threading.current_thread().name
+
+        def failing():
+            raise ValueError("failed")
+
+        async def ticker():
+            for i in range(5):
+                ticks.append(i)
+                await asyncio.sleep(0.02)
+
+        async def run():
+            loopThread = threading.current_thread().name
+            result, _ = await asyncio.gather(pools.run(blocking, 1), ticker())
+            # pure python work stays in the thread pool without processes
+            cpuResult = await pools.runCpu(blocking, 2)
+            with self.assertRaises(ValueError):
+                await pools.run(failing)
+            return loopThread, result, cpuResult
+
+        loop = asyncio.new_event_loop()
+        loopThread, result, cpuResult = loop.run_until_complete(run())
+        loop.close()
+
+        # the loop went on while the blocking call ran in a worker
+        self.assertEqual(ticks, [0, 1, 2, 3, 4, "done", "done"])
+        self.assertEqual(result[0], 1)
+        self.assertNotEqual(result[1], loopThread)
+        self.assertTrue(cpuResult[1].startswith("chipmunkdb-worker"))
+
+        stats = pools.getStats()
+        self.assertNotIn("processes", stats)
+        self.assertEqual(stats["threads"]["completed"], 2)
+        self.assertEqual(stats["threads"]["failed"], 1)
+        self.assertEqual(stats["threads"]["running"], 0)
+        self.assertEqual(stats["threads"]["queued"], 0)
+        pools.shutdown()
+
+    def testParseCache(self):
+
+        for func in [parse_query, replace_schemas, is_internal_query]:
+            func.cache_clear()
+
+        sql = "SELECT count(*) c FROM test_py_parse; SELECT sum(close) s FROM dataframe_view"
+        routes = parse_query(sql)
+        # the first table found is the target of the following statements
+        self.assertEqual([(r[1], r[2]) for r in routes], [("test_py_parse", ("test_py_parse",)),
+                                                          ("test_py_parse", ("dataframe_view",))])
+
+        # a repeated query gets the same routes, which no caller can change
+        self.assertIs(parse_query(sql), routes)
+        self.assertIsInstance(routes, tuple)
+        self.assertTrue(all(isinstance(r, tuple) and isinstance(r[2], tuple) for r in routes))
+        with self.assertRaises(TypeError):
+            routes[0][2][0] = "other"
+
+        self.assertEqual(replace_schemas('SELECT * FROM "default".test_py_parse'), "SELECT * FROM test_py_parse")
+        self.assertEqual(replace_schemas('SELECT * FROM "default".test_py_parse'), "SELECT * FROM test_py_parse")
+        self.assertTrue(is_internal_query("describe test_py_parse"))
+        self.assertFalse(is_internal_query("SELECT * FROM test_py_parse"))
+
+        stats = get_parse_cache_stats()
+        self.assertEqual((stats["parse"]["hits"], stats["parse"]["misses"]), (1, 1))
+        self.assertEqual((stats["schemas"]["hits"], stats["schemas"]["misses"]), (1, 1))
+        self.assertEqual(stats["internal"]["misses"], 2)
+
+        # the manager answers repeated queries from the cached routes
+        table = self.createCollection("test_py_parse", rows=10)
+        self.dbmng.loadedDatabases["test_py_parse"] = table
+        loop = asyncio.new_event_loop()
+        first = loop.run_until_complete(self.dbmng.query("SELECT count(*) c FROM test_py_parse"))
+        second = loop.run_until_complete(self.dbmng.query("SELECT count(*) c FROM test_py_parse"))
+        loop.close()
+        self.assertEqual(first[0][0]["c"].iloc[0], 10)
+        self.assertEqual(second[0][0]["c"].iloc[0], 10)
+        self.assertEqual(get_parse_cache_stats()["parse"]["hits"], 2)
+
+    def testDeltaSegments(self):
+
+        table = self.createCollection("test_py_delta", rows=10)
+        table._lastSaved = 0
+        table.save(update=False)
+
+        df2 = pd.DataFrame({"close": [100.0, 101.0]},
+                           index=pd.date_range("2021-01-01 00:10", periods=2, freq="1min"))
+        table.addDataframeToDatabase(df2, mode="append")
+        table._lastSaved = 0
+        table.save(update=False)
+
+        # the second save only writes the two new rows as a delta segment
+        self.assertEqual(table._segments, 1)
+
+        table2 = TableDatabase({
+            "name": "test_py_delta",
+            "indextype": "timeseries"
+        }, self.dbmng)
+
+        self.assertEqual(table2._df.shape[0], 12)
+        self.assertEqual(table2._df["close"].iloc[-1], 101.0)
+
+    def testSnapshotIsolation(self):
+
+        table = self.createCollection("test_py_snapshot", rows=10)
+        snapshot = table.getSnapshot()
+        version = table.getVersion()
+
+        table.addDataframeToDatabase(pd.DataFrame({"close": [-1.0]}, index=snapshot.index[:1]), mode="update")
+
+        # the old version is untouched, the new one is published
+        self.assertEqual(snapshot["close"].iloc[0], 0.0)
+        self.assertEqual(table.getSnapshot()["close"].iloc[0], -1.0)
+        self.assertEqual(table.getVersion(), version + 1)
+
+    def testQueryCache(self):
+
+        table = self.createCollection("test_py_cache", rows=10)
+
+        first, columns = table.query("SELECT sum(close) s FROM test_py_cache")
+        second, columns = table.query("SELECT  sum(close) s\n FROM test_py_cache;")
+        self.assertIs(first, second)
+
+        # a write publishes a new version, the old result is not used anymore
+        table.addDataframeToDatabase(closeFrame(1) + 100.0, mode="update")
+        third, columns = table.query("SELECT sum(close) s FROM test_py_cache")
+        self.assertEqual(third["s"].iloc[0], 145.0)
+
+        stats = self.dbmng.queryCache.getStats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertFalse(self.dbmng.queryCache.isCacheable("SELECT * FROM t WHERE datetime > now() - INTERVAL 1 DAY"))
+
+    def testTimeRangePushdown(self):
+
+        table = self.createCollection("test_py_range")
+        data = closeFrame(1000)
+        data["sig.datetime"] = data.index - pd.Timedelta(days=1)
+        table.addDataframeToDatabase(data, mode="append")
+
+        start, end = table.getQueryTimeRange("SELECT * FROM dataframe_view WHERE datetime BETWEEN '2021-01-01 01:00' AND '2021-01-01 02:00'")
+        self.assertEqual((start, end), (pd.Timestamp("2021-01-01 01:00"), pd.Timestamp("2021-01-01 02:00")))
+        # with OR the predicate does not restrict the rows
+        self.assertEqual(table.getQueryTimeRange("SELECT * FROM dataframe_view WHERE datetime > '2021-01-01' OR close > 1"), (None, None))
+
+        df, columns = table.query("SELECT count(*) c FROM test_py_range WHERE datetime >= '2021-01-01 01:00' AND datetime < '2021-01-01 02:00'")
+        self.assertEqual(df["c"].iloc[0], 60)
+
+        # a quoted domain column is not the index, a predicate which is the operand of a comparison or IS does not restrict the rows
+        for where, count in [("\"sig.datetime\" < '2020-12-31 01:00'", 60), ("(datetime > '2021-01-01 01:00') = false", 61),
+                             ("(datetime > '2021-01-01 01:00') IS NULL", 0), ("(close > 1 AND datetime > '2021-01-01 01:00') = false", 61)]:
+            self.assertEqual(table.getQueryTimeRange("SELECT * FROM dataframe_view WHERE " + where), (None, None))
+            df, columns = table.query("SELECT count(*) c FROM test_py_range WHERE " + where)
+            self.assertEqual(df["c"].iloc[0], count)
+        self.assertEqual(table.getQueryTimeRange("SELECT * FROM dataframe_view t WHERE (t.datetime > '2021-01-01') AND close > 1"),
+                         (pd.Timestamp("2021-01-01"), None))
+
+    def testColumnStatistics(self):
+
+        table = self.createCollection("test_py_stats")
+        data = closeFrame(1000)
+        data.iloc[::10] = np.nan
+        table.addDataframeToDatabase(data.iloc[:500], mode="append")
+        table.getStatistics()
+        table.addDataframeToDatabase(data.iloc[500:], mode="append")
+
+        # the statistics were updated with the write, not computed again
+        self.assertEqual(table._statistics[0], table.getVersion())
+        frame, statistics = table.getStatistics()
+        self.assertEqual(statistics.getRowCount(), 1000)
+        self.assertEqual(statistics.getNullCount("close"), 100)
+        self.assertEqual(statistics.getMax("close"), 999.0)
+
+        df, columns = table.query("SELECT count(*) AS c, count(close) AS n, min(close) AS low FROM test_py_stats")
+        self.assertEqual(df.iloc[0].tolist(), [1000, 900, 1.0])
+        self.assertEqual([d["Null"] for d in table.getDescriptions() if d["Field"] == "close"], ["YES"])
+
+    def testChunkSkipping(self):
+
+        rows = STATS_CHUNK_ROWS * 3
+        table = self.createCollection("test_py_skip", rows=rows)
+        bound = STATS_CHUNK_ROWS * 2 + 5
+
+        # only the last chunk can have rows for the predicate
+        self.assertEqual(table.skipChunks("SELECT * FROM dataframe_view WHERE close > %d" % bound).shape[0], STATS_CHUNK_ROWS)
+
+        # a predicate which is the operand of a comparison or IS is no range, the result is the one of the full scan
+        for where, count in [("close > %d" % bound, rows - bound - 1), ("(close > %d) = false" % bound, bound + 1),
+                             ("(close > %d) IS NULL" % bound, 0)]:
+            predicates = parse_column_predicates("SELECT * FROM dataframe_view WHERE " + where, "dataframe_view")
+            self.assertEqual(len(predicates) > 0, where.startswith("close"))
+            df, columns = table.query("SELECT count(*) c FROM test_py_skip WHERE " + where)
+            self.assertEqual(df["c"].iloc[0], count)
+
+    def testEmptyRowsFilter(self):
+
+        table = self.createCollection("test_py_empty")
+        data = closeFrame(100)
+        data.iloc[::4] = np.nan
+        table.addDataframeToDatabase(pd.DataFrame({"a.close": data["close"], "b.open": np.arange(100.0)}, index=data.index),
+                                     mode="append")
+
+        # the rows without a value in the returned columns are removed by the query itself
+        df, columns = table.query("SELECT * FROM test_py_empty", domains=["a."])
+        self.assertEqual(df.shape[0], 75)
+        self.assertEqual(df.columns.tolist(), ["a.close", "datetime"])
+
+        self.assertFalse(table.mayHaveEmptyRows(["datetime", "b.open"], table.getVersion()))
+        self.assertTrue(table.mayHaveEmptyRows(["datetime", "a.close"], table.getVersion()))
+        self.assertEqual(self.dbmng.getFrameFromTable(table, [], ["a."], None, None).shape[0], 75)
+
+    def testArrowQuery(self):
+
+        table = self.createCollection("test_py_arrow_query", storage_policy="strings")
+        data = closeFrame(100)
+        data.iloc[::4] = np.nan
+        table.addDataframeToDatabase(pd.DataFrame({"a.close": data["close"], "b.side": np.where(np.arange(100) % 2 == 0, "long", "short")},
+                                                  index=data.index), mode="append")
+
+        # the arrow result has the same rows and columns as the dataframe, without converting it
+        for domains in [[], ["a."]]:
+            df, columns = table.query("SELECT * FROM test_py_arrow_query", domains=domains)
+            arrow, arrowColumns = table.query("SELECT * FROM test_py_arrow_query", domains=domains, arrow=True)
+            self.assertIsInstance(arrow, pa.Table)
+            self.assertEqual(arrow.column_names, df.columns.tolist())
+            self.assertEqual(arrow.num_rows, df.shape[0])
+        self.assertEqual(arrow.num_rows, 75)
+
+        # enums are sent with signed dictionary indices, so pandas can read them
+        arrow, columns = table.query("SELECT \"b.side\" FROM test_py_arrow_query", arrow=True)
+        self.assertEqual(arrow.to_pandas()["b.side"].tolist()[:2], ["long", "short"])
+
+    def testStoragePolicy(self):
+
+        table = self.createCollection("test_py_policy", storage_policy="integers,float32,strings")
+        data = closeFrame(1000)
+        data["vol"] = np.arange(1000) % 10
+        data["side"] = np.where(np.arange(1000) % 2 == 0, "long", "short")
+        table.addDataframeToDatabase(data.iloc[:500], mode="append")
+        table.addDataframeToDatabase(data.iloc[500:], mode="append")
+        table.addDataframeToDatabase(pd.DataFrame({"vol": [100000], "side": ["flat"]}, index=data.index[:1]), mode="update")
+
+        dtypes = table.getPandas().dtypes
+        self.assertEqual(str(dtypes["close"]), "float32")
+        self.assertEqual(str(dtypes["vol"]), "int32")
+        self.assertEqual(str(dtypes["side"]), "category")
+
+        df, columns = table.query("SELECT side, count(*) AS c, max(vol) AS v FROM test_py_policy GROUP BY side ORDER BY side")
+        self.assertEqual(df["side"].tolist(), ["flat", "long", "short"])
+        self.assertEqual(df["c"].tolist(), [1, 499, 500])
+        self.assertEqual(df["v"].iloc[0], 100000)
+
+        # the query sees the narrowed integers with their wide type, so arithmetic does not overflow
+        df, columns = table.query("SELECT max(vol * 100000) AS m, max(vol + vol) AS s FROM test_py_policy")
+        self.assertEqual(df.iloc[0].tolist(), [10000000000, 200000])
+
+    def testStoragePolicyIsOptIn(self):
+
+        table = self.createCollection("test_py_policy_default")
+        data = closeFrame(100)
+        data["vol"] = np.arange(100)
+        table.addDataframeToDatabase(data, mode="append")
+        self.assertEqual(str(table.getPandas().dtypes["vol"]), "int64")
+        table.checkpoint()
+
+        # a frame loaded from a file keeps its types, even when the collection has a policy now
+        reloaded = TableDatabase({"name": "test_py_policy_default", "indextype": "timeseries", "storage_policy": "integers"},
+                                 self.dbmng)
+        self.assertEqual(str(reloaded.getPandas().dtypes["vol"]), "int64")
+
+    def testRetention(self):
+
+        table = self.createCollection("test_py_retention", rows=100, freq="1D")
+        table.checkpoint()
+
+        # the expired rows are removed from the loaded frame and from the file
+        self.assertEqual(table.applyRetention(pd.Timestamp("2021-03-02")), 60)
+        self.assertEqual(table.getPandas().index[0], pd.Timestamp("2021-03-02"))
+        self.assertEqual(self.loadCollection("test_py_retention").getRowCount(), 40)
+
+        # without a loaded frame only the files change, results cached before are not used anymore
+        onDisk = self.loadCollection("test_py_retention", onDisk=True)
+        self.assertEqual(onDisk.query("SELECT count(*) c FROM test_py_retention")[0]["c"].iloc[0], 40)
+        self.assertEqual(onDisk.applyRetention(pd.Timestamp("2021-03-12")), 10)
+        self.assertEqual(onDisk.query("SELECT count(*) c FROM test_py_retention")[0]["c"].iloc[0], 30)
+        self.assertFalse(onDisk._hydrated)
+
+        # the retention of a collection which is not loaded closes the connections of its temporary object
+        async def collectionInfo(name):
+            return {"name": name, "indextype": "timeseries"}
+
+        self.dbmng.getCollectionInfoByName = collectionInfo
+        closed = self.collectClosedObjects()
+        loop = asyncio.new_event_loop()
+        removed = loop.run_until_complete(self.dbmng.applyCollectionRetention("test_py_retention", pd.Timestamp("2021-03-22")))
+        loop.close()
+        self.assertEqual(removed, 10)
+        self.assertEqual(len(closed), 1)
+        self.assertIsNone(closed[0]._fileDb)
+
+        # a retention which can not be read is counted as failed, the other rows are still applied
+        async def retentions(table):
+            if table != "collections":
+                return []
+            return [{"name": "test_py_broken", "retention": "ninety days"},
+                    {"name": "test_py_retention", "retention": "keep 1 day"}]
+
+        self.dbmng.getRetentions = retentions
+        job = RetentionJob(self.dbmng)
+        loop = asyncio.new_event_loop()
+        stats = loop.run_until_complete(job.run())
+        loop.close()
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(stats["rows"], 20)
+
+        self.assertEqual(RetentionJob.parseRetention("keep 90 days"), pd.Timedelta(days=90))
+        self.assertIsNone(RetentionJob.parseRetention("forever"))
+        with self.assertRaises(Exception):
+            RetentionJob.parseRetention("ninety days")
+
+    def testSharedCatalog(self):
+
+        prices = self.createCollection("test_py_prices", rows=10)
+        volumes = self.createCollection("test_py_volumes")
+        volumes.addDataframeToDatabase(closeFrame(5, freq="2min").rename(columns={"close": "vol"}), mode="append")
+
+        query = "SELECT p.datetime, close, vol FROM test_py_prices p JOIN test_py_volumes v ON p.datetime = v.datetime ORDER BY 1"
+        self.assertEqual(parse_query(query)[0][2], ("test_py_prices", "test_py_volumes"))
+
+        catalog = SharedCatalog(self.dbmng.queryCache)
+        df, columns = catalog.query(query, {"test_py_prices": prices, "test_py_volumes": volumes})
+        self.assertEqual(df["close"].tolist(), [0.0, 2.0, 4.0, 6.0, 8.0])
+        self.assertEqual(df["vol"].tolist(), [0.0, 1.0, 2.0, 3.0, 4.0])
+
+    def testEvictionToDisk(self):
+
+        table = self.createCollection("test_py_evict", rows=100)
+        self.dbmng.loadedDatabases["test_py_evict"] = table
+        self.assertGreater(self.dbmng.getMemoryStats()["used"], 0)
+
+        # the pending changes are written before the memory is released
+        self.assertTrue(self.dbmng.cleanupDatabase(table, "test_py_evict"))
+        self.assertTrue(table.isEvicted())
+        self.assertEqual(table.getMemoryUsage(), 0)
+        self.assertNotIn("test_py_evict", self.dbmng.loadedDatabases)
+        self.assertTrue(os.path.isfile(table.getSnapshotFile()))
+
+        reloaded = TableDatabase({
+            "name": "test_py_evict",
+            "indextype": "timeseries"
+        }, self.dbmng)
+        self.assertEqual(reloaded.getRowCount(), 100)
+        self.assertEqual(reloaded.getPandas().index.tolist(), closeFrame(100).index.tolist())
+        reloaded.drop()
+        self.assertFalse(os.path.isfile(table.getSnapshotFile()))
+
+    def testReadWriteLock(self):
+
+        lock = ReadWriteLock()
+        events = []
+
+        async def reader():
+            async with lock.readLocked():
+                events.append("read")
+                await asyncio.sleep(0.05)
+
+        async def writer():
+            await asyncio.sleep(0.01)
+            async with lock.writeLocked():
+                # both readers have to be finished before the writer gets the lock
+                events.append(lock.getState()["readers"])
+
+        async def run():
+            await asyncio.gather(reader(), reader(), writer())
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run())
+        loop.close()
+        self.assertEqual(events, ["read", "read", 0])
+
+        lock.acquireWrite()
+        with self.assertRaises(Exception):
+            lock.acquireRead(timeout=0.05)
+        lock.releaseWrite()
+
+    def testSaveScheduler(self):
+
+        class Target():
+            def __init__(self):
+                self.saves = 0
+
+            def getDirtyBytes(self):
+                return 100
+
+            def checkpoint(self, update=False):
+                self.saves = self.saves + 1
+                return True
+
+        scheduler = SaveScheduler(workers=2)
+        target = Target()
+        for i in range(50):
+            scheduler.request(target, delay=0.2)
+        scheduler.flush(timeout=5)
+
+        # all requests were waiting for the same checkpoint
+        self.assertEqual(target.saves, 1)
+        self.assertEqual(scheduler.getStats()["coalesced"], 49)
+        scheduler.shutdown()
+
+    def testGatherStatements(self):
+
+        pools = WorkerPools(threads=4)
+        state = {"running": 0, "max": 0}
+
+        async def statement(value):
+            state["running"] = state["running"] + 1
+            state["max"] = max(state["max"], state["running"])
+            await asyncio.sleep(0.05 * (5 - value))
+            state["running"] = state["running"] - 1
+            return value
+
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(pools.gather([statement(i) for i in range(5)], limit=2))
+        loop.close()
+
+        # the results keep the order of the statements, even when later ones finish first
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+        self.assertEqual(state["max"], 2)
+        pools.shutdown()
+
+    def testStreamBatches(self):
+
+        df = closeFrame(25).reset_index(names="datetime")
+        df.loc[3, "close"] = np.nan
+
+        # the batches together are the same body as the one of the buffered response
+        batches = [encodeStreamBatch(df, lo, lo + 10, False) for lo in range(0, 25, 10)]
+        self.assertEqual("[" + ", ".join(batches) + "]", dumpJson(formatRecords(df)))
+
+        lines = "".join([encodeStreamBatch(df, lo, lo + 10, True) for lo in range(0, 25, 10)]).splitlines()
+        self.assertEqual(len(lines), 25)
+        self.assertEqual(lines[3], '{"datetime": "2021-01-01 00:03:00+00:00", "close": null}')
+
+    def testJsonEncoding(self):
+
+        index = pd.date_range("2021-03-27", periods=50, freq="1h")
+        df = pd.DataFrame({"datetime": index, "close": np.arange(50.0) / 3, "vol": np.arange(50),
+                           "side": np.where(np.arange(50) % 2 == 0, 'long "a"', None),
+                           "local": index.tz_localize("UTC").tz_convert("Europe/Berlin")})
+        df.loc[3, "close"] = np.nan
+        df.loc[4, "close"] = np.inf
+
+        # encoded column by column, but the same body as a dumps of the records
+        expected = dumpJson({"result": formatRecords(df), "columns": [{"name": "close"}]})
+        self.assertEqual(encodeQueryResult([df], None, [{"name": "close"}]), expected)
+
+        df.loc[5, "datetime"] = pd.NaT
+        self.assertEqual(encodeQueryResult([df], None), dumpJson({"result": formatRecords(df)}))
+
+    def testParquetRowGroups(self):
+
+        df = closeFrame(RAWSTREAM_ROW_GROUP_ROWS * 2 + 10, freq="1s")
+        table = pa.Table.from_pandas(df)
+
+        # every row group is taken out of the buffer when it is written, together they are one parquet file
+        buffer = ArrowStreamBuffer()
+        writer, groups = startParquetStream(buffer, table)
+        parts = [writeParquetRowGroup(buffer, writer, table, lo) for lo in groups + [None]]
+        self.assertEqual(len(groups), 3)
+        self.assertTrue(all([len(part) > 0 for part in parts]))
 
+        body = io.BytesIO(b"".join(parts))
+        self.assertEqual(pq.ParquetFile(body).num_row_groups, 3)
+        self.assertTrue(pd.read_parquet(body).equals(df))
 
+    def testResultShapes(self):
 
+        df = closeFrame(25).reset_index(names="datetime")
+        df["side"] = np.where(np.arange(25) % 3 == 0, "long", None)
+        df.loc[3, "close"] = np.nan
+        formatted = formatRecords(df)
+        records = pd.DataFrame(formatted)
 
+        split = dumpJson({"result": {"columns": list(records.columns), "data": records.values.tolist()}})
+        self.assertEqual(encodeQueryResult([df], None, shape="split"), split.replace("NaN", "null"))
+        columnar = dumpJson({"result": {c: [r[c] for r in formatted] for c in records.columns}})
+        self.assertEqual(encodeQueryResult([df], None, shape="columnar"), columnar)
 
+        # the streamed batches give the same layouts
+        for shape, expected in [("split", split.replace("NaN", "null")), ("columnar", columnar)]:
+            head, tail, count, step = getStreamLayout(df, shape)
+            batches = [encodeStreamBatch(df, lo, lo + step, False, shape) for lo in range(0, count, step)]
+            self.assertEqual('{"result": ' + head + ", ".join(batches) + tail + "}", expected)